@@ -0,0 +1,577 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+# Load generator for Inter.
+#
+# This starts a copy of the server in a temporary directory, with an auth.yml holding an API key for each simulated
+#   server, connects that many clients and has each of them send a mix of chat, players online/offline and players
+#   list messages at a fixed rate. Afterwards, it writes out a JSON report of:
+#
+#   - Connection setup: how long it took from connecting to getting a reply to the first request, and the rate at
+#       which the clients got connected.
+#   - Throughput: messages sent and received, overall and per type, per second.
+#   - Latency: chat and player online/offline messages carry the time they were sent, so each copy of them that's
+#       relayed to another client gives an end-to-end sample; list requests are timed until their reply.
+#   - The server's CPU time and RSS (including its workers), sampled every second from /proc, and our own CPU time -
+#       if that's close to the length of the run, the load generator was the bottleneck, not the server.
+#
+# Run it from the repository root, with the same Python that runs the server:
+#
+#   python benchmarks/loadgen.py --clients 100 --rate 10 --duration 30 --output results.json
+#
+# Use --workers to run the server with several worker processes, --config to give it extra configuration files, or
+#   --connect and --auth to aim at a server that's already running instead. See --help for everything else.
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+
+import yaml
+from twisted.internet import protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TYPES = ("chat", "online", "offline", "list")
+PERCENTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+MARKER = "lg:"  # Chat messages are MARKER followed by the time they were sent
+FROM_CHAT = re.compile(r'"from"\s*:\s*"chat"')  # Whichever JSON codec the server uses, and however it spaces things
+
+try:
+    TICKS = float(os.sysconf("SC_CLK_TCK"))
+    PAGE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    TICKS = PAGE = None
+
+
+def summarise(samples):
+    """
+    Get the count, mean, maximum and percentiles of a list of samples, in milliseconds.
+    :param samples: A list of samples, in seconds.
+    """
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    result = {"count": len(samples), "mean": sum(samples) / len(samples) * 1000, "max": samples[-1] * 1000}
+    for name, percentile in PERCENTILES:
+        index = min(len(samples) - 1, max(0, int(math.ceil(percentile / 100 * len(samples))) - 1))
+        result[name] = samples[index] * 1000
+    return result
+
+
+class Samples(object):
+    """
+    A uniform random sample of at most `size` values (reservoir sampling), so long runs don't eat all the memory.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.size:
+                self.values[index] = value
+
+
+class Server(object):
+    """
+    A copy of the server, running in a temporary directory with generated configuration.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.path = None
+        self.process = None
+        self.log = None
+        self.keys = [("bench-%s-%s" % (i, uuid.uuid4().hex), "bench%s" % i) for i in xrange(args.clients)]
+
+    def start(self):
+        self.path = tempfile.mkdtemp(prefix="inter-loadgen-")
+        for name in ("system", "plugins"):
+            shutil.copytree(os.path.join(ROOT, name), os.path.join(self.path, name),
+                            ignore=shutil.ignore_patterns("*.pyc"))
+        shutil.copy(os.path.join(ROOT, "run.py"), self.path)
+        os.makedirs(os.path.join(self.path, "config"))
+        os.makedirs(os.path.join(self.path, "data"))
+
+        mapping = {"networking": "networking.yml", "auth": "auth.yml"}
+        networking = {"port": self.args.port, "workers": self.args.workers,
+                      "config_watcher": {"enabled": False}}
+        for entry in self.args.config:
+            name, _, filename = entry.partition("=")
+            with open(filename, "r") as fh:
+                settings = yaml.safe_load(fh) or {}
+            if name == "networking":
+                networking.update(settings)
+            else:
+                mapping[name] = "%s.yml" % name
+                self._write("%s.yml" % name, settings)
+        self._write("mapping.yml", mapping)
+        self._write("networking.yml", networking)
+        self._write("auth.yml", {"keys": dict(self.keys)})
+
+        self.log = open(os.path.join(self.path, "server.log"), "w")
+        self.process = subprocess.Popen([self.args.python, "run.py"], cwd=self.path, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The server exited with code %s; see %s" %
+                                   (self.process.returncode, os.path.join(self.path, "server.log")))
+            try:
+                socket.create_connection(("127.0.0.1", self.args.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("The server didn't start listening within 30 seconds")
+
+    def _write(self, filename, data):
+        with open(os.path.join(self.path, "config", filename), "w") as fh:
+            yaml.safe_dump(data, fh, default_flow_style=False)
+
+    def processes(self):
+        # The server's PID, and those of its worker processes
+        pids = [self.process.pid]
+        try:
+            parents = {}
+            for name in os.listdir("/proc"):
+                if name.isdigit():
+                    try:
+                        with open("/proc/%s/stat" % name) as fh:
+                            parents[int(name)] = int(fh.read().rsplit(")", 1)[1].split()[1])
+                    except (IOError, IndexError, ValueError):
+                        pass
+        except OSError:
+            return pids
+        for pid in pids:
+            pids.extend(child for child, parent in parents.iteritems() if parent == pid)
+        return pids
+
+    def usage(self):
+        """
+        Get the total CPU time (in seconds) and RSS (in bytes) of the server and its workers, or None on systems
+            without /proc.
+        """
+        if TICKS is None or not os.path.exists("/proc/%s/stat" % self.process.pid):
+            return None
+        cpu = 0
+        rss = 0
+        for pid in self.processes():
+            try:
+                with open("/proc/%s/stat" % pid) as fh:
+                    fields = fh.read().rsplit(")", 1)[1].split()
+            except IOError:
+                continue
+            cpu += int(fields[11]) + int(fields[12])  # utime and stime
+            rss += int(fields[21]) * PAGE
+        return cpu / TICKS, rss
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            deadline = time.time() + 10
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        if self.log is not None:
+            self.log.close()
+        if self.path is not None:
+            if self.args.keep:
+                sys.stderr.write("Left the server's files in %s\n" % self.path)
+            else:
+                shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Client(LineReceiver):
+    """
+    One simulated server. It connects, authenticates (along with a locate request, since authentication on its own
+        gets no reply), then sends messages at the configured rate until it's told to stop.
+    """
+
+    delimiter = "\r\n"
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, bench, index, key):
+        self.bench = bench
+        self.index = index
+        self.key = key
+        self.started = None
+        self.ready = False
+        self.loop = None
+        self.players = []
+        self.next_player = 0
+        self.lists = deque()  # Times of list requests that haven't been answered yet
+
+    def connectionMade(self):
+        self.send({"api_key": self.key, "action": "players", "type": "locate", "player": "nobody"})
+
+    def connectionLost(self, reason=None):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.bench.lost(self)
+
+    def send(self, message):
+        self.sendLine(json.dumps(message))
+
+    def start(self):
+        self.loop = task.LoopingCall(self.tick)
+        reactor.callLater(random.random() / self.bench.rate, self.loop.start, 1.0 / self.bench.rate)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        kind = self.bench.choose()
+        if kind == "offline" and not self.players:
+            kind = "online"
+        elif kind == "online" and len(self.players) >= self.bench.max_players:
+            kind = "offline"
+        now = time.time()
+
+        if kind == "chat":
+            self.send({"action": "chat", "user": "c%sp0" % self.index, "message": "%s%r" % (MARKER, now)})
+        elif kind == "online":
+            player = "c%sp%s" % (self.index, self.next_player)
+            self.next_player += 1
+            self.players.append(player)
+            self.bench.relayed[("online", player)] = now
+            self.send({"action": "players", "type": "online", "player": player})
+        elif kind == "offline":
+            player = self.players.pop(random.randrange(len(self.players)))
+            self.bench.relayed[("offline", player)] = now
+            self.send({"action": "players", "type": "offline", "player": player})
+        else:
+            self.lists.append(now)
+            self.send({"action": "players", "type": "list"})
+        self.bench.sent(kind)
+
+    def lineReceived(self, line):
+        now = time.time()
+        bench = self.bench
+
+        # Chat is the bulk of the traffic, so find its timestamp without decoding the whole message
+        position = line.find(MARKER)
+        if position != -1 and FROM_CHAT.search(line):
+            end = line.find('"', position)
+            try:
+                bench.received("chat", now - float(line[position + len(MARKER):end]))
+                return
+            except ValueError:
+                pass  # Escaped or reordered somehow; decode it properly below
+
+        try:
+            message = json.loads(line)
+        except ValueError:
+            bench.errors += 1
+            return
+        if not isinstance(message, dict):
+            return
+        if "error" in message:
+            bench.errors += 1
+            return
+        if message.get("from") == "chat":
+            text = message.get("message")
+            if isinstance(text, basestring) and text.startswith(MARKER):
+                try:
+                    bench.received("chat", now - float(text[len(MARKER):]))
+                except ValueError:
+                    bench.errors += 1
+            return
+        if message.get("from") != "players":
+            return
+
+        kind = message.get("type")
+        if kind == "locate" and not self.ready:
+            self.ready = True
+            bench.connected(self, now - self.started)
+        elif kind in ("online", "offline"):
+            sent = bench.relayed.get((kind, message.get("player")))
+            bench.received(kind, None if sent is None else now - sent)
+        elif kind == "list" and self.lists:
+            bench.received("list", now - self.lists.popleft())
+
+
+class ClientFactory(protocol.ClientFactory):
+
+    def __init__(self, bench, index, key):
+        self.bench = bench
+        self.index = index
+        self.key = key
+
+    def buildProtocol(self, addr):
+        client = Client(self.bench, self.index, self.key)
+        client.started = self.started
+        return client
+
+    def startedConnecting(self, connector):
+        self.started = time.time()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.bench.failed(reason)
+
+
+class Benchmark(object):
+    """
+    Runs the clients through each phase - connecting, warming up, measuring - and collects the results.
+    """
+
+    def __init__(self, args, keys, server=None):
+        self.args = args
+        self.keys = keys
+        self.server = server
+        self.rate = args.rate
+        self.max_players = args.players
+        self.kinds, self.weights = zip(*args.mix)
+        self.total_weight = float(sum(self.weights))
+
+        self.clients = []
+        self.ready = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.setup_times = []
+        self.first_connect = None
+        self.last_ready = None
+        self.relayed = {}  # {(type, player): time sent}
+
+        self.measuring = False
+        self.errors = 0
+        self.sent_counts = dict.fromkeys(TYPES, 0)
+        self.received_counts = dict.fromkeys(TYPES, 0)
+        self.latencies = dict((kind, Samples(args.samples)) for kind in TYPES)
+        self.usage = []  # (time, cpu seconds, rss bytes)
+        self.monitor = None
+        self.result = None
+
+    def choose(self):
+        pick = random.random() * self.total_weight
+        for kind, weight in zip(self.kinds, self.weights):
+            pick -= weight
+            if pick < 0:
+                return kind
+        return self.kinds[-1]
+
+    def run(self):
+        self.first_connect = time.time()
+        for index, (key, name) in enumerate(self.keys):
+            factory = ClientFactory(self, index, key)
+            reactor.connectTCP(self.args.host, self.args.port, factory, timeout=30)
+        self.timeout = reactor.callLater(self.args.connect_timeout, self.connectTimedOut)
+
+    def connected(self, client, setup_time):
+        self.clients.append(client)
+        self.setup_times.append(setup_time)
+        self.ready += 1
+        self.last_ready = time.time()
+        self.checkConnected()
+
+    def failed(self, reason):
+        self.connect_failures += 1
+        self.checkConnected()
+
+    def lost(self, client):
+        if self.measuring:
+            self.disconnects += 1
+
+    def checkConnected(self):
+        if self.ready + self.connect_failures == len(self.keys):
+            if self.timeout.active():
+                self.timeout.cancel()
+            self.startTraffic()
+
+    def connectTimedOut(self):
+        sys.stderr.write("Only %s of %s clients connected in time; carrying on with those.\n" %
+                         (self.ready, len(self.keys)))
+        self.connect_failures = len(self.keys) - self.ready
+        self.startTraffic()
+
+    def startTraffic(self):
+        sys.stderr.write("%s clients connected; warming up for %s seconds.\n" % (self.ready, self.args.warmup))
+        for client in self.clients:
+            client.start()
+        reactor.callLater(self.args.warmup, self.startMeasuring)
+
+    def startMeasuring(self):
+        sys.stderr.write("Measuring for %s seconds.\n" % self.args.duration)
+        self.measuring = True
+        self.started = time.time()
+        self.cpu_started = os.times()
+        if self.server is not None:
+            self.monitor = task.LoopingCall(self.sample)
+            self.monitor.start(1.0)
+        reactor.callLater(self.args.duration, self.stopMeasuring)
+
+    def sample(self):
+        usage = self.server.usage()
+        if usage is not None:
+            self.usage.append((time.time(),) + usage)
+
+    def sent(self, kind):
+        if self.measuring:
+            self.sent_counts[kind] += 1
+
+    def received(self, kind, latency):
+        if self.measuring:
+            self.received_counts[kind] += 1
+            if latency is not None:
+                self.latencies[kind].add(latency)
+
+    def stopMeasuring(self):
+        if self.monitor is not None:
+            self.sample()
+            self.monitor.stop()
+        self.measuring = False
+        elapsed = time.time() - self.started
+        cpu = os.times()
+        for client in self.clients:
+            client.stop()
+        self.result = self.report(elapsed, cpu[0] + cpu[1] - self.cpu_started[0] - self.cpu_started[1])
+        for client in self.clients:
+            client.transport.loseConnection()
+        reactor.callLater(0.5, reactor.stop)
+
+    def report(self, elapsed, cpu):
+        connect_time = (self.last_ready or self.first_connect) - self.first_connect
+        sent = sum(self.sent_counts.values())
+        received = sum(self.received_counts.values())
+        result = {
+            "time": time.time(),
+            "config": {
+                "clients": len(self.keys), "rate": self.rate, "mix": dict(self.args.mix), "players": self.max_players,
+                "duration": self.args.duration, "warmup": self.args.warmup, "workers": self.args.workers,
+                "host": self.args.host, "port": self.args.port, "python": sys.version.split()[0]
+            },
+            "connections": {
+                "connected": self.ready,
+                "failed": self.connect_failures,
+                "disconnected": self.disconnects,
+                "per_second": self.ready / connect_time if connect_time else None,
+                "setup_ms": summarise(self.setup_times)
+            },
+            "throughput": {
+                "elapsed": elapsed,
+                "sent": sent,
+                "received": received,
+                "sent_per_second": sent / elapsed,
+                "received_per_second": received / elapsed,
+                "types": dict((kind, {"sent": self.sent_counts[kind], "received": self.received_counts[kind],
+                                      "sent_per_second": self.sent_counts[kind] / elapsed,
+                                      "received_per_second": self.received_counts[kind] / elapsed})
+                              for kind in TYPES)
+            },
+            "latency_ms": dict((kind, summarise(self.latencies[kind].values)) for kind in TYPES),
+            "errors": self.errors,
+            "loadgen": {"cpu_seconds": cpu, "cpu_percent": cpu / elapsed * 100},
+            "server": None
+        }
+
+        if len(self.usage) >= 2:
+            first, last = self.usage[0], self.usage[-1]
+            rss = [sample[2] for sample in self.usage]
+            result["server"] = {
+                "cpu_seconds": last[1] - first[1],
+                "cpu_percent": (last[1] - first[1]) / (last[0] - first[0]) * 100,
+                "rss_mb": {"mean": sum(rss) / float(len(rss)) / 1048576, "max": max(rss) / 1048576.0,
+                           "end": rss[-1] / 1048576.0}
+            }
+        return result
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in TYPES:
+            raise argparse.ArgumentTypeError("Unknown message type %r; use %s" % (kind, ", ".join(TYPES)))
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate load against an Inter server and report how it coped.")
+    parser.add_argument("--clients", type=int, default=50, help="Number of simulated servers (default 50)")
+    parser.add_argument("--rate", type=float, default=5, help="Messages per second, per client (default 5)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=60,online=15,offline=15,list=10"),
+                        help="Weights of each message type (default chat=60,online=15,offline=15,list=10)")
+    parser.add_argument("--players", type=int, default=50,
+                        help="Most players each client has online at once (default 50)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure for (default 30)")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of traffic before measuring (default 3)")
+    parser.add_argument("--connect-timeout", type=float, default=60,
+                        help="Seconds to wait for every client to connect (default 60)")
+    parser.add_argument("--samples", type=int, default=1000000,
+                        help="Most latency samples to keep per message type (default 1000000)")
+    parser.add_argument("--port", type=int, default=35566, help="Port for the server (default 35566)")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes (default 1)")
+    parser.add_argument("--config", action="append", default=[], metavar="NAME=FILE",
+                        help="Extra configuration for the server, eg chat=chat.yml; may be repeated. "
+                             "networking=FILE is merged into the generated networking configuration")
+    parser.add_argument("--python", default=sys.executable, help="Python to run the server with")
+    parser.add_argument("--keep", action="store_true", help="Keep the server's temporary directory and log")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="Use a server that's already running, instead of starting one (needs --auth)")
+    parser.add_argument("--auth", metavar="FILE", help="That server's auth.yml, for API keys")
+    parser.add_argument("--output", default="-", help="Where to write the JSON results (default stdout)")
+    args = parser.parse_args()
+    args.host = "127.0.0.1"
+
+    server = None
+    if args.connect:
+        if not args.auth:
+            parser.error("--connect needs --auth")
+        args.host, _, port = args.connect.rpartition(":")
+        args.port = int(port)
+        with open(args.auth, "r") as fh:
+            keys = sorted((yaml.safe_load(fh) or {}).get("keys", {}).items())
+        if len(keys) < args.clients:
+            parser.error("%s only has %s API keys" % (args.auth, len(keys)))
+        keys = keys[:args.clients]
+    else:
+        server = Server(args)
+        keys = server.keys
+
+    try:
+        if server is not None:
+            sys.stderr.write("Starting the server on port %s.\n" % args.port)
+            server.start()
+        bench = Benchmark(args, keys, server)
+        reactor.callWhenRunning(bench.run)
+        reactor.run()
+    finally:
+        if server is not None:
+            server.stop()
+
+    if bench.result is None:
+        sys.stderr.write("The benchmark didn't finish.\n")
+        sys.exit(1)
+
+    output = json.dumps(bench.result, indent=2, sort_keys=True)
+    if args.output == "-":
+        print output
+    else:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+        sys.stderr.write("Wrote the results to %s\n" % args.output)
+
+
+if __name__ == "__main__":
+    main()
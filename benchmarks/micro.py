@@ -0,0 +1,328 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+# Microbenchmarks for the server's hot paths.
+#
+# Where benchmarks/loadgen.py measures a whole server over the network, these run a CoreFactory in this process -
+#   with its plugins loaded from a temporary copy, and connections made over Twisted's in-memory StringTransport - and
+#   time single operations in isolation:
+#
+#   core.lineReceived         Parsing a line of JSON and routing it, for an action nothing handles.
+#   events.runCallback/N      Dispatching an event to N handlers.
+#   auth.valid / auth.invalid AuthPlugin.onDataReceived, for a valid and an invalid API key.
+#   chat.saveMessage          ChatPlugin.saveMessage, with the history already full.
+#   players.list/...          Answering a players list request with a large roster, when its encoded form has to be
+#                               built and when it's been cached.
+#
+# Each benchmark is calibrated to run for at least --min-time seconds, repeated --repeat times, and the fastest
+#   repeat is reported (in microseconds per operation), since that's the one with the least interference.
+#
+#   python benchmarks/micro.py                                   Run everything and print the results
+#   python benchmarks/micro.py --save benchmarks/baseline.json   Record a new baseline
+#   python benchmarks/micro.py --compare benchmarks/baseline.json --threshold 10
+#                                                                Run, and flag anything more than 10% slower than
+#                                                                  the baseline (exiting with status 1 if anything is)
+#
+# Timings depend heavily on the machine, so only compare against a baseline recorded on the same one. The baseline in
+#   the repository shows the expected shape of the results; re-record it with --save before relying on it.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+timer = timeit.default_timer
+
+HISTORY_SIZE = 1000
+SERVERS = 10
+PLAYERS = 1000  # Per server
+KEYS = 100
+HANDLERS = (1, 10, 100)
+LINE = ('{"action": "bench", "type": "online", "player": "Notch", "user": "Notch", '
+        '"message": "Hello, world! This is a fairly typical chat message."}')
+
+
+class Environment(object):
+    """
+    A CoreFactory and its plugins, running from a temporary directory with generated configuration. The reactor is
+        never started; nothing here needs it.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="inter-micro-")
+        self.cwd = os.getcwd()
+        shutil.copytree(os.path.join(ROOT, "plugins"), os.path.join(self.path, "plugins"),
+                        ignore=shutil.ignore_patterns("*.pyc"))
+        os.makedirs(os.path.join(self.path, "config"))
+        os.makedirs(os.path.join(self.path, "data"))
+        self.keys = [("micro-%s" % i, "micro%s" % i) for i in xrange(KEYS)]
+        self._write("mapping.yml", {"networking": "networking.yml", "auth": "auth.yml", "chat": "chat.yml",
+                                    "players": "players.yml"})
+        self._write("networking.yml", {"port": 0, "config_watcher": {"enabled": False}})
+        self._write("auth.yml", {"keys": dict(self.keys)})
+        self._write("chat.yml", {"history_size": HISTORY_SIZE, "archive": {"enabled": False}})
+        self._write("players.yml", {"persistence": {"enabled": False}})
+
+        os.chdir(self.path)
+        sys.path.insert(0, ROOT)
+
+        from twisted.internet.address import IPv4Address
+        from twisted.test.proto_helpers import StringTransport
+        from system.core import CoreFactory
+        from system.events import manager
+
+        self.address = IPv4Address("TCP", "127.0.0.1", 12345)
+        self.StringTransport = StringTransport
+        self.factory = CoreFactory()
+        self.events = manager.manager()
+        self.plugins = dict((info.name, info.plugin_object) for info in self.factory.plugman.getAllPlugins())
+
+    def _write(self, filename, data):
+        with open(os.path.join(self.path, "config", filename), "w") as fh:
+            yaml.safe_dump(data, fh, default_flow_style=False)
+
+    def connect(self, key=None):
+        """
+        Make a connection over a StringTransport, authenticating it with an API key if one's given.
+        """
+        protocol = self.factory.buildProtocol(self.address)
+        protocol.makeConnection(self.StringTransport())
+        if key is not None:
+            protocol.lineReceived('{"api_key": "%s"}' % key)
+        protocol.transport.clear()
+        return protocol
+
+    def close(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def measure(function, min_time, repeat):
+    """
+    Time a benchmark. `function(n)` must do n operations and return the seconds they took, so that it can leave its
+        own setup untimed.
+    :return: A dict of the fastest and median time per operation, in microseconds, and the number of operations.
+    """
+    n = 1
+    while True:
+        elapsed = function(n)
+        if elapsed >= min_time / 10 or n >= 10 ** 7:
+            break
+        n *= 10
+    n = max(1, int(n * min_time / max(elapsed, 1e-9)))
+
+    times = sorted(function(n) / n * 1e6 for _ in xrange(repeat))
+    return {"us": times[0], "median_us": times[len(times) // 2], "iterations": n}
+
+
+def benchmarks(env):
+    """
+    Get a list of (name, function) benchmarks, as described at the top of this file.
+    """
+    from system.events.event import Event, dataReceivedEvent
+
+    results = []
+    client = env.connect(env.keys[0][0])
+    others = [env.connect(key) for key, _ in env.keys[1:SERVERS]]
+
+    def line_received(n):
+        transport = client.transport
+        start = timer()
+        for _ in xrange(n):
+            client.lineReceived(LINE)
+        elapsed = timer() - start
+        transport.clear()
+        return elapsed
+
+    results.append(("core.lineReceived", line_received))
+
+    class Owner(object):
+        def __init__(self, name):
+            self.info = Info(name)
+
+    class Info(object):
+        def __init__(self, name):
+            self.name = name
+
+    def handler(event):
+        pass
+
+    def run_callback(count):
+        callback = "microbenchmark%s" % count
+        for i in xrange(count):
+            env.events.addCallback(callback, Owner("handler%s" % i), handler, i)
+        event = Event(client)
+        run = env.events.runCallback
+
+        def bench(n):
+            start = timer()
+            for _ in xrange(n):
+                run(callback, event)
+            return timer() - start
+        return bench
+
+    for count in HANDLERS:
+        results.append(("events.runCallback/%s" % count, run_callback(count)))
+
+    auth = env.plugins["Authentication"]
+    key, _ = env.keys[-1]
+    newcomer = env.connect()
+
+    def auth_valid(n):
+        elapsed = 0.0
+        message = {"api_key": key}
+        for _ in xrange(n):
+            event = dataReceivedEvent(newcomer, dict(message))
+            start = timer()
+            auth.onDataReceived(event)
+            elapsed += timer() - start
+            env.factory.clients.remove(newcomer)  # Forget it again, ready for the next go
+            newcomer.authenticated = False
+            env.factory.clients.add(newcomer)
+        newcomer.transport.clear()
+        for other in others:
+            other.transport.clear()
+        return elapsed
+
+    stranger = env.connect()
+
+    def auth_invalid(n):
+        events = [dataReceivedEvent(stranger, {"api_key": "not a key"}) for _ in xrange(n)]
+        start = timer()
+        for event in events:
+            auth.onDataReceived(event)
+        elapsed = timer() - start
+        stranger.transport.clear()
+        return elapsed
+
+    results.append(("auth.valid", auth_valid))
+    results.append(("auth.invalid", auth_invalid))
+
+    chat = env.plugins["Chat"]
+    message = {"user": "Notch", "message": "Hello, world!", "time": time.time(), "source": "micro0"}
+    for _ in xrange(HISTORY_SIZE):
+        chat.saveMessage(dict(message))
+
+    def save_message(n):
+        messages = [dict(message) for _ in xrange(n)]
+        start = timer()
+        for entry in messages:
+            chat.saveMessage(entry)
+        return timer() - start
+
+    results.append(("chat.saveMessage", save_message))
+
+    players = env.plugins["Players"]
+    for i, (key, name) in enumerate(env.keys[:SERVERS]):
+        for j in xrange(PLAYERS):
+            players.presence.online(name, "player%s_%s" % (i, j))
+    request = dataReceivedEvent(client, {"action": "players", "type": "list"})
+
+    def list_players(cached):
+        def bench(n):
+            elapsed = 0.0
+            for _ in xrange(n):
+                if not cached:
+                    # Make a change, so the list has to be built and encoded again
+                    players.presence.offline(env.keys[1][1], "player1_0")
+                    players.presence.online(env.keys[1][1], "player1_0")
+                start = timer()
+                players.onList(request)
+                elapsed += timer() - start
+                client.transport.clear()
+            return elapsed
+        return bench
+
+    results.append(("players.list/%sx%s" % (SERVERS, PLAYERS), list_players(False)))
+    results.append(("players.list/%sx%s/cached" % (SERVERS, PLAYERS), list_players(True)))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print a comparison of the results against a baseline.
+    :return: The names of the benchmarks that are more than `threshold` percent slower.
+    """
+    regressions = []
+    print "%-34s %12s %12s %9s" % ("Benchmark", "Baseline us", "Current us", "Change")
+    for name in sorted(set(results) | set(baseline)):
+        if name not in results or name not in baseline:
+            print "%-34s %12s %12s %9s" % (name, _format(baseline.get(name)), _format(results.get(name)), "-")
+            continue
+        before, after = baseline[name]["us"], results[name]["us"]
+        change = (after - before) / before * 100 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  improved"
+        print "%-34s %12.3f %12.3f %+8.1f%%%s" % (name, before, after, change, flag)
+    return regressions
+
+
+def _format(result):
+    return "%.3f" % result["us"] if result else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run microbenchmarks of the server's hot paths.")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="Seconds each repeat of each benchmark should take, at least (default 0.2)")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats of each benchmark (default 5)")
+    parser.add_argument("--only", action="append", default=[], metavar="NAME",
+                        help="Only run benchmarks whose names contain this; may be repeated")
+    parser.add_argument("--save", metavar="FILE", help="Write the results to this file, eg as a new baseline")
+    parser.add_argument("--compare", metavar="FILE", help="Compare the results with this baseline")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="Percentage slowdown that counts as a regression (default 10)")
+    parser.add_argument("--input", metavar="FILE",
+                        help="Compare the results saved in this file, instead of running the benchmarks")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as fh:
+            results = json.load(fh)["results"]
+    else:
+        logging.basicConfig(level=logging.CRITICAL)  # Log output would swamp the timings
+        env = Environment()
+        results = {}
+        try:
+            for name, function in benchmarks(env):
+                if args.only and not any(part in name for part in args.only):
+                    continue
+                results[name] = measure(function, args.min_time, args.repeat)
+                sys.stderr.write("%-34s %10.3f us\n" % (name, results[name]["us"]))
+        finally:
+            env.close()
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump({"time": time.time(), "python": sys.version.split()[0], "platform": platform.platform(),
+                       "results": results}, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        sys.stderr.write("Wrote the results to %s\n" % args.save)
+
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            baseline = json.load(fh)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print "%s benchmark(s) regressed by more than %s%%: %s" % (len(regressions), args.threshold,
+                                                                     ", ".join(regressions))
+            sys.exit(1)
+    elif not args.save:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
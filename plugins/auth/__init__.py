@@ -1,13 +1,21 @@
 # coding=utf-8
 __author__ = "Gareth Coles"
 
-import json
 import logging
+from functools import partial
 from system.plugin import Plugin
+from system import codec
 from system import config as conf
 from system.events import manager
 from authorizedEvent import authorizedEvent
 
+ALREADY_AUTHENTICATED = codec.constant({"error": "You have already authenticated.",
+                                        "from": "auth", "status": "error", "code": 1})
+ALREADY_CONNECTED = codec.constant({"error": "There is already a server with this API key connected",
+                                    "from": "auth", "status": "error", "code": 2})
+INVALID_KEY = codec.constant({"error": "Your API key is invalid.", "from": "auth", "status": "error", "code": 3})
+NO_KEY = codec.constant({"error": "You did not provide an API key.", "from": "auth", "status": "error", "code": 4})
+
 
 class AuthPlugin (Plugin):
 
@@ -29,18 +37,18 @@ class AuthPlugin (Plugin):
 
     When adding support for error codes to your application, remember that they're plugin-specific. Use the
         `from` key to determine where they're coming from and handle them accordingly.
+
+    API keys are kept in memory as a {key: name} dict, which is rebuilt whenever the configuration watcher sees that
+        auth.yml has changed (see system/watcher.py).
     """
 
+    keys = {}
+
     def __init__(self):
         super(AuthPlugin, self).__init__()
 
-    def sendToOthers(self, data):
-        clients = self.factory.clients
-        for client in clients:
-            if not client == self:
-                if hasattr(client, "authenticated"):
-                    if client.authenticated:
-                        client.send(data)
+    def sendToOthers(self, data, exclude=None, kind=None, key=None):
+        self.factory.broadcast(data, exclude=exclude, authenticated=True, kind=kind, key=key)
 
     def setup(self):
         self.config = conf.conf()
@@ -49,56 +57,64 @@ class AuthPlugin (Plugin):
             self.config.save_mapping("auth", "auth.yml")
             self.config.save_file("auth.yml", {"keys": {}})
             self.config.reload()
+        self.loadKeys()
         self.events = manager.manager()
+        self.events.addCallback("configChanged", self, self.onConfigChanged, 0)
         self.events.addCallback("dataReceived", self, self.onDataReceived, 99999)
         self.events.addCallback("protocolBuilt", self, self.onProtocolBuiltEvent, 99999)
         self.events.addCallback("clientDisconnected", self, self.onClientDisconnected, 0)
 
+    def loadKeys(self):
+        """
+        Build the {key: name} API key index from the current configuration.
+        """
+        conf = self.config.get("auth")
+        if not conf:
+            self.logger.warn("Unable to load API keys, keeping the %s we already have." % len(self.keys))
+            return
+        self.keys = dict(conf.get("keys") or {})
+        self.logger.info("Loaded %s API keys." % len(self.keys))
+
+    def onConfigChanged(self, event):
+        if "auth" in event.names:
+            self.loadKeys()
+
     def onDataReceived(self, event):
         if not event.caller.authenticated:
             data = event.data
-            self.config.reload_mapping("auth")
 
             if event.caller.authenticated:
-                event.caller.send(json.dumps({"error": "You have already authenticated.",
-                                              "from": "auth", "status": "error", "code": 1}))
+                event.caller.send(ALREADY_AUTHENTICATED)
                 return
 
             if "api_key" in data:
-                for x, y in event.caller.factory.servers.items():
-                    if data["api_key"] == y.api_key:
+                api_key = data["api_key"]
+                name = None
+                if isinstance(api_key, basestring):
+                    if event.caller.factory.clients.get_by_key(api_key) is not None:
                         event.cancel()
-                        event.caller.send(json.dumps({"error": "There is already a server with this API key connected",
-                                                      "from": "auth", "status": "error", "code": 2}))
+                        event.caller.send(ALREADY_CONNECTED)
                         event.caller.transport.loseConnection()
                         return
-                conf = self.config.get("auth")
-                for x, y in conf["keys"].items():
-                    if data["api_key"] == x:
-                        self.logger.info("Client authenticated: %s" % y)
-                        event.caller.authenticated = True
-                        event.caller.api_key = x
-                        event.caller.name = y
-                        # event.caller.send(json.dumps({"name": y, "from": "auth",
-                        #                               "status": "success"}))
-                        if "not_server" in data:
-                            if data["not_server"]:
-                                event.caller.not_server = True
-                                return
-                        event.caller.sendToOthers(json.dumps({"from": "auth", "action": "authenticated",
-                                                              "name": y, "status": "success"}))
-                        event.caller.factory.servers[y] = event.caller
-                        authevent = authorizedEvent(self, event.caller)
-                        self.events.runCallback("onAuthorized", authevent)
+                    name = self.keys.get(api_key)
+                if name is not None:
+                    self.logger.info("Client authenticated: %s" % name)
+                    not_server = "not_server" in data and data["not_server"]
+                    event.caller.factory.clients.authenticate(event.caller, name, api_key, not_server)
+                    # event.caller.send({"name": name, "from": "auth", "status": "success"})
+                    if not_server:
                         return
+                    event.caller.sendToOthers({"from": "auth", "action": "authenticated",
+                                               "name": name, "status": "success"})
+                    authevent = authorizedEvent(self, event.caller)
+                    self.events.runCallback("onAuthorized", authevent)
+                    return
                 event.cancel()
-                event.caller.send(json.dumps({"error": "Your API key is invalid.", "from": "auth",
-                                              "status": "error", "code": 3}))
+                event.caller.send(INVALID_KEY)
                 event.caller.transport.loseConnection()
             else:
                 event.cancel()
-                event.caller.send(json.dumps({"error": "You did not provide an API key.", "from": "auth",
-                                              "status": "error", "code": 4}))
+                event.caller.send(NO_KEY)
                 event.caller.transport.loseConnection()
 
     def onProtocolBuiltEvent(self, event):
@@ -110,12 +126,9 @@ class AuthPlugin (Plugin):
         self.logger.debug("Added `name` and `api_key` variables to protocol object.")
 
         event.protocol._sendToOthers = event.protocol.sendToOthers
-        event.protocol.sendToOthers = self.sendToOthers
+        event.protocol.sendToOthers = partial(self.sendToOthers, exclude=event.protocol)
         self.logger.debug("Overridden sendToOthers function in protocol object.")
 
     def onClientDisconnected(self, event):
-        if event.caller.name:
-            del event.caller.factory.servers[event.caller.name]
-            self.logger.debug("Removed server '%s' from factory servers dict." % event.caller.name)
         if event.caller.authenticated and not event.caller.not_server:
-            event.caller.sendToOthers(json.dumps({"from": "auth", "action": "disconnected", "name": event.caller.name}))
\ No newline at end of file
+            event.caller.sendToOthers({"from": "auth", "action": "disconnected", "name": event.caller.name})
\ No newline at end of file
@@ -1,15 +1,22 @@
 # coding=utf-8
-from operator import itemgetter
-
 __author__ = "Gareth Coles"
 
 import time
-import json
 import logging
 
+from twisted.internet import defer, reactor, task
 from system.plugin import Plugin
 from system import config as conf
 from system.events import manager
+from archive import ChatArchive
+from history import ChatHistory
+
+INVALID_HISTORY_REQUEST = {"from": "chat", "type": "history", "status": "error", "code": 2}
+INVALID_ARCHIVE_REQUEST = {"from": "chat", "type": "archive", "status": "error", "code": 3}
+NO_ARCHIVE = {"from": "chat", "type": "archive", "status": "error", "code": 4, "error": "The archive is disabled."}
+
+ARCHIVE_WORKER = "1"  # The worker that keeps the archive, in multi-process mode
+QUERY_TIMEOUT = 30  # Seconds to wait for it to answer a search
 
 
 class ChatPlugin (Plugin):
@@ -19,60 +26,274 @@ class ChatPlugin (Plugin):
         This plugin will log and relay chat messages between server.
         It will also keep a chat buffer for web clients to pull down periodically.
 
+    The buffer holds the last `history_size` messages (100 by default; set it in chat.yml, after adding
+        "chat: chat.yml" to mapping.yml). Fetch it with {"action": "chat-history"}, plus any of:
+        since  | Only messages sent after this UNIX timestamp.
+        after  | Only messages with a sequence number higher than this.
+        limit  | At most this many messages.
+        source | Only messages from this server, or list of servers.
+
+    The reply looks like {"from": "chat", "type": "history", "messages": [...], "latest": 123}. Each message has a
+        `seq`, its sequence number; `latest` is the sequence number of the newest message in the buffer, matched or
+        not. To poll for new messages, pass the last `latest` you got as `after`. Sequence numbers start again when
+        the server restarts, so clients that reconnect should use `since` instead. See history.py for the details.
+
+    Every message is also written to a durable archive on disk (see archive.py), which can be searched with
+        {"action": "chat-archive"}, plus any of:
+        start  | Only messages sent at or after this UNIX timestamp.
+        end    | Only messages sent at or before this UNIX timestamp.
+        source | Only messages from this server, or list of servers.
+        user   | Only messages from this user, or list of users.
+        after  | Only messages with an ID higher than this.
+        limit  | At most this many messages; 100 by default, and never more than the `query_limit` setting.
+
+    The reply looks like {"from": "chat", "type": "archive", "messages": [...], "more": false}, with the oldest
+        messages first. Each message has an `id`. If `more` is true, there were more matches than the limit; to get
+        the next page, send the same request again with the last ID you got as `after`.
+
+    The archive is configured with an `archive` section in chat.yml:
+        enabled:        Defaults to true.
+        path:           Where to keep the archive. Defaults to data/chat. In multi-process mode, only worker 1 keeps
+                            it (every worker sees every message, so it has them all), and the other workers pass
+                            searches on to it over the bus. So every message is written once, and its ID is the same
+                            whichever worker answers. While worker 1 is restarting, searches fail and new messages
+                            aren't archived.
+        segment_size:   Start a new segment once the newest is this many bytes. Defaults to 16777216 (16 MB).
+        max_size:       Delete the oldest segments once the archive is bigger than this many bytes. Defaults to
+                            1073741824 (1 GB).
+        max_age:        Delete segments whose messages are all older than this many days. Defaults to 30.
+        flush_interval: How often to write new messages out, in seconds. Defaults to 1.
+        query_limit:    The most messages a single search may return. Defaults to 1000.
+
     Error codes:
-        1 | The target specified was not found. | Alert the user and continue. | WARN
+        1 | The target specified was not found.        | Alert the user and continue.               | WARN
+        2 | The chat-history request was invalid.      | Alert the user and continue. Fix your bug. | WARN
+        3 | The chat-archive request was invalid.      | Alert the user and continue. Fix your bug. | WARN
+        4 | The archive is disabled.                   | Alert the user and continue.               | WARN
     """
 
-    history = []
-
     def __init__(self):
         super(ChatPlugin, self).__init__()
 
     def setup(self):
         self.config = conf.conf()
         self.logger = logging.getLogger("Chat")
+        settings = self.config.get("chat") or {}
+        self.history = ChatHistory(max(1, int(settings.get("history_size", 100))))
+        self.setupArchive(settings.get("archive") or {})
         self.events = manager.manager()
-        self.events.addCallback("dataReceived", self, self.onDataReceived, 100)
+        self.events.addRoute("chat", self, self.onChat, 100)
+        self.events.addRoute("chat-history", self, self.onChatHistory, 100)
+        self.events.addRoute("chat-archive", self, self.onChatArchive, 100)
+
+        for relay in self.factory.relays:
+            relay.subscribe("chat", self.onRelayChat)
+
+    def setupArchive(self, settings):
+        self.archiving = settings.get("enabled", True)
+        self.archive = None
+        self.loops = []
+        self.trigger = None
+        self.queries = {}  # {ID: (Deferred, timeout)}, for searches passed on to the archive worker
+        self.query_id = 0
+        if not self.archiving:
+            return
+        self.query_limit = settings.get("query_limit", 1000)
+
+        bus = self.factory.bus
+        if bus is not None:
+            if bus.worker != ARCHIVE_WORKER:
+                bus.subscribe("chat-archive-result", self.onBusArchiveResult)
+                return
+            bus.subscribe("chat-archive", self.onBusArchive)
+
+        self.archive = ChatArchive(settings.get("path", "data/chat"), settings.get("segment_size", 16 * 1024 * 1024),
+                                   settings.get("max_size", 1024 * 1024 * 1024), settings.get("max_age", 30))
+
+        flusher = task.LoopingCall(self.archive.flush)
+        flusher.start(settings.get("flush_interval", 1), now=False)
+        expirer = task.LoopingCall(self.archive.expire)
+        expirer.start(3600)
+        self.loops = [flusher, expirer]
+        self.trigger = reactor.addSystemEventTrigger("before", "shutdown", self.archive.flush)
+
+    def deactivate(self):
+        for loop in self.loops:
+            if loop.running:
+                loop.stop()
+        if self.trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self.trigger)
+            except ValueError:
+                pass  # It's already run; we're being disabled at shutdown
+            self.trigger = None
+        for d, timeout in self.queries.values():
+            timeout.cancel()
+        self.queries = {}
+        super(ChatPlugin, self).deactivate()
 
     def saveMessage(self, message):
         """
-        Saves a message to the buffer, dropping messages if we have over 100 saved.
+        Saves a message to the buffer, dropping the oldest message if it's full, and queues it to be archived.
         :param message:
         """
-        self.history.append(message)
-        self.history = sorted(self.history, key=itemgetter("time"))
-        while len(self.history) > 100:
-            self.history.pop(0)
+        self.history.add(message)
+        if self.archive is not None:
+            self.archive.add(message)
 
-    def onDataReceived(self, event):
+    def onChat(self, event):
         data = event.data
         curtime = time.time()
 
-        if "action" in data:
-            if data["action"] == "chat":
-                del data["action"]
+        del data["action"]
+
+        data["time"] = curtime
+        data["source"] = event.caller.name
+
+        message = data["message"]
+        user = data["user"]
+        target = None
+
+        self.saveMessage(data)
+
+        data["from"] = "chat"
+        for relay in self.factory.relays:
+            relay.publish("chat", data)
+
+        self.logger.info("<%s@%s> %s" % (data["user"], event.caller.name, data["message"]))
+
+        if target:
+            if target in self.factory.servers:
+                self.factory.servers[target].send(data, kind="chat")
+            else:
+                event.caller.send({"from": "chat", "error": "Unable to locate server: " + target, "code": 1})
+        else:
+            event.caller.sendToOthers(data, kind="chat")
+
+    def onChatHistory(self, event):
+        if not event.caller.authenticated:
+            return
+        data = event.data
+        try:
+            since = data.get("since")
+            if since is not None:
+                since = float(since)
+            after = data.get("after")
+            if after is not None:
+                after = int(after)
+            limit = data.get("limit")
+            if limit is not None:
+                limit = int(limit)
+            sources = _names(data.get("source"))
+        except (TypeError, ValueError) as e:
+            event.caller.send(dict(INVALID_HISTORY_REQUEST, error="Invalid chat-history request: %s" % e))
+            return
+
+        messages = []
+        for seq, message in self.history.query(since, after, limit, sources):
+            message = dict(message)
+            message["seq"] = seq
+            messages.append(message)
+        event.caller.send({"from": "chat", "type": "history", "messages": messages, "latest": self.history.latest})
+
+    def onChatArchive(self, event):
+        if not event.caller.authenticated:
+            return
+        if not self.archiving:
+            event.caller.send(NO_ARCHIVE)
+            return
+        data = event.data
+        try:
+            start = data.get("start")
+            if start is not None:
+                start = float(start)
+            end = data.get("end")
+            if end is not None:
+                end = float(end)
+            after = data.get("after")
+            if after is not None:
+                after = int(after)
+            limit = min(int(data.get("limit", 100)), self.query_limit)
+            if limit < 1:
+                raise ValueError("limit must be at least 1")
+            sources = _names(data.get("source"))
+            users = _names(data.get("user"))
+        except (TypeError, ValueError) as e:
+            event.caller.send(dict(INVALID_ARCHIVE_REQUEST, error="Invalid chat-archive request: %s" % e))
+            return
+
+        caller = event.caller
+        if self.archive is not None:
+            d = self.archive.query(start, end, sources, users, after, limit)
+        else:
+            d = self.queryArchiveWorker(start, end, sources, users, after, limit)
+
+        def found(result):
+            messages, more = result
+            caller.send({"from": "chat", "type": "archive", "messages": messages, "more": more})
+
+        def failed(failure):
+            self.logger.error("Unable to search the chat archive: %s" % failure.getErrorMessage())
+            caller.send(dict(INVALID_ARCHIVE_REQUEST, error="Unable to search the archive."))
+
+        return d.addCallbacks(found, failed)
+
+    def queryArchiveWorker(self, start, end, sources, users, after, limit):
+        """
+        Pass a search on to the worker that keeps the archive, over the bus.
+        :return: A Deferred that fires with (messages, more), like ChatArchive.query().
+        """
+        self.query_id += 1
+        d = defer.Deferred()
+        timeout = reactor.callLater(QUERY_TIMEOUT, self._queryTimedOut, self.query_id)
+        self.queries[self.query_id] = (d, timeout)
+        self.factory.bus.publish("chat-archive", {
+            "id": self.query_id, "start": start, "end": end, "after": after, "limit": limit,
+            "sources": sorted(sources) if sources is not None else None,
+            "users": sorted(users) if users is not None else None
+        }, to=ARCHIVE_WORKER)
+        return d
+
+    def _queryTimedOut(self, query_id):
+        d, _ = self.queries.pop(query_id)
+        d.errback(defer.TimeoutError("Worker %s didn't answer within %s seconds" % (ARCHIVE_WORKER, QUERY_TIMEOUT)))
+
+    def onBusArchive(self, worker, message):
+        # A search passed on by another worker
+        bus = self.factory.bus
+        d = self.archive.query(message["start"], message["end"], _names(message["sources"]),
+                               _names(message["users"]), message["after"], message["limit"])
 
-                data["time"] = curtime
-                data["source"] = event.caller.name
+        def found(result):
+            messages, more = result
+            bus.publish("chat-archive-result", {"id": message["id"], "messages": messages, "more": more}, to=worker)
 
-                message = data["message"]
-                user = data["user"]
-                target = None
+        def failed(failure):
+            self.logger.error("Unable to search the chat archive: %s" % failure.getErrorMessage())
+            bus.publish("chat-archive-result", {"id": message["id"], "error": failure.getErrorMessage()}, to=worker)
 
-                self.saveMessage(data)
+        d.addCallbacks(found, failed)
 
-                data["from"] = "chat"
+    def onBusArchiveResult(self, worker, message):
+        query = self.queries.pop(message["id"], None)
+        if query is None:
+            return  # It's already timed out
+        d, timeout = query
+        timeout.cancel()
+        if "error" in message:
+            d.errback(RuntimeError(message["error"]))
+        else:
+            d.callback((message["messages"], message["more"]))
 
-                self.logger.info("<%s@%s> %s" % (data["user"], event.caller.name, data["message"]))
+    def onRelayChat(self, owner, message):
+        # Messages relayed from other workers and nodes, so that every process has the full history
+        self.saveMessage(message)
 
-                if target:
-                    if target in self.factory.servers:
-                        self.factory.servers[target].send(json.dumps(data))
-                    else:
-                        event.caller.send(json.dumps({"from": "chat", "error": "Unable to locate server: " + target,
-                                                      "code": 1}))
-                else:
-                    event.caller.sendToOthers(json.dumps(data))
 
-            elif data["action"] == "chat-history":
-                pass
+def _names(value):
+    # A name, or a list of names, from a request
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return frozenset([value])
+    return frozenset(value)
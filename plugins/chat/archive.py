@@ -0,0 +1,328 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+from system import codec
+from system.fileio import io
+
+# One index record per message: the time it's filed under, where its line starts in the segment's log, and CRC32s of
+#   its source and user, so that queries can skip most non-matching messages without decoding them.
+RECORD = struct.Struct("<dQII")
+
+
+def _hash(value):
+    if value is None:
+        return 0
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return zlib.crc32(str(value)) & 0xffffffff
+
+
+class Segment(object):
+    """
+    One segment of the archive: a log of JSON lines (<first ID>.log) and its index (<first ID>.idx).
+    Only the newest segment is ever written to.
+    """
+
+    def __init__(self, path, first):
+        self.first = first
+        self.log = os.path.join(path, "%016d.log" % first)
+        self.index = os.path.join(path, "%016d.idx" % first)
+        self.count = 0
+        self.size = 0
+        self.first_time = None
+        self.last_time = None
+
+    @property
+    def last(self):
+        return self.first + self.count - 1
+
+    def load(self):
+        """
+        Read the segment's details from its index, and cut off anything left half-written by a crash.
+        """
+        if not os.path.exists(self.log):
+            open(self.log, "ab").close()
+        if not os.path.exists(self.index):
+            open(self.index, "ab").close()
+
+        length = os.path.getsize(self.index)
+        self.count = length // RECORD.size
+        if length % RECORD.size:
+            with open(self.index, "r+b") as fh:
+                fh.truncate(self.count * RECORD.size)
+
+        self.size = 0
+        if self.count:
+            with open(self.index, "rb") as fh:
+                self.first_time = RECORD.unpack(fh.read(RECORD.size))[0]
+                fh.seek((self.count - 1) * RECORD.size)
+                self.last_time, offset, _, _ = RECORD.unpack(fh.read(RECORD.size))
+            with open(self.log, "rb") as fh:
+                fh.seek(offset)
+                self.size = offset + len(fh.readline())
+        if os.path.getsize(self.log) != self.size:
+            with open(self.log, "r+b") as fh:
+                fh.truncate(self.size)
+
+    def append(self, entries):
+        """
+        Append a list of (filed time, source hash, user hash, line) entries. The log is synced before the index, so
+            the index never points at data that isn't there. If either write fails, both files are cut back to where
+            they were before re-raising, so the next append doesn't land after the half-written lines.
+        """
+        lines = []
+        records = []
+        offset = self.size
+        for filed, source, user, line in entries:
+            lines.append(line)
+            records.append(RECORD.pack(filed, offset, source, user))
+            offset += len(line)
+
+        try:
+            with open(self.log, "ab") as fh:
+                fh.write("".join(lines))
+                fh.flush()
+                os.fsync(fh.fileno())
+            with open(self.index, "ab") as fh:
+                fh.write("".join(records))
+                fh.flush()
+                os.fsync(fh.fileno())
+        except Exception:
+            error = sys.exc_info()
+            try:
+                self._truncate()
+            except (IOError, OSError):
+                pass  # load() cuts off whatever's left when the archive's next opened
+            raise error[0], error[1], error[2]
+
+        if self.first_time is None:
+            self.first_time = entries[0][0]
+        self.last_time = entries[-1][0]
+        self.count += len(entries)
+        self.size = offset
+
+    def _truncate(self):
+        # Cut both files back to what's been appended successfully
+        for path, size in ((self.log, self.size), (self.index, self.count * RECORD.size)):
+            with open(path, "r+b") as fh:
+                fh.truncate(size)
+
+    def remove(self):
+        for path in (self.log, self.index):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def query(self, start, end, after, sources, users, limit, results):
+        """
+        Add matching messages to results, until there are `limit` of them. Both files are memory-mapped, and only the
+            lines of messages whose index records match are decoded.
+        """
+        if not self.count:
+            return
+        with open(self.index, "rb") as index_fh, open(self.log, "rb") as log_fh:
+            index = mmap.mmap(index_fh.fileno(), self.count * RECORD.size, access=mmap.ACCESS_READ)
+            log = mmap.mmap(log_fh.fileno(), self.size, access=mmap.ACCESS_READ)
+            try:
+                lo = 0
+                if start is not None:
+                    lo = self._search(index, start, False)
+                if after is not None:
+                    lo = max(lo, after + 1 - self.first)
+                hi = self.count
+                if end is not None:
+                    hi = self._search(index, end, True)
+
+                source_hashes = user_hashes = None
+                if sources is not None:
+                    source_hashes = set(_hash(source) for source in sources)
+                if users is not None:
+                    user_hashes = set(_hash(user) for user in users)
+
+                for i in xrange(lo, hi):
+                    filed, offset, source, user = RECORD.unpack_from(index, i * RECORD.size)
+                    if source_hashes is not None and source not in source_hashes:
+                        continue
+                    if user_hashes is not None and user not in user_hashes:
+                        continue
+
+                    message = codec.decode(log[offset:log.find("\n", offset) + 1])
+                    if sources is not None and message.get("source") not in sources:
+                        continue  # A hash collision
+                    if users is not None and message.get("user") not in users:
+                        continue
+                    message["id"] = self.first + i
+                    results.append(message)
+                    if len(results) >= limit:
+                        return
+            finally:
+                index.close()
+                log.close()
+
+    def _search(self, index, when, inclusive):
+        # Binary search for the first record filed after `when` (or at it, unless inclusive is set)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            filed = RECORD.unpack_from(index, mid * RECORD.size)[0]
+            if filed < when or (inclusive and filed == when):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class ChatArchive(object):
+    """
+    A durable archive of every chat message, split into segments on disk.
+
+    Messages get an ID as they're written, counting up from 1 across the whole archive (and across restarts). Like the
+        in-memory history, each is filed under its time, or the time of the last message archived before it if that's
+        later, so the index is always in time order and can be binary searched.
+
+    The reactor only ever queues messages up. Everything else happens on the file I/O thread (see system/fileio.py),
+        one job at a time: queued messages are written out in batches every `flush_interval` seconds and at shutdown,
+        queries are answered with memory-mapped reads, and old segments are deleted. A new segment is started once
+        the newest reaches `segment_size` bytes, and the oldest segments are deleted once the archive is bigger than
+        `max_size` bytes, or once their newest message is older than `max_age` days.
+
+    Public methods:
+        add(message)    Queue a message to be archived.
+        flush()         Write the queued messages out now. Returns a Deferred.
+        query(start=None, end=None, sources=None, users=None, after=None, limit=100)
+                        Returns a Deferred that fires with (messages, more). See below.
+        expire()        Delete segments that are past the size or age limits. Returns a Deferred.
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024, max_age=30):
+        self.logger = logging.getLogger("Chat")
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.pending = []
+        self.last_time = 0.0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".idx"):
+                segment = Segment(path, int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+        if self.segments:
+            self.last_time = self.segments[-1].last_time or 0.0
+        self.logger.info("Opened the chat archive in %s, with %s messages in %s segments." %
+                         (path, sum(segment.count for segment in self.segments), len(self.segments)))
+
+    def add(self, message):
+        """
+        Queue a message to be archived.
+        :param message: The message; a dict with a `time`, a `source` and a `user`.
+        """
+        filed = message.get("time") or 0.0
+        if filed < self.last_time:
+            filed = self.last_time
+        self.last_time = filed
+        self.pending.append((filed, _hash(message.get("source")), _hash(message.get("user")),
+                             codec.encode(message) + "\n"))
+
+    def flush(self):
+        """
+        Write the queued messages out, on the file I/O thread.
+        :return: A Deferred that fires once they've been written.
+        """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return io().run(_nothing)  # Still ordered after any writes that are in progress
+        d = io().run(self._write, batch)
+
+        def failed(failure):
+            self.logger.error("Unable to archive %s chat messages: %s" % (len(batch), failure.getErrorMessage()))
+
+        return d.addErrback(failed)
+
+    def _write(self, batch):
+        while batch:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.size >= self.segment_size:
+                first = segment.last + 1 if segment is not None else 1
+                segment = Segment(self.path, first)
+                segment.load()
+                self.segments.append(segment)
+                self._expire()
+
+            # Don't let a single batch run a segment far past its size limit
+            room = self.segment_size - segment.size
+            taken = 0
+            for i, entry in enumerate(batch):
+                taken += len(entry[3])
+                if taken >= room:
+                    break
+            segment.append(batch[:i + 1])
+            batch = batch[i + 1:]
+
+    def expire(self):
+        """
+        Delete the oldest segments, if the archive is past its size or age limits.
+        :return: A Deferred that fires once that's been done.
+        """
+        return io().run(self._expire)
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age * 86400 if self.max_age else None
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.max_size and total > self.max_size
+            too_old = cutoff is not None and oldest.last_time is not None and oldest.last_time < cutoff
+            if not (too_big or too_old):
+                break
+            oldest.remove()
+            self.segments.pop(0)
+            total -= oldest.size
+            self.logger.info("Deleted archived chat messages %s to %s." % (oldest.first, oldest.last))
+
+    def query(self, start=None, end=None, sources=None, users=None, after=None, limit=100):
+        """
+        Search the archive, oldest messages first. Queued messages are written out first, so they're included.
+
+        :param start:   Only return messages filed at or after this UNIX timestamp.
+        :param end:     Only return messages filed at or before this UNIX timestamp.
+        :param sources: Only return messages from servers in this collection of names.
+        :param users:   Only return messages from users in this collection of names.
+        :param after:   Only return messages with an ID higher than this, for paging through results.
+        :param limit:   Return at most this many messages.
+        :return:        A Deferred that fires with a tuple of (list of messages, whether there are any more). Each
+                            message has an `id`.
+        """
+        self.flush()
+        return io().run(self._query, start, end, sources, users, after, limit)
+
+    def _query(self, start, end, sources, users, after, limit):
+        results = []
+        for segment in list(self.segments):
+            if not segment.count:
+                continue
+            if end is not None and segment.first_time > end:
+                break
+            if start is not None and segment.last_time < start:
+                continue
+            if after is not None and segment.last <= after:
+                continue
+            segment.query(start, end, after, sources, users, limit + 1, results)
+            if len(results) > limit:
+                return results[:limit], True
+        return results, False
+
+
+def _nothing():
+    pass
@@ -0,0 +1,128 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+
+class ChatHistory(object):
+    """
+    A fixed-size ring buffer of chat messages, oldest first. Once it's full, each new message replaces the oldest.
+
+    Every message is given a sequence number as it's added. These count up from 1 without gaps, so the messages in
+        the buffer always have consecutive numbers, and finding a message by its number is just arithmetic. Sequence
+        numbers only mean anything to this process, and start from 1 again when it's restarted.
+
+    Messages are kept in the order they arrived in, and each is filed under its `time`, or the time of the newest
+        message already in the buffer if that's later - which only happens to messages relayed late from other
+        workers and nodes. That keeps the filing times in order too, so messages since a given time are found with a
+        binary search over the buffer, and a late message is still seen by a client polling with the time of the last
+        message it got.
+
+    Nothing in here copies the buffer; queries only build the list of messages they return.
+
+    Public methods:
+        add(message)                            Add a message. Returns its sequence number.
+        query(since, after, limit, sources)     Get a list of (sequence number, message) tuples; all arguments are
+                                                    optional. See below.
+        latest                                  The sequence number of the newest message, or 0 (a property).
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.messages = [None] * size
+        self.times = [0.0] * size
+        self.start = 0  # Where the oldest message is
+        self.count = 0
+        self.next = 1  # The next message's sequence number
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def latest(self):
+        return self.next - 1
+
+    def add(self, message):
+        """
+        Add a message to the buffer, replacing the oldest message if it's full.
+        :param message: The message; a dict with a `time`.
+        :return:        The message's sequence number.
+        """
+        filed = message.get("time") or 0.0
+        if self.count:
+            newest = self.times[(self.start + self.count - 1) % self.size]
+            if filed < newest:
+                filed = newest
+
+        if self.count == self.size:
+            index = self.start
+            self.start = (self.start + 1) % self.size
+        else:
+            index = (self.start + self.count) % self.size
+            self.count += 1
+        self.messages[index] = message
+        self.times[index] = filed
+
+        seq = self.next
+        self.next += 1
+        return seq
+
+    def _since(self, since):
+        # Binary search for the position (0 being the oldest) of the first message filed after `since`
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[(self.start + mid) % self.size] <= since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, since=None, after=None, limit=None, sources=None):
+        """
+        Get messages from the buffer, oldest first.
+
+        With `since` or `after`, this returns the oldest `limit` messages after that point, so a client can page
+            through the buffer and then keep polling with the last sequence number it got. Without either, it returns
+            the newest `limit` messages.
+
+        :param since:   Only return messages filed after this UNIX timestamp.
+        :param after:   Only return messages with a sequence number higher than this.
+        :param limit:   Return at most this many messages. Defaults to all of them.
+        :param sources: Only return messages from servers in this collection of names.
+        :return:        A list of (sequence number, message) tuples.
+        """
+        first = self.next - self.count  # The oldest message's sequence number
+        lo = 0
+        if after is not None:
+            lo = max(lo, after + 1 - first)
+        if since is not None:
+            lo = max(lo, self._since(since))
+        if limit is None:
+            limit = self.count
+        if lo >= self.count or limit <= 0:
+            return []
+
+        start, size, messages = self.start, self.size, self.messages
+        forwards = since is not None or after is not None
+
+        if sources is None:
+            if forwards:
+                hi = min(self.count, lo + limit)
+            else:
+                hi = self.count
+                lo = max(lo, hi - limit)
+            return [(first + i, messages[(start + i) % size]) for i in xrange(lo, hi)]
+
+        result = []
+        if forwards:
+            positions = xrange(lo, self.count)
+        else:
+            positions = xrange(self.count - 1, lo - 1, -1)
+        for i in positions:
+            message = messages[(start + i) % size]
+            if message.get("source") in sources:
+                result.append((first + i, message))
+                if len(result) >= limit:
+                    break
+        if not forwards:
+            result.reverse()
+        return result
@@ -1,7 +1,6 @@
 # coding=utf-8
 __author__ = "Gareth Coles"
 
-import json
 from system.plugin import Plugin
 from system import config as conf
 from system.events import manager
@@ -28,4 +27,4 @@ class EchoPlugin (Plugin):
 
     def onDataReceived(self, event):
         if self.config.get("echo")["enabled"]:
-            event.caller.send(json.dumps(event.data))
\ No newline at end of file
+            event.caller.send(event.data)
\ No newline at end of file
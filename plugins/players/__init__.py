@@ -1,32 +1,51 @@
 # coding=utf-8
 __author__ = "Gareth Coles"
 
-import json
 import logging
+import time
+from functools import partial
 from system.plugin import Plugin
+from system import codec
 from system import config as conf
 from system.events import manager
+from presence import Presence
+from persistence import Persistence
+
+TYPES = ("online", "offline", "list", "locate", "locate-many", "points")
+
 
 class PlayersPlugin (Plugin):
 
     """
-    Authentication plugin.
-    This plugin needs to have the highest priority callbacks.
+    Players plugin.
+    Keeps track of which players are online on which servers, and tells the other servers when players come and go.
 
-    Checks an incoming JSON message for an API key. If the API key is invalid or missing, it sends an error and
-        closes the connection, also cancelling the event. This is only done on the first message.
+    Servers send {"action": "players", "type": ...}, with one of these types:
+        online      | {"player": name}     | A player joined this server. The other servers are told.
+        offline     | {"player": name}     | A player left this server. The other servers are told.
+        list        | {"target": server}   | Get the players on a server, or on every other server if there's no
+                    |                      |     target. Replies include the index's "version" and "epoch"; send
+                    |                      |     them back as "since" and "epoch" to get just the "changes" since
+                    |                      |     then - a list of ["online" or "offline", server, player].
+        locate      | {"player": name}     | Find out which server a player is on. Replies with {"server": name},
+                    |                      |     or {"server": null} if they aren't online anywhere.
+        locate-many | {"players": [name]}  | The same, for a list of players at once. Replies with
+                    |                      |     {"servers": {player: server or null}}.
+        points      | {"player": name,     | A player's points changed by `change` (which may be negative). These are
+                    |  "change": number}   |     only recorded in the database.
 
-    Remember, whatever your first message is, it must contain the API key. It can contain other data for the other
-        plugins as well, but the API key is required for authentication.
+    Players are kept in a single presence index (see presence.py) covering every server - including those on other
+        workers and nodes, whose players are relayed to us - so finding a player is a dict lookup, rather than a search
+        through every server. A server's players are forgotten when it goes away.
 
-    Error codes:
-        1 | You've already authenticated.              | Alert the user and continue. Fix your bug. | WARN
-        2 | Another server is using your API key.      | Alert the user and stop.                   | CRITICAL
-        3 | Your API key is invalid or not recognized. | Alert the user and stop.                   | CRITICAL
-        4 | You didn't provide an API key.             | Alert the user and stop. Fix your bug.     | CRITICAL
+    Full lists are encoded once and cached until the index next changes, so servers polling for them don't cost a
+        re-encode every time. If the change log (the last `log_size` changes, 1000 by default; set it in players.yml,
+        after adding "players: players.yml" to mapping.yml) doesn't go back far enough for a "since" request, or the
+        epoch doesn't match (after a restart, say), the full list is sent instead.
 
-    When adding support for error codes to your application, remember that they're plugin-specific. Use the
-        `from` key to determine where they're coming from and handle them accordingly.
+    Logins, logouts (including everyone on a server that disconnects), last servers and points changes are saved to a
+        database in batches, off the reactor thread (see persistence.py; it's configured by the `persistence` section
+        of players.yml). Only the worker a server is connected to saves its players' changes.
     """
 
     def __init__(self):
@@ -35,79 +54,203 @@ class PlayersPlugin (Plugin):
     def setup(self):
         self.config = conf.conf()
         self.logger = logging.getLogger("Players")
+        settings = self.config.get("players") or {}
+        self.presence = Presence(max(1, int(settings.get("log_size", 1000))))
+        self.snapshots = {}  # {target or ("all", requester): encoded list message}
+        self.snapshot_version = 0
+        self.snapshot_servers = set()
+        self.setupPersistence(settings.get("persistence") or {})
         self.events = manager.manager()
-        self.events.addCallback("dataReceived", self, self.onDataReceived, 0)
-        self.events.addCallback("protocolBuilt", self, self.onProtocolBuiltEvent, 99999)
+        self.events.addRoute("players", self, self.onOnline, 0, type="online")
+        self.events.addRoute("players", self, self.onOffline, 0, type="offline")
+        self.events.addRoute("players", self, self.onList, 0, type="list")
+        self.events.addRoute("players", self, self.onLocate, 0, type="locate")
+        self.events.addRoute("players", self, self.onLocateMany, 0, type="locate-many")
+        self.events.addRoute("players", self, self.onPoints, 0, type="points")
+        self.events.addRoute("players", self, self.onPlayers, 0)
+        self.events.addCallback("serverRemoved", self, self.onServerRemoved, 0)
 
-    def sendToOthers(self, current, message):
-        cur = current.name
-        all_servers = {}
+        for relay in self.factory.relays:
+            relay.subscribe("players", self.onRelayPlayers)
+            relay.subscribe("joined", partial(self.onRelayJoined, relay))
 
-        for x, y in current.factory.servers.items():
-            all_servers[x] = y
+    def setupPersistence(self, settings):
+        self.persistence = None
+        if not settings.get("enabled", True):
+            return
+        try:
+            self.persistence = Persistence(settings)
+        except Exception as e:
+            self.logger.error("Unable to set up player persistence: %s" % e)
 
-        names = []
-        for x, y in all_servers.items():
-            names.append(x)
+    def deactivate(self):
+        if self.persistence is not None:
+            self.persistence.close()
+        super(PlayersPlugin, self).deactivate()
 
-        self.logger.debug("Servers: %s" % names)
+    def sendToOthers(self, current, message, key=None):
+        current.factory.broadcast(message, exclude=current, servers=True, kind="players", key=key)
 
-        if cur in all_servers:
-            del all_servers[cur]
+    def publish(self, message):
+        for relay in self.factory.relays:
+            relay.publish("players", message)
 
-        for name, server in all_servers.items():
-            self.logger.debug("Sending message to server %s: %s" % (name, message))
-            server.send(message)
+    def onOnline(self, event):
+        if not event.caller.authenticated:
+            return
+        data = event.data
+        previous = self.presence.locate(data["player"])
+        if not self.presence.online(event.caller.name, data["player"]):
+            return
+        self.logger.info("Player connected to %s: %s." % (event.caller.name, data["player"]))
+        if self.persistence is not None:
+            now = time.time()
+            if previous is not None:
+                # They've been moved here before the server they were on said they'd left
+                self.persistence.logout(data["player"], previous, now)
+            self.persistence.login(data["player"], event.caller.name, now)
+        self.publish({"type": "online", "server": event.caller.name, "player": data["player"]})
+        self.sendToOthers(event.caller,
+                          {"from": "players", "type": "online", "player": data["player"],
+                           "target": event.caller.name},
+                          (event.caller.name, data["player"])
+                          )
 
-    def onDataReceived(self, event):
-        if event.caller.authenticated:
-            data = event.data
-            if not "action" in data:
-                return
-            if data["action"] == "players":
-                if data["type"] == "online":
-                    self.logger.info("Player connected to %s: %s." % (event.caller.name, data["player"]))
-                    event.caller.players.append(data["player"])
-                    self.sendToOthers(event.caller,
-                                      json.dumps({"from": "players", "type": "online", "player": data["player"],
-                                                  "target": event.caller.name})
-                                      )
-                elif data["type"] == "offline":
-                    if data["player"] in event.caller.players:
-                        self.logger.info("Player disconnected from %s: %s." % (event.caller.name, data["player"]))
-                        event.caller.players.remove(data["player"])
-                        self.sendToOthers(event.caller,
-                                          json.dumps({"from": "players", "type": "offline", "player": data["player"],
-                                                      "target": event.caller.name})
-                                          )
-                elif data["type"] == "list":
-                    if "target" in data:
-                        if data["target"] in event.caller.factory.servers:
-                            self.logger.debug("Server %s requested players from server %s." % (event.caller.name,
-                                                                                              data["target"]))
-                            json_data = json.dumps({"from": "players",
-                                                    "players": event.caller.factory.servers[data["target"]].players,
-                                                    "type": "list",
-                                                    "target": data["target"]})
-                        else:
-                            json_data = json.dumps({"from": "players", "error": "Unknown server: %s" % data["target"]})
-                    else:
-                        self.logger.debug("Server %s requested players from all servers." % event.caller.name)
-                        all_players = {}
-
-                        for name, obj in event.caller.factory.servers.items():
-                            if not name == event.caller.name:
-                                all_players[name] = obj.players
-                        json_data = json.dumps({"from": "players", "players": all_players, "target": "all",
-                                                "type": "list"})
-
-                    event.caller.send(json_data)
+    def onOffline(self, event):
+        if not event.caller.authenticated:
+            return
+        data = event.data
+        if self.presence.offline(event.caller.name, data["player"]):
+            self.logger.info("Player disconnected from %s: %s." % (event.caller.name, data["player"]))
+            if self.persistence is not None:
+                self.persistence.logout(data["player"], event.caller.name, time.time())
+            self.publish({"type": "offline", "server": event.caller.name, "player": data["player"]})
+            self.sendToOthers(event.caller,
+                              {"from": "players", "type": "offline", "player": data["player"],
+                               "target": event.caller.name},
+                              (event.caller.name, data["player"])
+                              )
+
+    def onList(self, event):
+        if not event.caller.authenticated:
+            return
+        data = event.data
+        target = data.get("target")
+        if target is not None and target not in event.caller.factory.servers:
+            event.caller.send({"from": "players", "error": "Unknown server: %s" % target})
+            return
+
+        since = data.get("since")
+        if since is not None and data.get("epoch") == self.presence.epoch and isinstance(since, (int, long)):
+            changes = self.presence.changes(since)
+            if changes is not None:
+                if target is None:
+                    name = event.caller.name
+                    changes = [list(change) for change in changes if change[1] != name]
                 else:
-                    json_data = json.dumps({"from": "players", "error": "Unknown action type: %s" % data["type"]})
-                    event.caller.send(json_data)
+                    changes = [list(change) for change in changes if change[1] == target]
+                event.caller.send({"from": "players", "type": "list", "target": target or "all", "since": since,
+                                   "version": self.presence.version, "epoch": self.presence.epoch,
+                                   "changes": changes},
+                                  kind="players", key=("list", target))
+                return
+
+        event.caller.send(self.snapshot(target, event.caller.name), kind="players", key=("list", target))
+
+    def snapshot(self, target, name):
+        """
+        Get the full list of players on a server, or on every server but `name` if there's no target, as a
+            pre-encoded message. These are cached until the next change to the presence index, or to the servers we
+            know about (which can come and go without any players).
+        """
+        servers = self.factory.servers
+        if self.snapshot_version != self.presence.version or self.snapshot_servers != servers.viewkeys():
+            self.snapshots.clear()
+            self.snapshot_version = self.presence.version
+            self.snapshot_servers = set(servers)
+
+        key = target if target is not None else ("all", name)
+        message = self.snapshots.get(key)
+        if message is None:
+            if target is not None:
+                self.logger.debug("Server %s requested players from server %s." % (name, target))
+                players = list(self.presence.players(target))
+            else:
+                self.logger.debug("Server %s requested players from all servers." % name)
+                players = {}
+                for server in servers:
+                    if not server == name:
+                        players[server] = list(self.presence.players(server))
+            message = self.snapshots[key] = codec.constant({
+                "from": "players", "type": "list", "target": target or "all", "players": players,
+                "version": self.presence.version, "epoch": self.presence.epoch
+            })
+        return message
+
+    def onLocate(self, event):
+        if not event.caller.authenticated:
+            return
+        player = event.data.get("player")
+        try:
+            server = self.presence.locate(player)
+        except TypeError:  # Unhashable
+            server = None
+        event.caller.send({"from": "players", "type": "locate", "player": player, "server": server})
+
+    def onLocateMany(self, event):
+        if not event.caller.authenticated:
+            return
+        players = event.data.get("players")
+        if not isinstance(players, list):
+            event.caller.send({"from": "players", "error": "locate-many needs a list of players"})
+            return
+        locate = self.presence.locations.get
+        servers = {}
+        for player in players:
+            if isinstance(player, basestring):
+                servers[player] = locate(player)
+        event.caller.send({"from": "players", "type": "locate-many", "servers": servers})
+
+    def onPoints(self, event):
+        if not event.caller.authenticated:
+            return
+        player, change = event.data.get("player"), event.data.get("change")
+        if not isinstance(player, basestring) or isinstance(change, bool) or not isinstance(change, (int, long)):
+            event.caller.send({"from": "players", "error": "points needs a player and a whole number change"})
+            return
+        if self.persistence is not None:
+            self.persistence.points(player, change)
+
+    def onPlayers(self, event):
+        # This route sees every players message, whatever its type
+        if event.caller.authenticated and event.data.get("type") not in TYPES:
+            event.caller.send({"from": "players", "error": "Unknown action type: %s" % event.data.get("type")})
+
+    def onServerRemoved(self, event):
+        server = event.caller
+        players = self.presence.drop(server.name)
+        if players:
+            self.logger.debug("Forgot %s players on %s." % (len(players), server.name))
+            if self.persistence is not None and not server.remote:
+                now = time.time()
+                for player in players:
+                    self.persistence.logout(player, server.name, now)
+
+    # Relay channels, for multi-process mode and federation. Servers on other workers and nodes are RemoteClient
+    #   objects, and we keep their players in the presence index up to date with what their owners tell us.
 
-    def onProtocolBuiltEvent(self, event):
-        event.protocol.players = []
-        self.logger.debug("Added `players` variable to protocol object.")
+    def onRelayPlayers(self, owner, message):
+        server = self.factory.servers.get(message["server"])
+        if server is None or not server.remote:
+            return
+        if message["type"] == "online":
+            self.presence.online(server.name, message["player"])
+        elif message["type"] == "offline":
+            self.presence.offline(server.name, message["player"])
+        elif message["type"] == "sync":
+            self.presence.sync(server.name, message["players"])
 
-        pass
\ No newline at end of file
+    def onRelayJoined(self, relay, owner, message):
+        for server in self.factory.clients.recipients(servers=True):
+            relay.publish("players", {"type": "sync", "server": server.name,
+                                      "players": list(self.presence.players(server.name))}, to=owner)
@@ -0,0 +1,330 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import os
+from collections import deque
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor, task
+from twisted.python import reflect
+
+ROWS = 200  # Rows per INSERT statement; SQLite's default limit on parameters is 999 before 3.32
+
+# The same schema in each database's dialect. Both understand INSERT .. ON CONFLICT (SQLite since 3.24, Postgres
+#   since 9.5), so the statements in _write() work unchanged with either.
+SCHEMAS = {
+    "sqlite": [
+        "PRAGMA journal_mode=WAL",  # So that several workers can share the database
+        "CREATE TABLE IF NOT EXISTS player_players (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS player_data (pid INTEGER PRIMARY KEY, last_server TEXT, last_online REAL, "
+        "points INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS player_login_logout (pid INTEGER, action BOOLEAN, time REAL)",
+        "CREATE TABLE IF NOT EXISTS player_points (pid INTEGER, change INTEGER)",
+    ],
+    "postgres": [
+        "CREATE TABLE IF NOT EXISTS player_players (id serial PRIMARY KEY, username varchar UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS player_data (pid integer PRIMARY KEY, last_server varchar, "
+        "last_online double precision, points integer NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS player_login_logout (pid integer, action bool, time double precision)",
+        "CREATE TABLE IF NOT EXISTS player_points (pid integer, change integer)",
+    ]
+}
+
+# Postgres tables made by the old prototype (test.py) have no key on player_data.pid, which ON CONFLICT (pid) needs,
+#   nullable points, and time-of-day columns where we store UNIX timestamps. These bring them up to date; they're
+#   only run when last_online still has the old type. A time of day can't be turned into a timestamp, so those are
+#   cleared, and only one row is kept for each player in player_data.
+MIGRATIONS = {
+    "sqlite": [],
+    "postgres": [
+        "DELETE FROM player_data a USING player_data b WHERE a.pid = b.pid AND a.ctid < b.ctid",
+        "CREATE UNIQUE INDEX IF NOT EXISTS player_data_pid ON player_data (pid)",
+        "UPDATE player_data SET points = 0 WHERE points IS NULL",
+        "ALTER TABLE player_data ALTER COLUMN points SET DEFAULT 0, ALTER COLUMN points SET NOT NULL, "
+        "ALTER COLUMN last_online TYPE double precision USING NULL",
+        "ALTER TABLE player_login_logout ALTER COLUMN time TYPE double precision USING NULL",
+    ]
+}
+
+
+class Persistence(object):
+    """
+    Records player logins, logouts, last servers and points changes in a database, in batches.
+
+    Nothing here touches the database on the reactor thread. Changes are buffered in memory, and every
+        `flush_interval` seconds (or as soon as `batch_size` of them are waiting) they're written out in a single
+        transaction, with multi-row INSERTs, through a Twisted adbapi connection pool. Only one batch is written at a
+        time; anything that comes in meanwhile waits for the next one. Last servers, last online times and points
+        totals are coalesced per player, so they only cost one row per player per batch.
+
+    The buffers are bounded: if the database can't keep up (or is down - failed batches are put back), at most
+        `max_pending` logins, logouts and points changes are kept, and the oldest are dropped, with a warning.
+
+    Postgres tables left over from the old prototype schema are migrated when the plugin starts; see MIGRATIONS.
+
+    Whatever is waiting is flushed before the reactor shuts down, and once more, synchronously, when the plugin is
+        disabled by CoreFactory.cleanup(), since by then the reactor and the pool have stopped.
+
+    Settings, from `persistence` in the players configuration:
+        enabled:        Defaults to true.
+        backend:        "sqlite" (the default; for local testing and single machines) or "postgres" (with psycopg2).
+        path:           For sqlite, the database file. Defaults to data/players.sqlite.
+        dsn:            For postgres, the connection string; eg "dbname=inter user=inter password=inter".
+        pool_min:       The fewest connections to keep open. Defaults to 1.
+        pool_max:       The most connections to open. Defaults to 5 (always 1 for sqlite).
+        flush_interval: Defaults to 1 (second).
+        batch_size:     Defaults to 500.
+        max_pending:    Defaults to 100000.
+
+    Public methods:
+        login(player, server, when)     Record that a player logged in to a server.
+        logout(player, server, when)    Record that a player logged out of a server.
+        points(player, change)          Record a change to a player's points.
+        flush()                         Write out everything that's waiting. Returns a Deferred.
+        close()                         Stop, writing out anything that's still waiting without the reactor.
+    """
+
+    def __init__(self, settings):
+        self.logger = logging.getLogger("Players")
+        self.backend = settings.get("backend", "sqlite")
+        self.flush_interval = settings.get("flush_interval", 1)
+        self.batch_size = settings.get("batch_size", 500)
+        self.max_pending = settings.get("max_pending", 100000)
+
+        if self.backend == "sqlite":
+            path = settings.get("path", "data/players.sqlite")
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.module = "sqlite3"
+            self.args = (path,)
+            self.kwargs = {"check_same_thread": False, "timeout": 30}
+            pool_min = pool_max = 1  # SQLite only allows one writer anyway
+        elif self.backend == "postgres":
+            self.module = "psycopg2"
+            self.args = (settings.get("dsn", ""),)
+            self.kwargs = {}
+            pool_min = settings.get("pool_min", 1)
+            pool_max = settings.get("pool_max", 5)
+        else:
+            raise ValueError("Unknown persistence backend: %s" % self.backend)
+
+        # The DB-API parameter style, for the placeholders in our statements
+        self.marker = "?" if reflect.namedModule(self.module).paramstyle == "qmark" else "%s"
+
+        self.sessions = deque()  # (player, logged in?, time), oldest first
+        self.changes = deque()  # (player, change), oldest first
+        self.players = {}  # {player: [last server, last online, points change]}
+        self.ids = {}  # {username: id}, for players in batches that have been committed
+        self.dropped = 0
+        self.writing = None  # A Deferred for the batch being written, if there is one
+        self.closed = False
+
+        self.pool = adbapi.ConnectionPool(self.module, *self.args, cp_min=pool_min, cp_max=pool_max,
+                                          cp_reconnect=True, cp_noisy=False, **self.kwargs)
+        self.pool.runInteraction(self._create).addErrback(self._failed, "create the player tables")
+
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(self.flush_interval, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self._shutdown)
+        self.logger.info("Persisting player data to %s." % self.backend)
+
+    def _create(self, txn):
+        for statement in SCHEMAS[self.backend]:
+            txn.execute(statement)
+        if MIGRATIONS[self.backend]:
+            txn.execute("SELECT data_type FROM information_schema.columns "
+                        "WHERE table_name = 'player_data' AND column_name = 'last_online'")
+            row = txn.fetchone()
+            if row and row[0].startswith("time "):
+                for statement in MIGRATIONS[self.backend]:
+                    txn.execute(statement)
+                self.logger.warn("Migrated the player tables from the old schema. Last online and login/logout "
+                                 "times recorded as times of day couldn't be kept, and have been cleared.")
+
+    @property
+    def pending(self):
+        return len(self.sessions) + len(self.changes)
+
+    def _drop(self):
+        # Drop the oldest login, logout or points change, to make room for another
+        (self.sessions or self.changes).popleft()
+        self.dropped += 1
+
+    def _append(self, buffer, entry):
+        if self.pending >= self.max_pending:
+            self._drop()
+        buffer.append(entry)
+        if self.pending >= self.batch_size and self.writing is None:
+            self.flush()
+
+    def _player(self, player):
+        try:
+            return self.players[player]
+        except KeyError:
+            data = self.players[player] = [None, None, 0]
+            return data
+
+    def login(self, player, server, when):
+        """
+        Record that a player logged in.
+        :param player: The player's name.
+        :param server: The server they logged in to.
+        :param when:   The UNIX timestamp it happened at.
+        """
+        data = self._player(player)
+        data[0], data[1] = server, when
+        self._append(self.sessions, (player, True, when))
+
+    def logout(self, player, server, when):
+        """
+        Record that a player logged out.
+        :param player: The player's name.
+        :param server: The server they logged out of.
+        :param when:   The UNIX timestamp it happened at.
+        """
+        data = self._player(player)
+        data[0], data[1] = server, when
+        self._append(self.sessions, (player, False, when))
+
+    def points(self, player, change):
+        """
+        Record a change to a player's points.
+        :param player: The player's name.
+        :param change: How many points they gained (or lost, if it's negative).
+        """
+        self._player(player)[2] += change
+        self._append(self.changes, (player, change))
+
+    def _take(self):
+        batch = (list(self.sessions), list(self.changes), self.players)
+        self.sessions.clear()
+        self.changes.clear()
+        self.players = {}
+        if self.dropped:
+            self.logger.warn("Dropped %s player changes that couldn't be written in time." % self.dropped)
+            self.dropped = 0
+        return batch
+
+    def flush(self):
+        """
+        Write out everything that's waiting, in one transaction. If a batch is already being written, this waits
+            for it first.
+        :return: A Deferred that fires once everything that was waiting when this was called has been written.
+        """
+        if self.writing is not None:
+            d = defer.Deferred()
+            self.writing.addBoth(lambda result: self.flush().chainDeferred(d))
+            return d
+        if not (self.sessions or self.changes or self.players):
+            return defer.succeed(None)
+
+        batch = self._take()
+        self.writing = self.pool.runInteraction(self._write, batch)
+        self.writing.addCallback(self._learn)
+
+        def failed(failure):
+            self._failed(failure, "save %s player changes" % (len(batch[0]) + len(batch[1])))
+            self._requeue(batch)
+
+        def done(result):
+            self.writing = None
+
+        return self.writing.addErrback(failed).addBoth(done)
+
+    def _failed(self, failure, what):
+        self.logger.error("Unable to %s: %s" % (what, failure.getErrorMessage()))
+
+    def _requeue(self, batch):
+        # Put a failed batch back in front of anything that's come in since, within the limit
+        sessions, changes, players = batch
+        self.sessions.extendleft(reversed(sessions))
+        self.changes.extendleft(reversed(changes))
+        for player, (server, when, points) in players.iteritems():
+            data = self._player(player)
+            if data[1] is None:
+                data[0], data[1] = server, when
+            data[2] += points
+        while self.pending > self.max_pending:
+            self._drop()
+
+    def _insert(self, txn, statement, rows, suffix=""):
+        # Run a multi-row INSERT, ROWS rows at a time
+        if not rows:
+            return
+        row = "(%s)" % ", ".join([self.marker] * len(rows[0]))
+        for start in xrange(0, len(rows), ROWS):
+            chunk = rows[start:start + ROWS]
+            txn.execute("%s VALUES %s %s" % (statement, ", ".join([row] * len(chunk)), suffix),
+                        [value for values in chunk for value in values])
+
+    def _write(self, txn, batch):
+        sessions, changes, players = batch
+
+        if len(self.ids) > 100000:
+            self.ids.clear()
+        ids = dict(self.ids)
+        learned = {}  # IDs we've looked up, which are only cached once the transaction commits
+
+        unknown = [(name,) for name in players if name not in ids]
+        if unknown:
+            self._insert(txn, "INSERT INTO player_players (username)", unknown, "ON CONFLICT (username) DO NOTHING")
+            for start in xrange(0, len(unknown), ROWS):
+                chunk = [name for (name,) in unknown[start:start + ROWS]]
+                txn.execute("SELECT id, username FROM player_players WHERE username IN (%s)" %
+                            ", ".join([self.marker] * len(chunk)), chunk)
+                for pid, name in txn.fetchall():
+                    learned[name] = pid
+            ids.update(learned)
+
+        self._insert(txn, "INSERT INTO player_login_logout (pid, action, time)",
+                     [(ids[player], action, when) for player, action, when in sessions])
+        self._insert(txn, "INSERT INTO player_points (pid, change)",
+                     [(ids[player], change) for player, change in changes])
+        self._insert(txn, "INSERT INTO player_data (pid, last_server, last_online, points)",
+                     [(ids[player], server, when, points) for player, (server, when, points) in players.iteritems()],
+                     "ON CONFLICT (pid) DO UPDATE SET "
+                     "last_server = COALESCE(excluded.last_server, player_data.last_server), "
+                     "last_online = COALESCE(excluded.last_online, player_data.last_online), "
+                     "points = player_data.points + excluded.points")
+        return learned
+
+    def _learn(self, learned):
+        # Cache the IDs looked up by a batch that's been committed
+        self.ids.update(learned)
+
+    def _shutdown(self):
+        if self.flusher.running:
+            self.flusher.stop()
+        return self.flush()
+
+    def close(self):
+        """
+        Stop, and write out anything that's still waiting with a connection of our own, without the reactor or the
+            pool. This is for after the reactor has stopped; don't call it while it's running.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.flusher.running:
+            self.flusher.stop()
+        if self.sessions or self.changes or self.players:
+            batch = self._take()
+            count = len(batch[0]) + len(batch[1])
+            try:
+                connection = reflect.namedModule(self.module).connect(*self.args, **self.kwargs)
+                try:
+                    cursor = connection.cursor()
+                    self._create(cursor)
+                    learned = self._write(cursor, batch)
+                    connection.commit()
+                    self._learn(learned)
+                finally:
+                    connection.close()
+            except Exception as e:
+                self.logger.error("Unable to save %s player changes at shutdown: %s" % (count, e))
+            else:
+                self.logger.info("Saved %s player changes at shutdown." % count)
+        if self.pool.running:
+            self.pool.close()
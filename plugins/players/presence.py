@@ -0,0 +1,106 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import os
+from collections import deque
+from itertools import islice
+
+
+class Presence(object):
+    """
+    An index of which players are online where, across every server we know about - local or on another worker or
+        node.
+
+    A player can only be on one server at a time; if they come online on a second server before the first says
+        they've gone, they're moved. Every operation is a dict or set operation.
+
+    Every change bumps `version` by one and is recorded in a log of the last `log_size` changes, so anyone who knows
+        the version they last saw can be sent just the changes since then. Versions only mean anything to this
+        process, so each instance also gets a random `epoch`; a version from a different epoch is meaningless.
+
+    Public methods:
+        online(server, player)  Mark a player as online on a server. Returns False if they already were.
+        offline(server, player) Mark a player as offline. Returns False if they weren't online on that server.
+        sync(server, players)   Replace a server's players with the given ones.
+        drop(server)            Forget about a server and its players. Returns the players it had.
+        locate(player)          Get the name of the server a player is on, or None.
+        players(server)         Get the set of players on a server. Don't modify it!
+        changes(since)          Get a list of (type, server, player) changes since a version, or None if the log
+                                    doesn't go back that far.
+
+    Public attributes (treat these as read-only):
+        locations {player: server}
+        rosters   {server: set of players}
+        version   The number of changes made so far
+        epoch     A random string identifying this instance's versions
+    """
+
+    def __init__(self, log_size=1000):
+        self.locations = {}
+        self.rosters = {}
+        self.version = 0
+        self.epoch = os.urandom(4).encode("hex")
+        self.log = deque(maxlen=log_size)  # (version, type, server, player), oldest first
+
+    def _record(self, kind, server, player):
+        self.version += 1
+        self.log.append((self.version, kind, server, player))
+
+    def online(self, server, player):
+        current = self.locations.get(player)
+        if current == server:
+            return False
+        if current is not None:
+            self.rosters[current].discard(player)
+            self._record("offline", current, player)
+        self.locations[player] = server
+        try:
+            self.rosters[server].add(player)
+        except KeyError:
+            self.rosters[server] = {player}
+        self._record("online", server, player)
+        return True
+
+    def offline(self, server, player):
+        if self.locations.get(player) != server:
+            return False
+        del self.locations[player]
+        self.rosters[server].discard(player)
+        self._record("offline", server, player)
+        return True
+
+    def sync(self, server, players):
+        players = set(players)
+        for player in self.players(server) - players:
+            self.offline(server, player)
+        for player in players:
+            self.online(server, player)
+
+    def drop(self, server):
+        players = self.rosters.pop(server, set())
+        for player in players:
+            if self.locations.get(player) == server:
+                del self.locations[player]
+                self._record("offline", server, player)
+        return players
+
+    def locate(self, player):
+        return self.locations.get(player)
+
+    def players(self, server):
+        return self.rosters.get(server, frozenset())
+
+    def changes(self, since):
+        """
+        Get the changes made after a version, oldest first.
+        :param since: The version to get the changes since.
+        :return:      A list of (type, server, player) tuples, where type is "online" or "offline" - or None, if some
+                          of those changes have already dropped out of the log (or the version is from the future).
+        """
+        if since > self.version:
+            return None
+        if since == self.version:
+            return []
+        if not self.log or self.log[0][0] > since + 1:
+            return None
+        return [entry[1:] for entry in islice(self.log, since + 1 - self.log[0][0], None)]
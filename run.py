@@ -1,6 +1,8 @@
 # coding=utf-8
 
 import logging
+import os
+import socket
 import sys
 import system.config as config
 import system.util as util
@@ -8,7 +10,16 @@ import system.util as util
 from twisted.internet import reactor
 from system.core import CoreFactory
 
-logging.basicConfig(format="%(asctime)s | %(name)8s | %(levelname)8s | %(message)s", datefmt="%d %b %Y - %H:%M:%S",
+
+def argument(name):
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+worker = argument("--worker")
+
+logging.basicConfig(format="%(asctime)s | " + ("w%s | " % worker if worker else "") +
+                           "%(name)8s | %(levelname)8s | %(message)s", datefmt="%d %b %Y - %H:%M:%S",
                     level=(logging.DEBUG if "--debug" in sys.argv else logging.INFO))
 
 logger = logging.getLogger("Init")
@@ -20,10 +31,33 @@ if not networking:
     logger.critical("Networking configuration is unavailable. The program will now terminate.")
     exit(1)
 
-factory = CoreFactory()
+if worker is None and int(networking.get("workers", 1)) > 1:
+    from system.workers import Master
+
+    master = Master(networking, "--debug" in sys.argv)
+    try:
+        master.start()
+        logger.info("Now listening on port %s with %s workers." % (networking["port"], master.count))
+        reactor.run()
+    except Exception as e:
+        logger.error("Error starting up: %s" % e)
+        util.output_exception(logger)
+    exit(0)
+
+if worker is not None:
+    from system.bus import Bus
+
+    factory = CoreFactory(Bus(worker, argument("--bus")))
+else:
+    factory = CoreFactory()
 
 try:
-    reactor.listenTCP(networking["port"], factory)
+    if worker is not None:
+        fd = int(argument("--fd"))
+        reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+        os.close(fd)  # adoptStreamPort works on a copy
+    else:
+        reactor.listenTCP(networking["port"], factory)
 
     logger.info("Now listening on port %s." % networking["port"])
 
@@ -0,0 +1,277 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+
+from collections import defaultdict
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+from system import codec
+
+
+class BusHubProtocol(LineReceiver):
+    """
+    One worker's connection to the bus hub.
+
+    Lines on the bus are "<target> <message>", where the target is either "*" (every other worker) or a worker ID.
+        The hub only looks at the target, so it never has to decode the messages it's relaying. The first line a
+        worker sends is "hello <worker ID>".
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    worker = None
+
+    def lineReceived(self, line):
+        target, _, message = line.partition(" ")
+        if self.worker is None:
+            if target == "hello":
+                self.factory.join(self, message)
+            return
+        self.factory.relay(self, target, line)
+
+    def connectionLost(self, reason=None):
+        if self.worker is not None:
+            self.factory.leave(self)
+
+
+class BusHub(Factory):
+    """
+    The bus hub, run by the master process in multi-process mode (see system/workers.py).
+    This relays messages between the workers over a Unix socket, and tells the workers when one of them joins or
+        leaves the bus.
+    """
+
+    protocol = BusHubProtocol
+
+    def __init__(self):
+        self.logger = logging.getLogger("Bus")
+        self.workers = {}
+
+    def join(self, protocol, worker):
+        protocol.worker = worker
+        self.workers[worker] = protocol
+        self.logger.info("Worker %s joined the bus." % worker)
+        self.relay(protocol, "*", "* " + codec.encode({"channel": "joined", "worker": worker, "message": {}}))
+
+    def leave(self, protocol):
+        if self.workers.get(protocol.worker) is protocol:
+            del self.workers[protocol.worker]
+        self.logger.info("Worker %s left the bus." % protocol.worker)
+        self.relay(protocol, "*", "* " + codec.encode({"channel": "left", "worker": protocol.worker, "message": {}}))
+
+    def relay(self, source, target, line):
+        if target == "*":
+            for protocol in self.workers.values():
+                if protocol is not source:
+                    protocol.sendLine(line)
+        else:
+            protocol = self.workers.get(target)
+            if protocol is not None:
+                protocol.sendLine(line)
+
+
+class RemoteClient(object):
+    """
+    A stand-in for an authenticated client that's connected to another worker (or, with federation, another node).
+
+    These live in the registry's `by_name`, `by_key` and `servers` indexes (but not in the recipient lists), so
+        plugins can look up and send to clients elsewhere as if they were local. Anything sent to one of these is
+        published on the `send` channel of its relay, addressed to the worker or node that owns the connection.
+    """
+
+    remote = True
+    authenticated = True
+
+    def __init__(self, relay, owner, id, name, api_key, not_server=False):
+        """
+        :param relay:      The Bus or Federation the client was announced on.
+        :param owner:      The ID of the worker, or the name of the node, that the client is connected to.
+        :param id:         The client's connection ID on its worker, if known.
+        :param name:       The name the client authenticated as.
+        :param api_key:    The API key the client authenticated with.
+        :param not_server: Whether the client is something other than a server.
+        """
+        self.relay = relay
+        self.owner = owner
+        self.id = id
+        self.name = name
+        self.api_key = api_key
+        self.not_server = not_server
+
+    def __repr__(self):
+        return "<RemoteClient %s on %s %s>" % (self.name, self.relay.kind, self.owner)
+
+    def send(self, data, kind=None, key=None):
+        if isinstance(data, codec.Frames):
+            data = data.obj
+        elif not isinstance(data, dict):
+            data = codec.decode(data)
+        self.relay.publish("send", {"id": self.id, "name": self.name, "message": data, "kind": kind, "key": key},
+                           to=self.owner)
+
+
+class BusClientProtocol(LineReceiver):
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.bus.connected(self)
+
+    def connectionLost(self, reason=None):
+        self.factory.bus.disconnected(self)
+
+    def lineReceived(self, line):
+        self.factory.bus.lineReceived(line.partition(" ")[2])
+
+
+class BusClientFactory(ReconnectingClientFactory):
+    protocol = BusClientProtocol
+    maxDelay = 5
+
+    def __init__(self, bus):
+        self.bus = bus
+
+
+class Bus(object):
+    """
+    A worker's connection to the bus.
+    In multi-process mode, each worker's factory has one of these as `bus` (and in `relays`); otherwise the factory's
+        `bus` is None.
+
+    Messages are published on named channels, and are delivered to the subscribers of that channel on every other
+        worker (or just one worker, if `to` is given). Subscribers are called with the ID of the worker that published
+        the message and the message itself, which must be JSON-serializable.
+
+    The bus keeps the workers' views of the network in sync on its own:
+        broadcast - Messages broadcast by the factory are relayed to the clients of every other worker.
+        send      - Messages sent to a RemoteClient are delivered to the connection on its worker.
+        client    - Authenticated clients are announced to the other workers, which add a RemoteClient for each of
+                    them to their registry. They're removed again when the client disconnects, or its worker leaves.
+        joined    - A worker joined the bus. We announce our clients to it.
+        left      - A worker left the bus. We forget about its clients.
+
+    Plugins with state that should be shared between workers (like the players plugin's player lists) can publish
+        and subscribe to channels of their own. Subscribe to `joined` to send a newly-started worker your current
+        state, with `to` set to its ID.
+
+    Public methods:
+        publish(channel, message, to=None)  Publish a message to the other workers, or to the worker `to`.
+        subscribe(channel, function)        Call function(worker, message) for each message on a channel.
+        announce(protocol)                  Tell the other workers about a client that authenticated here.
+        retract(protocol)                   Tell the other workers that a client here is gone.
+    """
+
+    kind = "worker"
+
+    def __init__(self, worker, path):
+        self.logger = logging.getLogger("Bus")
+        self.worker = str(worker)
+        self.path = path
+        self.factory = None
+        self.protocol = None
+        self.backlog = []
+        self.remotes = {}
+        self.subscribers = defaultdict(list)
+
+        self.subscribe("broadcast", self.onBroadcast)
+        self.subscribe("send", self.onSend)
+        self.subscribe("client", self.onClient)
+        self.subscribe("joined", self.onJoined)
+        self.subscribe("left", self.onLeft)
+
+    def start(self, factory):
+        """
+        Connect to the hub. The CoreFactory does this when it's given a bus.
+        """
+        self.factory = factory
+        reactor.connectUNIX(self.path, BusClientFactory(self))
+
+    def connected(self, protocol):
+        self.logger.info("Connected to the bus as worker %s." % self.worker)
+        self.protocol = protocol
+        protocol.sendLine("hello %s" % self.worker)
+        for client in self.factory.clients.authenticated.values():
+            self.announce(client)
+        backlog, self.backlog = self.backlog, []
+        for line in backlog:
+            protocol.sendLine(line)
+
+    def disconnected(self, protocol):
+        if self.protocol is protocol:
+            self.logger.warn("Lost connection to the bus.")
+            self.protocol = None
+            for worker in set(remote.owner for remote in self.remotes.values()):
+                self.onLeft(worker, {})
+
+    def publish(self, channel, message, to=None):
+        # Worker IDs that came off the bus are unicode, and would make the whole line unicode
+        line = "%s %s" % (str(to or "*"), codec.encode({"channel": channel, "worker": self.worker, "message": message}))
+        if self.protocol is None:
+            self.backlog.append(line)
+        else:
+            self.protocol.sendLine(line)
+
+    def subscribe(self, channel, function):
+        self.subscribers[channel].append(function)
+
+    def lineReceived(self, line):
+        try:
+            envelope = codec.decode(line)
+        except ValueError:
+            self.logger.warn("Unable to parse bus message: %s" % line)
+            return
+        for function in self.subscribers.get(envelope["channel"], ()):
+            try:
+                function(envelope["worker"], envelope["message"])
+            except Exception:
+                self.logger.exception("Error handling message on bus channel '%s'" % envelope["channel"])
+
+    def announce(self, protocol, to=None):
+        self.publish("client", {"type": "add", "id": protocol.id, "name": protocol.name, "api_key": protocol.api_key,
+                                "not_server": protocol.not_server}, to)
+
+    def retract(self, protocol):
+        self.publish("client", {"type": "remove", "id": protocol.id})
+
+    # Core channels
+
+    def onBroadcast(self, worker, message):
+        key = message.get("key")
+        if isinstance(key, list):
+            key = tuple(key)
+        self.factory.broadcast(message["message"], authenticated=message.get("authenticated", False),
+                               servers=message.get("servers", False), kind=message.get("kind"), key=key, source=self)
+
+    def onSend(self, worker, message):
+        protocol = self.factory.clients.get(message["id"])
+        if protocol is not None:
+            key = message.get("key")
+            if isinstance(key, list):
+                key = tuple(key)
+            protocol.send(message["message"], kind=message.get("kind"), key=key)
+
+    def onClient(self, worker, message):
+        clients = self.factory.clients
+        if message["type"] == "add":
+            remote = self.remotes.get((worker, message["id"]))
+            if remote is None:
+                remote = RemoteClient(self, worker, message["id"], message["name"], message["api_key"],
+                                      message.get("not_server", False))
+                self.remotes[(worker, remote.id)] = remote
+            clients.add_remote(remote)
+        else:
+            remote = self.remotes.pop((worker, message["id"]), None)
+            if remote is not None:
+                clients.remove_remote(remote)
+
+    def onJoined(self, worker, message):
+        for client in self.factory.clients.authenticated.values():
+            self.announce(client, to=worker)
+
+    def onLeft(self, worker, message):
+        for key, remote in self.remotes.items():
+            if remote.owner == worker:
+                del self.remotes[key]
+                self.factory.clients.remove_remote(remote)
@@ -0,0 +1,136 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import json
+import logging
+
+logger = logging.getLogger("Codec")
+
+_CODECS = {"json": json}
+
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    _CODECS["simplejson"] = simplejson
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    _CODECS["ujson"] = ujson
+
+# ujson is faster still, but it's only used when it's asked for (with `json_codec` in the networking configuration):
+#   its output differs from the standard library's in small ways that clients can notice, like how floats are rounded
+#   and which characters are escaped.
+PREFERENCE = ["simplejson", "json"]
+
+name = None
+_dumps = None
+_loads = None
+
+
+def use(codec=None):
+    """
+    Pick the JSON implementation to use. This is done for you when this module is imported.
+    :param codec: The name of a JSON module to use (json, simplejson or ujson), or None for the default: simplejson
+                      if it's installed, and json otherwise.
+    :return:      The name of the module that's now in use.
+    """
+    global name, _dumps, _loads
+
+    if codec is not None and codec not in _CODECS:
+        logger.warn("JSON codec '%s' is not available, using the default one instead." % codec)
+        codec = None
+    if codec is None:
+        codec = [c for c in PREFERENCE if c in _CODECS][0]
+
+    module = _CODECS[codec]
+    name = codec
+    _dumps = module.dumps
+    _loads = module.loads
+    return name
+
+
+def encode(obj):
+    """
+    Encode an object to a string (bytes) of JSON.
+    :param obj: The object to encode.
+    """
+    data = _dumps(obj)
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return data
+
+
+def decode(data):
+    """
+    Decode a string of JSON. Raises ValueError if it isn't valid JSON.
+    :param data: The JSON to decode.
+    """
+    return _loads(data)
+
+
+class Frames(dict):
+    """
+    A cache of one message's encoded frames, keyed by wire format (see system/wire.py).
+
+    Index this with a connection's `wire` to get the bytes to write to it; each format's frame is only built the
+        first time it's needed, so a broadcast encodes the message once per format in use rather than once per client.
+    """
+
+    def __init__(self, message):
+        """
+        :param message: The message - either a dict, or a string of JSON.
+        """
+        super(Frames, self).__init__()
+        if isinstance(message, dict):
+            self._obj = message
+            self._json = None
+        else:
+            if isinstance(message, unicode):
+                message = message.encode("utf-8")
+            self._obj = None
+            self._json = message
+
+    @property
+    def obj(self):
+        if self._obj is None:
+            self._obj = decode(self._json)
+        return self._obj
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = encode(self._obj)
+        return self._json
+
+    def __missing__(self, wire):
+        frame = self[wire] = wire.frame(self)
+        return frame
+
+
+def frames(message):
+    """
+    Get a Frames cache for a message, which may be a dict, a string of JSON or a Frames instance.
+    """
+    if isinstance(message, Frames):
+        return message
+    return Frames(message)
+
+
+def constant(obj):
+    """
+    Pre-encode a message that never changes, like an error response.
+    Keep the result around (at module or class level) and send it as often as you like; it'll only ever be encoded
+        once for each wire format.
+    :param obj: The message, as a dict.
+    """
+    message = Frames(obj)
+    message.json  # Encode it now, so that mistakes show up when the constant is defined
+    return message
+
+
+use()
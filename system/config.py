@@ -4,10 +4,17 @@ import yaml
 import logging
 import system.util as util
 
+from twisted.internet import defer
 from system.decorators import Singleton
+from system.fileio import io, read, write_atomic
 
 BASE_PATH = "config/%s"
 
+# Use libyaml's loader and dumper when PyYAML was built with it; they're many times faster than the pure Python ones.
+Loader = getattr(yaml, "CFullLoader", None) or getattr(yaml, "FullLoader", None) or \
+    getattr(yaml, "CLoader", yaml.Loader)
+Dumper = getattr(yaml, "CDumper", yaml.Dumper)
+
 
 @Singleton
 class configuration(object):
@@ -25,9 +32,28 @@ class configuration(object):
         save_file(filename, dict)   Save configuration to a file. If you do this a lot, consider using `system.storage`.
         save_mapping(key, filename) Save a mapping between a key and a filename.
         get_mapping(key)            Get a filename for a mapping, or None if it doesn't exist.
-        reload()                    Reload all mappings and configurations.
+        reload()                    Reload all mappings and configurations. Returns the names of those that changed.
+        reload_mapping(key)         Reload a single mapping.
+
+    Loading and saving is done in the caller's thread, which is usually the reactor thread. From event handlers, use
+        the asynchronous versions instead; they do the work on the file I/O thread (see system/fileio.py) and return
+        Deferreds:
+        load_file_async(filename)                   Fires with the data in a file (without config/), or None.
+        save_file_async(filename, dict)             Fires with True once it's saved, or False if it couldn't be.
+        reload_async()                              Fires with the names of the changed mappings once everything has
+                                                        been reloaded.
+        reload_mapping_async(key)                   Fires with True once it's reloaded, or False if there's no mapping.
+
+    Files are always saved atomically, so a crash while saving never leaves a half-written file behind.
+
+    Parsed files are cached, keyed by their path, inode, modification time and size, so loading a file that hasn't
+        changed (including mapping.yml, for get_mapping) only costs a stat. Reloading only parses the files that have
+        changed, and fires a `configChanged` event (see system/events/event.py) naming the mappings whose data changed,
+        was added or was removed. system/watcher.py reloads the configuration whenever the files change on disk, so
+        plugins can listen for that event instead of checking the files themselves.
     """
     files = {}
+    cache = {}  # {path: ((inode, mtime, size), data)}
     logger = logging.getLogger("Config")
 
     def __init__(self):
@@ -45,29 +71,77 @@ class configuration(object):
                 self.logger.info("Unable to load configuration: '%s'" % n)
         self.logger.info("Finished loading configuration.")
 
+    def _load(self, filename):
+        # This is also run on the file I/O thread, so it only touches the cache with single, atomic operations.
+        st = os.stat(filename)
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        cached = self.cache.get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        data = load_yaml(read(filename))
+        self.cache[filename] = (key, data)
+        return data
+
     def _load_file(self, filename):
         try:
-            fh = open(filename, "r")
-            data = fh.read()
-            fh.close()
-
-            return yaml.load(data)
+            return self._load(filename)
         except Exception:
             util.output_exception(self.logger)
             return None
 
     def _save_file(self, filename, dictionary):
         try:
-            fh = open(filename, "w")
-            data = yaml.dump(dictionary, default_flow_style=False)
-            fh.write(data)
-            fh.flush()
-            fh.close()
-
+            write_atomic(filename, dump_yaml(dictionary))
             return True
         except Exception:
             util.output_exception(self.logger)
             return False
+        finally:
+            self.cache.pop(filename, None)
+
+    def _changed(self, names):
+        if not names:
+            return
+        self.logger.info("Configuration changed: %s" % ", ".join(names))
+
+        from system.events import manager  # The event manager imports us, via the tracer
+        from system.events.event import configChangedEvent
+        manager.manager().runCallback("configChanged", configChangedEvent(self, names))
+
+    def _update(self, mappings, loaded):
+        files = {}
+        changed = []
+        for n, data in loaded:
+            if data:
+                fmap = {"name": n, "path": mappings[n], "data": data}
+                files[n] = fmap
+                if n not in self.files or self.files[n]["data"] is not data:
+                    changed.append(n)
+                    self.logger.debug("Data: %s" % fmap)
+            else:
+                self.logger.info("Unable to load configuration: '%s'" % n)
+
+        changed.extend(n for n in self.files if n not in files)
+        changed.sort()
+        self.files = files
+        self._changed(changed)
+        return changed
+
+    def _update_mapping(self, mapping, f, data):
+        old = self.files.get(mapping)
+        fmap = {"name": mapping, "path": f, "data": data}
+        self.files[mapping] = fmap
+        self.logger.debug("Data: %s" % fmap)
+        if old is None or old["data"] is not data:
+            self._changed([mapping])
+
+    def _path(self, filename):
+        if "\\" in filename:
+            filename = filename.replace("\\", "/")
+        if "/" in filename:
+            filename = filename.replace("../", "")
+        return BASE_PATH % filename
 
     def save_file(self, filename, dictionary):
         """
@@ -76,16 +150,48 @@ class configuration(object):
         :param dictionary: The data to be saved, a standard Python dictionary
         :param filename:   The file to save to, without config/
         """
-        if "\\" in filename:
-            filename = filename.replace("\\", "/")
-        if "/" in filename:
-            filename = filename.replace("../", "")
-            path = BASE_PATH % filename.split("/")
-            path = path[0:len(path)-1]
-            path = "/".join(path)
-            if not os.path.exists(path):
-                os.makedirs(path)
-        self._save_file(BASE_PATH % filename, dictionary)
+        self._save_file(self._path(filename), dictionary)
+
+    def _load_file_async(self, filename):
+        d = io().load(filename, loader=self._load)
+
+        def failed(failure):
+            self.logger.error("Unable to load %s: %s" % (filename, failure.getErrorMessage()))
+            return None
+
+        return d.addErrback(failed)
+
+    def _save_file_async(self, filename, dictionary):
+        d = io().save(filename, dictionary, dump_yaml)
+
+        def saved(result):
+            self.cache.pop(filename, None)
+            return result
+
+        def failed(failure):
+            self.logger.error("Unable to save %s: %s" % (filename, failure.getErrorMessage()))
+            return False
+
+        return d.addCallbacks(saved, failed)
+
+    def load_file_async(self, filename):
+        """
+        Load a yaml file on the file I/O thread.
+        This will only load stuff in the config/ folder, don't specify config/ in the path.
+        :param filename: The file to load from, without config/
+        :return:         A Deferred that fires with the data, or None if the file couldn't be loaded.
+        """
+        return self._load_file_async(self._path(filename))
+
+    def save_file_async(self, filename, dictionary):
+        """
+        Save a dictionary to a yaml file on the file I/O thread.
+        This will only save stuff in the config/ folder, don't specify config/ in the path.
+        :param dictionary: The data to be saved, a standard Python dictionary
+        :param filename:   The file to save to, without config/
+        :return:           A Deferred that fires with True once it's saved, or False if it couldn't be.
+        """
+        return self._save_file_async(self._path(filename), dictionary)
 
 
     def get(self, key):
@@ -107,7 +213,7 @@ class configuration(object):
         :param filename: The filename this mapping identifies (without config/)
         """
         self.logger.debug("Saving mapping: %s (%s)" % (mapping, filename))
-        mappings = self._load_file(BASE_PATH % "mapping.yml")
+        mappings = dict(self._load_file(BASE_PATH % "mapping.yml") or {})
         mappings[mapping] = filename
         self._save_file(BASE_PATH % "mapping.yml", mappings)
 
@@ -117,42 +223,90 @@ class configuration(object):
         :param mapping: The key used to identify the mapping
         """
         mappings = self._load_file(BASE_PATH % "mapping.yml")
-        if mapping in mappings:
+        if mappings and mapping in mappings:
             return mappings[mapping]
         return None
 
     def reload(self):
         """
         Reloads the entire configuration set from the mappings.
+        Only files that have changed since they were last loaded are parsed again.
+        :return: A sorted list of the names of the mappings that changed.
         """
         self.logger.info("Reloading configuration..")
         mappings = self._load_file(BASE_PATH % "mapping.yml")
+        if not mappings:
+            self.logger.error("Unable to load mapping.yml, keeping the current configuration.")
+            return []
 
-        self.files = {}
-
-        for n, f in mappings.items():
-            self.logger.info("Loading configuration: '%s'" % n)
-            data = self._load_file(BASE_PATH % f)
-            if data:
-                fmap = {"name": n, "path": f, "data": data}
-                self.files[n] = fmap
-                self.logger.debug("Data: %s" % fmap)
+        changed = self._update(mappings, [(n, self._load_file(BASE_PATH % f)) for n, f in mappings.items()])
         self.logger.info("Finished reloading configuration.")
+        return changed
 
     def reload_mapping(self, mapping):
+        """
+        Reload a single mapping.
+        :param mapping: The key used to identify the mapping
+        :return:        True if it was reloaded, or False if there's no such mapping.
+        """
         self.logger.debug("Reloading mapping: %s" % mapping)
         mappings = self._load_file(BASE_PATH % "mapping.yml")
 
-        if mapping in mappings:
-            n = mapping
+        if mappings and mapping in mappings:
             f = mappings[mapping]
-            data = self._load_file(BASE_PATH % f)
-            fmap = {"name": n, "path": f, "data": data}
-            self.files[n] = fmap
-            self.logger.debug("Data: %s" % fmap)
+            self._update_mapping(mapping, f, self._load_file(BASE_PATH % f))
             return True
         return False
 
+    @defer.inlineCallbacks
+    def reload_async(self):
+        """
+        Reloads the entire configuration set from the mappings, on the file I/O thread.
+        The old configuration stays in place until everything has been loaded, and only files that have changed since
+            they were last loaded are parsed again.
+        :return: A Deferred that fires with a sorted list of the names of the mappings that changed.
+        """
+        self.logger.debug("Reloading configuration..")
+        mappings = yield self._load_file_async(BASE_PATH % "mapping.yml")
+        if not mappings:
+            self.logger.error("Unable to load mapping.yml, keeping the current configuration.")
+            defer.returnValue([])
+
+        names = list(mappings.keys())
+        results = yield defer.gatherResults([self._load_file_async(BASE_PATH % mappings[n]) for n in names])
+        defer.returnValue(self._update(mappings, zip(names, results)))
+
+    @defer.inlineCallbacks
+    def reload_mapping_async(self, mapping):
+        """
+        Reload a single mapping, on the file I/O thread.
+        :param mapping: The key used to identify the mapping
+        :return:        A Deferred that fires with True once it's been reloaded, or False if there's no such mapping.
+        """
+        self.logger.debug("Reloading mapping: %s" % mapping)
+        mappings = yield self._load_file_async(BASE_PATH % "mapping.yml")
+
+        if mappings and mapping in mappings:
+            f = mappings[mapping]
+            data = yield self._load_file_async(BASE_PATH % f)
+            self._update_mapping(mapping, f, data)
+            defer.returnValue(True)
+        defer.returnValue(False)
+
+
+def load_yaml(data):
+    """
+    Parse a string of YAML, with the fastest loader available.
+    """
+    return yaml.load(data, Loader=Loader)
+
+
+def dump_yaml(dictionary):
+    """
+    Serialize something to a string of YAML, with the fastest dumper available.
+    """
+    return yaml.dump(dictionary, Dumper=Dumper, default_flow_style=False)
+
 
 def conf():
     """
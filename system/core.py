@@ -1,29 +1,62 @@
 # coding=utf-8
 
-import json
 import logging
-import time
+from collections import deque
 
+from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Factory, connectionDone
-from twisted.internet import reactor
 from twisted.protocols.basic import LineReceiver
 from yapsy.PluginManager import PluginManagerSingleton
+from system import codec
 from system import util
+from system import config
+from system.heartbeat import Heartbeat
+from system.outbound import OutboundQueue, OutboundSettings
 from system.events import manager
+from system.federation import Federation
+from system.tracing import tracer
+from system.watcher import ConfigWatcher
+from system.registry import ClientRegistry
+from system.storage import data
+from system.wire import FLAG_ZLIB, FORMATS, FRAMED_JSON, HEADER, LINE_JSON, ZlibStream
 from system.events.event import clientConnectedEvent, clientDisconnectedEvent, dataReceivedEvent, pluginLoadedEvent, \
-    pluginsLoadedEvent, protocolBuiltEvent, pingSentEvent, pongReceivedEvent
+    pluginsLoadedEvent, protocolBuiltEvent, pongReceivedEvent
 
 import system.globals as g
 
+NOT_JSON = codec.constant({"error": "No JSON object could be decoded", "from": "core"})
+FRAME_TOO_LONG = codec.constant({"error": "Frame too long", "from": "core"})
+UNDECODABLE_FRAME = codec.constant({"error": "Unable to decode frame", "from": "core"})
+CORRUPT_STREAM = codec.constant({"error": "Unable to decompress frame", "from": "core"})
+SHUTTING_DOWN = codec.constant({"error": "Server is shutting down", "from": "core"})
+
 
 class Core(LineReceiver):
     """
     Core networking and parsing.
     This class is the `core` of the application and is responsible for individual connections.
+
+    Debug output for individual messages is only formatted when `tracing` is set. This is decided once per
+        connection by the tracer (see system/tracing.py), so it costs nothing when we're not logging at DEBUG.
+
+    Connections start out speaking newline-delimited JSON, but a client may switch to another wire format (see
+        system/wire.py) by sending {"format": name} after the version handshake. The connection's format is `wire`.
+        If the factory offers compression, the same message may also carry {"compression": "zlib"}; the connection's
+        wire.ZlibStream is then `stream`. Only messages without an `action` or an `api_key` are taken as negotiation;
+        anything else with a "format" or "compression" key (a chat message's own formatting, say) is handled
+        normally.
+
+    Messages from a connection are handled in the order they arrived in. If a handler returns a Deferred, any
+        messages that arrive before it fires are kept in `backlog`, and handled once it has.
     """
 
     host = ""
     pings = []
+    tracing = False
+    wire = LINE_JSON
+    stream = None
+    remote = False
+    MAX_FRAME = 1024 * 1024
 
     def __init__(self, factory, addr):
         self.factory = factory
@@ -32,25 +65,8 @@ class Core(LineReceiver):
         self.events = manager.manager()
         self.id = None
         self.pings = []
-
-    def ping(self):
-        if not self.connected:
-            return
-        if len(self.pings) > 2:
-            self.info("Disconnecting: Ping timeout.")
-            self.send(json.dumps({"error": "Ping timeout", "from": "core"}))
-            self.transport.loseConnection()
-            return
-        now = str(time.time())
-
-        self.debug("Sending ping: %s" % now)
-
-        self.send(json.dumps({"from": "ping", "timestamp": now}))
-        self.pings.append(now)
-
-        event = pingSentEvent(self, now)
-        self.events.runCallback("pingSent", event)
-        reactor.callLater(30, self.ping)
+        self._framebuf = ""
+        self.backlog = None  # Messages waiting for an earlier one that's still being handled, in order
 
     def connectionMade(self):
         """
@@ -58,9 +74,11 @@ class Core(LineReceiver):
         """
         # host = self.transport.getPeer().host
         # port = self.transport.getPeer().port
-        data = json.dumps({"version": g.__version__})
-        self.send(data)
-        self.ping()
+        self.tracing = self.factory.tracer.connection(self)
+        self.queue = OutboundQueue(self, self.factory.outbound)
+        self.transport.registerProducer(self.queue, True)
+        self.send(self.factory.handshake)
+        self.factory.heartbeat.add(self)
         event = clientConnectedEvent(self)
         self.events.runCallback("clientConnected", event)
 
@@ -71,6 +89,7 @@ class Core(LineReceiver):
         """
 
         self.connected = 0
+        self.factory.heartbeat.remove(self)
 
         event = clientDisconnectedEvent(self)
         self.events.runCallback("clientDisconnected", event)
@@ -82,32 +101,160 @@ class Core(LineReceiver):
         Called when a line is recieved from the client. Must end with '\n'.
         :param line: The data recieved.
         """
-        self.debug("Data: %s" % line.rstrip("\n"))
         try:
-            data = json.loads(line)
+            data = codec.decode(line)
         except ValueError:
             self.warn("Unable to parse JSON: %s" % line.rstrip("\n"))
-            data = json.dumps({"error": "No JSON object could be decoded", "from": "core"})
-            self.send(data)
+            self.send(NOT_JSON)
         except Exception as e:
             util.output_exception(self)  # Never do this, by the way. Hackish formatting = baaaaaaaad.
-            data = json.dumps({"error": str(e), "from": "core"})
-            self.sendLine(data)
+            self.send({"error": str(e), "from": "core"})
         else:
+            if self.tracing and self.factory.tracer.action(data):
+                self.debug("Data: %s" % line.rstrip("\n"))
+            self.messageReceived(data)
+
+    def rawDataReceived(self, data):
+        """
+        Called with incoming data once the client has switched to a framed wire format.
+        Splits the data into frames, buffering any partial frame until the rest of it arrives.
+        :param data: The data recieved.
+        """
+        buf = self._framebuf + data if self._framebuf else data
+        offset = 0
+        size = HEADER.size
+
+        while len(buf) - offset >= size:
+            length, flags = HEADER.unpack_from(buf, offset)
+            if length > self.MAX_FRAME:
+                self.warn("Disconnecting: Frame too long (%s bytes)." % length)
+                self.send(FRAME_TOO_LONG)
+                self.transport.loseConnection()
+                self._framebuf = ""
+                return
+            end = offset + size + length
+            if len(buf) < end:
+                break
+            self.frameReceived(buf[offset + size:end], flags)
+            offset = end
+            if self.transport.disconnecting:
+                self._framebuf = ""
+                return
+
+        self._framebuf = buf[offset:]
+
+    def frameReceived(self, payload, flags):
+        """
+        Called when a complete frame is recieved from the client.
+        A frame that can't be decompressed leaves the connection's deflate stream in an unknown state, so nothing after
+            it could be trusted either; the client is disconnected.
+        :param payload: The frame's payload.
+        :param flags:   The frame's flags byte.
+        """
+        if flags & ~FLAG_ZLIB or (flags and self.stream is None):
+            self.warn("Unsupported frame flags: %s" % flags)
+            self.send({"error": "Unsupported frame flags: %s" % flags, "from": "core"})
+            return
+        if flags & FLAG_ZLIB:
+            try:
+                payload = self.stream.decompress(payload, self.MAX_FRAME)
+            except Exception as e:
+                self.warn("Disconnecting: Unable to decompress frame: %s" % e)
+                self.send(CORRUPT_STREAM)
+                self.transport.loseConnection()
+                return
+        try:
+            data = self.wire.loads(payload)
+        except Exception as e:
+            self.warn("Unable to decode %s frame: %s" % (self.wire.name, e))
+            self.send(UNDECODABLE_FRAME)
+        else:
+            self.messageReceived(data)
+
+    def messageReceived(self, data):
+        """
+        Called with each decoded message from the client, whatever the wire format.
+        Messages go to the `dataReceived` callback first, and then to the routes for their action (see EventManager).
+        :param data: The decoded message.
+        """
+        if self.tracing and self.factory.tracer.action(data):
             self.debug("Parsed data: %s" % data)
 
-            if "pong" in data:
-                pong = data["pong"]
+        if "pong" in data:
+            pong = data["pong"]
 
+            if self.tracing:
                 self.debug("Received pong: %s" % pong)
 
-                self.pings.remove(pong)
+            if self.factory.heartbeat.pong(self, pong):
                 event = pongReceivedEvent(self, pong)
-                self.events.runCallback("pingSent", event)
+                self.events.runCallback("pongReceived", event)
+            return
+
+        if ("format" in data or "compression" in data) and "action" not in data and "api_key" not in data \
+                and self.wire is LINE_JSON:
+            self.switchFormat(data.get("format", LINE_JSON.name), data.get("compression"))
+            return
+
+        event = dataReceivedEvent(self, data)
+        if self.backlog is not None:
+            self.backlog.append(event)  # An earlier message is still being handled; this one has to wait for it
+            return
+        waiting = self.dispatch(event)
+        if waiting is not None:
+            self.backlog = deque()
+            waiting.addBoth(self._resume)
+
+    def dispatch(self, event):
+        """
+        Run the `dataReceived` callback and then the routes for a message.
+        :return: None once they've all run, or a Deferred if a handler is still waiting on one.
+        """
+        waiting = self.events.runCallback("dataReceived", event)
+        if waiting is not None:
+            return waiting.addCallback(self.events.route)
+        routed = self.events.route(event)
+        if isinstance(routed, Deferred):
+            return routed
+        return None
+
+    def _resume(self, ignored):
+        # The message we were waiting on has been handled; carry on with the ones that arrived in the meantime
+        backlog = self.backlog
+        while backlog:
+            waiting = self.dispatch(backlog.popleft())
+            if waiting is not None:
+                waiting.addBoth(self._resume)
                 return
+        self.backlog = None
 
-            event = dataReceivedEvent(self, data)
-            self.events.runCallback("dataReceived", event)
+    def switchFormat(self, name, compression=None):
+        """
+        Switch this connection to a different wire format, as requested by the client.
+        :param name:        The name of the format to switch to.
+        :param compression: The name of the compression to use, if any. Only "zlib" is supported.
+        """
+        wire = FORMATS.get(name) if isinstance(name, basestring) else None
+        if wire is None:
+            self.send({"error": "Unsupported format: %s" % name, "from": "core"})
+            return
+        if compression is not None and (compression != ZlibStream.name or not self.factory.compression):
+            self.send({"error": "Unsupported compression: %s" % compression, "from": "core"})
+            return
+
+        if compression is None:
+            self.send({"format": wire.name, "from": "core"})
+        else:
+            self.send({"format": wire.name, "compression": compression, "from": "core"})
+            if not wire.framed:
+                wire = FRAMED_JSON
+            self.stream = ZlibStream(self.factory.compression)
+            self.queue.compressWith(self.stream)
+
+        if wire.framed:
+            self.info("Switching to wire format: %s%s" % (wire.name, " (%s)" % compression if compression else ""))
+            self.wire = wire
+            self.setRawMode()
 
     def log(self, level, message):
         self.logger.log(level, "%s | %s" % (self.host.rjust(15), message))
@@ -127,16 +274,37 @@ class Core(LineReceiver):
     def critical(self, message):
         self.log(logging.CRITICAL, message)
 
-    def send(self, data):
+    def send(self, data, kind=None, key=None):
+        """
+        Send a message to the client, encoded for its wire format.
+        :param data: The message to send: a dict, a string of JSON, or a constant made with codec.constant()
+        :param kind: The class of message this is, for the outbound queue's overflow policies (eg "chat")
+        :param key:  For message classes that are coalesced, messages with the same key replace each other.
+        """
         if self.connected:
-            self.debug("Sending data: %s" % data)
-            self.sendLine(data)
+            if self.tracing:
+                self.debug("Sending data: %s" % data)
+            if self.wire is LINE_JSON and isinstance(data, str):
+                self.writeFrame(data + self.delimiter, kind, key)
+            else:
+                self.writeFrame(codec.frames(data)[self.wire], kind, key)
 
-    def sendToOthers(self, data):
-        clients = self.factory.clients
-        for client in clients:
-            if not client == self:
-                client.send(data)
+    def sendLine(self, line):
+        self.send(line)
+
+    def writeFrame(self, frame, kind=None, key=None):
+        """
+        Write an already-encoded frame (delimiter or header included) to the client, through its outbound queue.
+        This is used by the factory's broadcast methods, which encode a message once and reuse the buffer.
+        :param frame: The bytes to write.
+        :param kind:  The class of message this is, for the outbound queue's overflow policies.
+        :param key:   For message classes that are coalesced, messages with the same key replace each other.
+        """
+        if self.connected:
+            self.queue.write(frame, kind, key)
+
+    def sendToOthers(self, data, kind=None, key=None):
+        self.factory.broadcast(data, exclude=self, kind=kind, key=key)
 
 
 class CoreFactory(Factory):
@@ -146,10 +314,47 @@ class CoreFactory(Factory):
     It also handles plugin loading and execution.
     """
 
-    def __init__(self):
-        self.servers = {}
-        self.clients = []
+    def __init__(self, bus=None):
+        """
+        :param bus: In multi-process mode, this worker's system.bus.Bus. See system/workers.py.
+        """
+        self.clients = ClientRegistry()
+        self.servers = self.clients.servers
         self.logger = logging.getLogger("Factory")
+        self.relays = self.clients.relays
+        self.bus = bus
+        if bus is not None:
+            self.relays.append(bus)
+            bus.start(self)
+            data().share(bus)
+
+        self.federation = None
+        federation = config.conf().get("federation")
+        if federation:
+            if bus is not None:
+                self.logger.warn("Federation isn't available in multi-process mode, so it won't be started.")
+            else:
+                self.federation = Federation(federation)
+                self.relays.append(self.federation)
+                self.federation.start(self)
+        networking = config.conf().get("networking") or {}
+        self.logger.info("Using JSON codec: %s" % codec.use(networking.get("json_codec")))
+        self.heartbeat = Heartbeat(networking.get("ping_interval", 30), networking.get("ping_slots", 30))
+        self.outbound = OutboundSettings(networking.get("outbound"))
+        if "coalesce" in networking:
+            self.logger.warn("'coalesce' belongs in the 'outbound' section of the networking configuration; "
+                             "it's being ignored.")
+        self.watcher = ConfigWatcher(networking.get("config_watcher"))
+
+        self.compression = dict(networking.get("compression") or {})  # A copy; the configuration is shared
+        if self.compression.get("enabled", True):
+            self.compression.setdefault("enabled", True)
+        else:
+            self.compression = None
+        self.handshake = codec.constant({"version": g.__version__, "formats": sorted(FORMATS.keys()),
+                                         "compression": [ZlibStream.name] if self.compression else []})
+        self.tracer = tracer()
+        self.tracer.refresh()
         self.plugman = PluginManagerSingleton.get()
         self.events = manager.manager()
         self.plugman.setPluginPlaces(["plugins"])
@@ -175,6 +380,14 @@ class CoreFactory(Factory):
         event = pluginsLoadedEvent(self)
         self.events.runCallback("pluginsLoaded", event)
 
+    def startFactory(self):
+        self.heartbeat.start()
+        self.watcher.start()
+
+    def stopFactory(self):
+        self.heartbeat.stop()
+        self.watcher.stop()
+
     def buildProtocol(self, addr):
         """
         Builds an instance of the protocol for a client.
@@ -183,17 +396,54 @@ class CoreFactory(Factory):
         protocol = Core(self, addr)
         event = protocolBuiltEvent(self, protocol)
         self.events.runCallback("protocolBuilt", event)
+        self.clients.add(protocol)
         protocol.info("Client connecting on port %s" % addr.port)
-        self.clients.append(protocol)
         return protocol
 
     def sendToAll(self, data):
         """
         Send a message to all clients.
-        :param data: JSON to send to all connected clients.
+        :param data: The message to send to all connected clients.
         """
-        for client in self.clients:
-            client.send(data)
+        self.broadcast(data)
+
+    def broadcast(self, data, exclude=None, authenticated=False, servers=False, kind=None, key=None, source=None):
+        """
+        Send a message to many clients, serializing it only once.
+        The message is encoded and framed a single time for each wire format in use, and the resulting buffer is
+            written to every recipient using that format.
+        :param data:          The message to send: a dict, a string of JSON, or a constant made with codec.constant()
+        :param exclude:       A protocol, or a collection of protocols, that should not receive the message.
+        :param authenticated: Only send to clients that have authenticated.
+        :param servers:       Only send to authenticated servers (the `servers` dict), ignoring `not_server` clients.
+        :param kind:          The class of message this is, for the outbound queues' overflow policies.
+        :param key:           For message classes that are coalesced, messages with the same key replace each other.
+        :param source:        The relay (see `relays`) that the message came in on, if any. Messages are passed on to
+                                  every other relay, so that clients of other workers and nodes receive them too.
+        :return:              The number of clients the message was written to (in this process).
+        """
+        frames = codec.frames(data)
+        targets = self.clients.recipients(authenticated, servers)
+
+        if exclude is None:
+            exclude = ()
+        elif isinstance(exclude, Core):
+            exclude = (exclude,)
+
+        count = 0
+        for client in targets:
+            if client.connected and client not in exclude:
+                client.writeFrame(frames[client.wire], kind, key)
+                count += 1
+
+        for relay in self.relays:
+            if relay is not source:
+                relay.publish("broadcast", {"message": frames.obj, "authenticated": authenticated,
+                                            "servers": servers, "kind": kind, "key": key})
+
+        if self.tracer.core:
+            self.logger.debug("Broadcast to %s clients: %s" % (count, data))
+        return count
 
     def cleanup(self):
         """
@@ -203,10 +453,12 @@ class CoreFactory(Factory):
         self.logger.info("Dropping clients..")
 
         for client in self.clients:
-            client.send(json.dumps({"error": "Server is shutting down", "from": "core"}))
+            client.send(SHUTTING_DOWN)
             client.transport.loseConnection()
             del client
 
+        self.logger.info("Outbound queue policy counters: %s" % self.outbound.stats)
+
         self.logger.info("Disabling plugins..")
         for pluginInfo in self.plugman.getAllPlugins():
             try:
@@ -112,4 +112,28 @@ class protocolBuiltEvent(Event):
 
     def __init__(self, caller, protocol):
         super(protocolBuiltEvent, self).__init__(caller)
-        self.protocol = protocol
\ No newline at end of file
+        self.protocol = protocol
+
+class configChangedEvent(Event):
+    """
+    Event fired when the configuration has been reloaded and some of it has changed.
+
+    The names of the mappings whose data changed, was added or was removed are available through event.names; use
+        conf().get(name) to get the new data.
+    """
+
+    def __init__(self, caller, names):
+        super(configChangedEvent, self).__init__(caller)
+        self.names = names
+
+
+class serverRemovedEvent(Event):
+    """
+    Event fired when a server is removed from the factory's `servers`: a local server disconnected, or a server on
+        another worker or node went away (see system/registry.py).
+
+    The server (a protocol object or a RemoteClient) is available through event.caller
+    """
+
+    def __init__(self, caller):
+        super(serverRemovedEvent, self).__init__(caller)
@@ -1,7 +1,9 @@
 # coding=utf-8
 import logging
 from operator import itemgetter
+from twisted.internet.defer import Deferred
 from system import util
+from system.tracing import tracer
 
 __author__ = "Gareth Coles"
 
@@ -51,17 +53,75 @@ class EventManager(object):
             Note: `plugin` is the name of a plugin, not a plugin object.
         runCallback(callback, event):
             Run all handlers for a certain callback with an event.
+            Returns None once they've all run, or a Deferred if one of them returned a Deferred; see below.
+        addRoute(action, plugin, function, priority, type=None, cancelled=False):
+            Add a route. Routes are handlers for messages with a specific `action` (and, optionally, `type`); see below.
+            Note: A plugin may have one handler for each action and type.
+            - action:    The message action to handle, like "chat"
+            - type:      Defaults to None; the message type to handle, like "online". None handles every type.
+            - The rest are the same as for addCallback.
+        removeRoute(action, plugin, type=None):
+            Remove a route from a plugin.
+            Note: `plugin` is the name of a plugin, not a plugin object.
+        route(event):
+            Run the routes matching a dataReceivedEvent's message. Returns False if there weren't any, None once
+            they've all run, or a Deferred if one of them returned a Deferred.
+
+    Handlers are kept as dicts in `callbacks`, which is what the methods above work with. Every time the handlers for
+        a callback change, they're also compiled into a dispatch table in `tables`, which is what runCallback uses:
+        a tuple of the handler functions in priority order, plus, for every position in it, a tuple of the handlers
+        from that position on that accept cancelled events. Dispatching an event is then a plain loop over a tuple
+        until something cancels it, at which point it jumps straight to the remaining handlers that want to see it.
+
+    Most plugins only care about one or two message actions. Rather than registering for `dataReceived` (and seeing
+        every single message), they can add routes for those actions. The core runs the `dataReceived` callback for
+        every message first - so catch-all plugins like auth still work, and can still cancel messages - and then
+        calls route(), which finds the handlers for the message's action and type with a couple of dict lookups and
+        runs just those, in priority order, with the same cancellation rules. Routes without a type see messages of
+        every type for their action.
+
+    Handlers may return a Deferred (use the @blocking decorator in system/threads.py for handlers that block). The
+        rest of the handlers are then run once it fires, in the same order and with the same cancellation rules, so
+        the handler can still cancel the event. runCallback returns a Deferred that fires with the event once every
+        handler has run, and the core waits for the `dataReceived` callback before routing the message. Failures are
+        logged, just like exceptions raised by handlers that don't return Deferreds.
     """
 
     callbacks = {}
     # {"callbackname": [{"name": name, "priority": prioriy, "function": function, "cancelled": cancelled]}
 
+    tables = {}
+    # {"callbackname": ((function, ...), ((cancelled function, ...), ...), [handler, ...])}
+
+    routes = {}
+    # {"action": [{"name": name, "type": type, "priority": priority, "function": function, "cancelled": cancelled}]}
+
+    route_tables = {}
+    # {"action": (table for messages of any type, {"type": table for messages of that type})}
+
     def __init__(self):
         self.logger = logging.getLogger("Events")
+        self.tracer = tracer()
 
     def _sort(self, lst):
         return sorted(lst, key=itemgetter("priority", "name"), reverse=True)
 
+    def _compile(self, callback):
+        """
+        Rebuild the dispatch table for a callback. Call this whenever its handlers change.
+        """
+        handlers = self.callbacks.get(callback)
+        if not handlers:
+            self.tables.pop(callback, None)
+            return
+        self.tables[callback] = self._table(handlers)
+
+    def _table(self, handlers):
+        functions = tuple(cb["function"] for cb in handlers)
+        tails = tuple(tuple(cb["function"] for cb in handlers[i:] if cb["cancelled"])
+                      for i in xrange(len(handlers) + 1))
+        return functions, tails, handlers
+
     def addCallback(self, callback, plugin, function, priority, cancelled=False):
         if not self.hasCallback(callback):
             self.callbacks[callback] = []
@@ -81,6 +141,7 @@ class EventManager(object):
         current.append(data)
 
         self.callbacks[callback] = self._sort(current)
+        self._compile(callback)
 
     def getCallback(self, callback, plugin):
         if self.hasCallback(callback):
@@ -119,10 +180,12 @@ class EventManager(object):
                 self.callbacks[callback] = self._sort(done)
             else:
                 del self.callbacks[callback]
+            self._compile(callback)
 
     def removeCallbacks(self, callback):
         if self.hasCallback(callback):
             del self.callbacks[callback]
+            self._compile(callback)
 
     def removeCallbacksForPlugin(self, plugin):
         current = self.callbacks.items()
@@ -135,23 +198,148 @@ class EventManager(object):
                 self.callbacks[key] = self._sort(done)
             else:
                 del self.callbacks[key]
+            self._compile(key)
+
+        for action, handlers in self.routes.items():
+            done = [cb for cb in handlers if not cb["name"] == plugin]
+            if len(done) != len(handlers):
+                self.routes[action] = done
+                self._compileRoute(action)
 
     def runCallback(self, callback, event):
-        if self.hasCallback(callback):
-            for cb in self.getCallbacks(callback):
+        table = self.tables.get(callback)
+        if table is not None:
+            return self._dispatch(callback, table, event)
+
+    def _dispatch(self, callback, table, event, position=0):
+        if self.tracer.events and self.tracer.callback(callback):
+            return self._traceCallback(callback, table, event, position)
+
+        functions, tails, _ = table
+        if not event.cancelled:
+            for function in functions[position:] if position else functions:
+                position += 1
                 try:
-                    self.logger.debug("Running callback: %s" % cb)
-                    if event.cancelled:
-                        if cb["cancelled"]:
-                            cb["function"](event)
-                        else:
-                            self.logger.debug("Not running, event is cancelled and handler doesn't accept cancelled " +
-                                              "events")
-                    else:
-                        cb["function"](event)
+                    result = function(event)
                 except Exception as e:
-                    self.logger.warn("Error running callback '%s': %s" % (callback, e))
-                    util.output_exception(self.logger, logging.WARN)
+                    self._error(callback, e)
+                else:
+                    if result is not None and isinstance(result, Deferred):
+                        return self._wait(result, callback, event, self._dispatch, table, position)
+                if event.cancelled:
+                    break
+            else:
+                return None
+
+        return self._dispatchCancelled(callback, tails[position], event)
+
+    def _dispatchCancelled(self, callback, tail, event, position=0):
+        for function in tail[position:] if position else tail:
+            position += 1
+            try:
+                result = function(event)
+            except Exception as e:
+                self._error(callback, e)
+            else:
+                if result is not None and isinstance(result, Deferred):
+                    return self._wait(result, callback, event, self._dispatchCancelled, tail, position)
+        return None
+
+    def _wait(self, deferred, callback, event, resume, table, position):
+        """
+        Wait for a handler's Deferred, then carry on from the next handler.
+        """
+        def failed(failure):
+            self.logger.warn("Error running callback '%s': %s" % (callback, failure.getErrorMessage()))
+            self.logger.warn(failure.getTraceback())
+
+        deferred.addErrback(failed)
+        deferred.addCallback(lambda _: resume(callback, table, event, position))
+        deferred.addCallback(lambda _: event)
+        return deferred
+
+    def _error(self, callback, e):
+        self.logger.warn("Error running callback '%s': %s" % (callback, e))
+        util.output_exception(self.logger, logging.WARN)
+
+    def _traceCallback(self, callback, table, event, position=0):
+        """
+        The slow version of runCallback, with debug output for every handler. Used when tracing is enabled.
+        """
+        handlers = table[2]
+        while position < len(handlers):
+            cb = handlers[position]
+            position += 1
+            try:
+                self.logger.debug("Running callback: %s" % cb)
+                if event.cancelled and not cb["cancelled"]:
+                    self.logger.debug("Not running, event is cancelled and handler doesn't accept cancelled events")
+                    continue
+                result = cb["function"](event)
+            except Exception as e:
+                self._error(callback, e)
+            else:
+                if isinstance(result, Deferred):
+                    self.logger.debug("Waiting for handler's Deferred")
+                    return self._wait(result, callback, event, self._traceCallback, table, position)
+        return None
+
+    def addRoute(self, action, plugin, function, priority, type=None, cancelled=False):
+        current = self.routes.setdefault(action, [])
+        for cb in current:
+            if cb["name"] == plugin.info.name and cb["type"] == type:
+                raise ValueError("Plugin '%s' has already registered a route for '%s' messages%s" %
+                                 (plugin.info.name, action, "" if type is None else " of type '%s'" % type))
+
+        data = {"name": plugin.info.name,
+                "type": type,
+                "function": function,
+                "priority": priority,
+                "cancelled": cancelled}
+
+        self.logger.debug("Adding route for '%s': %s" % (action, data))
+
+        current.append(data)
+        self._compileRoute(action)
+
+    def removeRoute(self, action, plugin, type=None):
+        current = self.routes.get(action)
+        if current:
+            self.routes[action] = [cb for cb in current if not (cb["name"] == plugin and cb["type"] == type)]
+            self._compileRoute(action)
+
+    def _compileRoute(self, action):
+        """
+        Rebuild the dispatch tables for an action. Call this whenever its routes change.
+        """
+        handlers = self._sort(self.routes.get(action) or [])
+        if not handlers:
+            self.routes.pop(action, None)
+            self.route_tables.pop(action, None)
+            return
+
+        self.routes[action] = handlers
+        untyped = [cb for cb in handlers if cb["type"] is None]
+        types = set(cb["type"] for cb in handlers if cb["type"] is not None)
+        typed = dict((type, self._table([cb for cb in handlers if cb["type"] in (None, type)])) for type in types)
+        self.route_tables[action] = (self._table(untyped), typed)
+
+    def route(self, event):
+        data = event.data
+        try:
+            action = data["action"]
+            untyped, typed = self.route_tables[action]
+        except (KeyError, TypeError):  # No action, no routes, or it isn't a dict
+            return False
+
+        table = untyped
+        if typed:
+            try:
+                table = typed.get(data.get("type"), untyped)
+            except TypeError:  # Unhashable type
+                pass
+
+        return self._dispatch(action, table, event)
 
 
 def manager():
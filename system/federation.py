@@ -0,0 +1,345 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+
+from collections import defaultdict, deque
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+from system import codec
+from system.bus import RemoteClient
+
+
+class PeerProtocol(LineReceiver):
+    """
+    A link to another node. The two ends prove to each other that they know the shared secret, without sending it
+        (see Federation.handshake()); after that, every line is a message envelope (see Federation).
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    node = None
+    challenge = None  # The other end's nonce
+
+    def connectionMade(self):
+        self.nonce = os.urandom(16).encode("hex")
+        if not self.factory.initiator:
+            self.sendLine(codec.encode({"nonce": self.nonce}))
+
+    def connectionLost(self, reason=None):
+        if self.node is not None:
+            self.federation.linkLost(self)
+
+    def lineReceived(self, line):
+        try:
+            data = codec.decode(line)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self.federation.logger.warn("Unable to parse message from peer %s: %s" % (self.node, line))
+            if self.node is None:
+                self.transport.loseConnection()
+            return
+
+        if self.node is None:
+            self.federation.handshake(self, data)
+        else:
+            self.federation.envelopeReceived(self, data)
+
+    @property
+    def federation(self):
+        return self.factory.federation
+
+
+class PeerFactory(Factory):
+    protocol = PeerProtocol
+    initiator = False
+
+    def __init__(self, federation):
+        self.federation = federation
+
+
+class PeerClientFactory(ReconnectingClientFactory):
+    protocol = PeerProtocol
+    maxDelay = 30
+    initiator = True
+
+    def __init__(self, federation):
+        self.federation = federation
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+
+class Federation(object):
+    """
+    Federation - links this Inter instance (a node) with others, so that they behave as one logical cluster.
+
+    Nodes connect to each other over TCP as peers. Each node announces the servers that authenticate with it, and adds
+        the servers announced by other nodes to its registry as RemoteClient objects - so `factory.servers`, the
+        duplicate API key check and targeted sends see the whole cluster. Broadcasts are passed on to every node, and
+        plugins can share state of their own the same way they do between workers (see system/bus.py); the players
+        plugin uses this for player presence.
+
+    Messages are flooded across the peer graph, so nodes don't have to be connected to every other node. Every message
+        carries a unique ID (the origin node's name plus a sequence number), and each node remembers the last
+        `seen_size` IDs it has handled, dropping repeats - so loops in the graph are harmless. Targeted messages go
+        along the link we first heard from their destination node on, if there is one, and are flooded otherwise.
+
+    If a link to a node goes down, its servers are forgotten, and the other nodes are told to do the same unless they
+        have a link of their own to it. A full mesh (every node listing every other node as a peer) or a tree work
+        best; in other topologies, membership recovers when the lost node next links up.
+
+    Configuration, from federation.yml (add "federation: federation.yml" to mapping.yml):
+        node:      This node's name. Must be unique in the cluster.
+        secret:    A shared secret. Peers that don't know it are disconnected. It's never sent over the network.
+        port:      The port to listen for peers on. Leave this out to only make outgoing links.
+        interface: The interface to listen for peers on. Defaults to all of them.
+        peers:     A list of {host, port} mappings: the nodes to link up with.
+
+    Federation is only available in single-process mode; it isn't started if `workers` is set above 1.
+
+    A link starts with a challenge and response, so that the secret never crosses the wire, and the side that was
+        connected to gives nothing away until the side that connected has proven itself:
+        1. The listening side sends {"nonce": Nl}.
+        2. The connecting side replies with {"node": its name, "nonce": Nc, "proof": P("initiator", its name, Nl, Nc)}.
+        3. If that proof is right, the listening side replies with {"node": its name, "proof": P("listener", its name,
+           Nc, Nl)}, and the link is up. The connecting side checks that proof in turn.
+        Nonces are random hex strings, and P is a hex HMAC-SHA256, keyed with the secret, of its arguments joined by
+        "|". Anything else, or a wrong proof, gets the link dropped.
+
+    Envelopes are JSON lines of the form {"id", "origin", "to", "channel", "message"}. The core channels are:
+        broadcast - A broadcast from a node, to be sent to our clients.
+        send      - A message for a client that's connected to us.
+        server    - Servers that authenticated with ("add") or left ("remove") a node, or all of a node's servers
+                    ("sync").
+        joined    - A node linked up with the cluster. We send it our servers.
+        lost      - A node's link went down.
+
+    Public methods:
+        publish(channel, message, to=None)  Publish a message to every node, or just to the node named `to`.
+        subscribe(channel, function)        Call function(node, message) for each message on a channel.
+        announce(protocol)                  Tell the other nodes about a server that authenticated here.
+        retract(protocol)                   Tell the other nodes that a server here is gone.
+    """
+
+    kind = "node"
+    seen_size = 65536
+
+    def __init__(self, settings):
+        self.logger = logging.getLogger("Federation")
+        self.node = str(settings["node"])
+        self.secret = str(settings.get("secret", ""))
+        self.settings = settings
+        self.factory = None
+
+        self.links = []
+        self.routes = {}
+        self.remotes = {}
+        self.subscribers = defaultdict(list)
+
+        self.sequence = itertools.count(1)
+        self.seen = set()
+        self.seen_order = deque()
+
+        self.subscribe("broadcast", self.onBroadcast)
+        self.subscribe("send", self.onSend)
+        self.subscribe("server", self.onServer)
+        self.subscribe("joined", self.onJoined)
+        self.subscribe("lost", self.onLost)
+
+    def start(self, factory):
+        """
+        Start listening for and linking up with peers. The CoreFactory does this when federation is configured.
+        """
+        self.factory = factory
+        if self.settings.get("port"):
+            reactor.listenTCP(self.settings["port"], PeerFactory(self), interface=self.settings.get("interface", ""))
+            self.logger.info("Listening for peers on port %s." % self.settings["port"])
+        for peer in self.settings.get("peers") or []:
+            reactor.connectTCP(peer["host"], peer["port"], PeerClientFactory(self))
+
+    # Links
+
+    def proof(self, role, node, *nonces):
+        return hmac.new(self.secret, "|".join((role, node) + nonces), hashlib.sha256).hexdigest()
+
+    def handshake(self, protocol, data):
+        nonce, proof = _text(data.get("nonce")), _text(data.get("proof"))
+        if protocol.factory.initiator and protocol.challenge is None:
+            # The listening side's challenge; answer it, and challenge it back
+            if not nonce:
+                return self.reject(protocol, "Peer sent an invalid challenge")
+            protocol.challenge = nonce
+            protocol.sendLine(codec.encode({"node": self.node, "nonce": protocol.nonce,
+                                            "proof": self.proof("initiator", self.node, nonce, protocol.nonce)}))
+            return
+
+        node = data.get("node")
+        name = _text(node)
+        if not name or name == self.node:
+            return self.reject(protocol, "Peer has an invalid node name (%s)" % node)
+        if protocol.factory.initiator:
+            expected = self.proof("listener", name, protocol.nonce, protocol.challenge)
+        elif nonce:
+            expected = self.proof("initiator", name, protocol.nonce, nonce)
+        else:
+            return self.reject(protocol, "Peer %s sent an invalid challenge" % name)
+        if not proof or not hmac.compare_digest(proof, expected):
+            return self.reject(protocol, "Peer %s doesn't know the secret" % name)
+
+        if not protocol.factory.initiator:
+            protocol.sendLine(codec.encode({"node": self.node,
+                                            "proof": self.proof("listener", self.node, nonce, protocol.nonce)}))
+        self.link(protocol, node)
+
+    def reject(self, protocol, reason):
+        self.logger.warn("%s; disconnecting." % reason)
+        protocol.transport.loseConnection()
+
+    def link(self, protocol, node):
+        protocol.node = node
+        self.links.append(protocol)
+        self.routes[node] = protocol
+        self.logger.info("Linked up with node %s." % node)
+        self.publish("joined", {})
+
+    def linkLost(self, protocol):
+        if protocol in self.links:
+            self.links.remove(protocol)
+        for node, link in self.routes.items():
+            if link is protocol:
+                del self.routes[node]
+        self.logger.info("Lost link to node %s." % protocol.node)
+
+        if not self.linked(protocol.node):
+            self.forget(protocol.node)
+            self.publish("lost", {"node": protocol.node})
+
+    def linked(self, node):
+        for link in self.links:
+            if link.node == node:
+                return True
+        return False
+
+    def forget(self, node):
+        for name, remote in self.remotes.items():
+            if remote.owner == node:
+                del self.remotes[name]
+                self.factory.clients.remove_remote(remote)
+
+    # Messages
+
+    def publish(self, channel, message, to=None):
+        envelope = {"id": "%s:%s" % (self.node, next(self.sequence)), "origin": self.node, "to": to,
+                    "channel": channel, "message": message}
+        self.remember(envelope["id"])
+        self.forward(envelope, codec.encode(envelope), None)
+
+    def subscribe(self, channel, function):
+        self.subscribers[channel].append(function)
+
+    def remember(self, id):
+        self.seen.add(id)
+        self.seen_order.append(id)
+        if len(self.seen_order) > self.seen_size:
+            self.seen.discard(self.seen_order.popleft())
+
+    def forward(self, envelope, line, source):
+        to = envelope["to"]
+        if to is not None:
+            link = self.routes.get(to)
+            if link is not None and link is not source:
+                link.sendLine(line)
+                return
+        for link in self.links:
+            if link is not source:
+                link.sendLine(line)
+
+    def envelopeReceived(self, protocol, envelope):
+        id = envelope.get("id")
+        if id is None or id in self.seen:
+            return
+        self.remember(id)
+
+        origin = envelope["origin"]
+        if origin not in self.routes:
+            self.routes[origin] = protocol
+
+        to = envelope.get("to")
+        if to != self.node:
+            self.forward(envelope, codec.encode(envelope), protocol)
+        if to is None or to == self.node:
+            for function in self.subscribers.get(envelope["channel"], ()):
+                try:
+                    function(origin, envelope["message"])
+                except Exception:
+                    self.logger.exception("Error handling message on federation channel '%s'" % envelope["channel"])
+
+    def announce(self, protocol):
+        if not protocol.not_server:
+            self.publish("server", {"type": "add", "name": protocol.name, "api_key": protocol.api_key})
+
+    def retract(self, protocol):
+        if not protocol.not_server:
+            self.publish("server", {"type": "remove", "name": protocol.name})
+
+    # Core channels
+
+    def onBroadcast(self, node, message):
+        key = message.get("key")
+        if isinstance(key, list):
+            key = tuple(key)
+        self.factory.broadcast(message["message"], authenticated=message.get("authenticated", False),
+                               servers=message.get("servers", False), kind=message.get("kind"), key=key, source=self)
+
+    def onSend(self, node, message):
+        protocol = self.factory.clients.get_by_name(message["name"])
+        if protocol is not None and not protocol.remote:
+            key = message.get("key")
+            if isinstance(key, list):
+                key = tuple(key)
+            protocol.send(message["message"], kind=message.get("kind"), key=key)
+
+    def onServer(self, node, message):
+        if message["type"] == "sync":
+            for server in message["servers"]:
+                self.add(node, server)
+        elif message["type"] == "add":
+            self.add(node, message)
+        else:
+            remote = self.remotes.get(message["name"])
+            if remote is not None and remote.owner == node:
+                del self.remotes[message["name"]]
+                self.factory.clients.remove_remote(remote)
+
+    def add(self, node, server):
+        remote = self.remotes.get(server["name"])
+        if remote is None or remote.owner != node:
+            remote = RemoteClient(self, node, None, server["name"], server["api_key"])
+            self.remotes[remote.name] = remote
+        self.factory.clients.add_remote(remote)
+
+    def onJoined(self, node, message):
+        servers = [{"name": server.name, "api_key": server.api_key}
+                   for server in self.factory.clients.recipients(servers=True)]
+        self.publish("server", {"type": "sync", "servers": servers}, to=node)
+
+    def onLost(self, node, message):
+        if message["node"] != self.node and not self.linked(message["node"]):
+            self.forget(message["node"])
+
+
+def _text(value):
+    # A string from a handshake message as UTF-8 bytes, or None if it isn't a string
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, str):
+        return value
+    return None
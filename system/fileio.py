@@ -0,0 +1,179 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import os
+import stat
+import tempfile
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from system.decorators import Singleton
+
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomic(filename, data):
+    """
+    Write a string to a file atomically: it's written to a temporary file in the same directory, which is then renamed
+        over the original. Anyone reading the file sees either the old version or the new one, never half of one.
+    :param filename: The file to write to.
+    :param data:     The string to write.
+    """
+    directory = os.path.dirname(filename) or "."
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    fd, temp = tempfile.mkstemp(prefix=".%s." % os.path.basename(filename), suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.path.exists(filename):
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        else:
+            mode = 0666 & ~_UMASK
+        os.chmod(temp, mode)  # mkstemp creates files that only we can read
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)  # Windows won't rename over an existing file
+        os.rename(temp, filename)
+    except Exception:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def read(filename):
+    """
+    Read a whole file into a string.
+    """
+    with open(filename, "r") as fh:
+        return fh.read()
+
+
+@Singleton
+class FileIO(object):
+    """
+    FileIO - A singleton that does file I/O on a dedicated thread, so the reactor never waits on the disk.
+    Use the io() function at the bottom of this file or FileIO.Instance() to get an instance of this.
+
+    Everything runs on a single I/O thread, one operation at a time, and both methods return Deferreds that fire on
+        the reactor thread.
+
+    Concurrent requests for the same file are collapsed:
+        - Loading a file that's already being loaded doesn't read it again; everyone gets the same result.
+        - Saving a file that's already being saved waits for that save to finish, and then writes only the newest
+          data it's been given. Everyone that asked for a save in the meantime is told once that last write is done.
+
+    system.config and system.storage use this for their *_async methods.
+
+    Public methods:
+        load(filename, parse)       Read a file and parse it with parse(string) on the I/O thread. Pass `loader`
+                                        instead to load it with loader(filename), eg to check a cache first.
+        save(filename, data, dump)  Serialize data with dump(data) now, and write it atomically on the I/O thread.
+        run(function, *args)        Run any other file I/O on the I/O thread. Nothing is collapsed.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("FileIO")
+        self.threadpool = None
+        self.loading = {}  # {filename: [Deferred, ...]}
+        self.saving = {}  # {filename: [text, [Deferred, ...]] for the next save, or None if there isn't one}
+
+    def _run(self, function, *args):
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(1, 1, "io")
+            self.threadpool.start()
+            reactor.addSystemEventTrigger("during", "shutdown", self.threadpool.stop)
+        return threads.deferToThreadPool(reactor, self.threadpool, function, *args)
+
+    def run(self, function, *args):
+        """
+        Run a function on the I/O thread.
+        :return: A Deferred that fires with the function's result, or fails with its exception.
+        """
+        return self._run(function, *args)
+
+    def load(self, filename, parse=None, loader=None):
+        """
+        Load a file.
+        :param filename: The path of the file to load.
+        :param parse:    A function to turn the file's contents into something useful, like yaml.load.
+        :param loader:   Instead of parse, a function that does the whole load, given the path. It's run on the I/O
+                             thread, and only once for loads of the same file that overlap.
+        :return:         A Deferred that fires with the parsed contents, or fails if the file couldn't be loaded.
+        """
+        d = defer.Deferred()
+        if filename in self.loading:
+            self.loading[filename].append(d)
+            return d
+
+        self.loading[filename] = [d]
+        if loader is None:
+            loader = lambda path: parse(read(path))
+        self._run(loader, filename).addBoth(self._loaded, filename)
+        return d
+
+    def _loaded(self, result, filename):
+        for d in self.loading.pop(filename):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def save(self, filename, data, dump):
+        """
+        Save a file atomically.
+        The data is serialized right away, on the calling thread, so it's safe to keep changing it afterwards; only
+            the resulting string is handed to the I/O thread.
+        :param filename: The path of the file to save to.
+        :param data:     The data to save.
+        :param dump:     A function to serialize the data to a string, like yaml.dump.
+        :return:         A Deferred that fires with True once the data (or newer data) is on disk, or fails if it
+                             couldn't be serialized or written.
+        """
+        try:
+            text = dump(data)
+        except Exception:
+            return defer.fail()
+
+        d = defer.Deferred()
+        if filename in self.saving:
+            pending = self.saving[filename]
+            if pending is None:
+                self.saving[filename] = [text, [d]]
+            else:
+                pending[0] = text
+                pending[1].append(d)
+            return d
+
+        self.saving[filename] = None
+        self._save(filename, text, [d])
+        return d
+
+    def _save(self, filename, text, waiting):
+        d = self._run(write_atomic, filename, text)
+        d.addBoth(self._saved, filename, waiting)
+
+    def _saved(self, result, filename, waiting):
+        failed = isinstance(result, Failure)
+        for d in waiting:
+            if failed:
+                d.errback(result)
+            else:
+                d.callback(True)
+
+        pending = self.saving.pop(filename)
+        if pending is not None:
+            self.saving[filename] = None
+            self._save(filename, *pending)
+
+
+def io():
+    """
+    Convenience method for getting an instance of the file I/O singleton.
+    """
+    return FileIO.Instance()
@@ -0,0 +1,117 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import time
+
+from twisted.internet import task
+from system.events import manager
+from system.events.event import pingSentEvent
+from system import codec
+
+
+class Heartbeat(object):
+    """
+    Heartbeat scheduler.
+    A single timing wheel, owned by the factory, that pings every connection once per `interval` seconds.
+
+    The wheel has `slots` buckets and ticks once every `interval / slots` seconds, pinging the connections in one
+        bucket per tick. New connections are dealt out to the buckets round-robin, so the pings (and the JSON they
+        need) are spread evenly across the interval instead of bunching up, and the reactor only ever has one delayed
+        call for the lot of them.
+
+    Every connection pinged in a tick gets the same timestamp, so the ping is only encoded once per tick (and wire
+        format). Outstanding pings are kept in each protocol's `pings` list, which never holds more than
+        `max_pings + 1` timestamps. Connections with more than `max_pings` unanswered pings when their bucket comes
+        around are dropped together.
+
+    Public methods:
+        start()              Start ticking. The factory does this when it starts listening.
+        stop()               Stop ticking.
+        add(protocol)        Start pinging a connection.
+        remove(protocol)     Stop pinging a connection.
+        pong(protocol, pong) Handle a pong from a connection. Returns False if we didn't send that ping.
+    """
+
+    timeout_frames = codec.constant({"error": "Ping timeout", "from": "core"})
+
+    def __init__(self, interval=30, slots=30, max_pings=2):
+        self.logger = logging.getLogger("Heartbeat")
+        self.events = manager.manager()
+        self.interval = float(interval)
+        self.slots = max(1, int(slots))
+        self.max_pings = max_pings
+
+        self.wheel = [{} for _ in xrange(self.slots)]
+        self.slot_of = {}
+        self.position = 0
+        self.next_slot = 0
+
+        self.loop = task.LoopingCall(self.tick)
+
+    def start(self):
+        if not self.loop.running:
+            self.loop.start(self.interval / self.slots, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def add(self, protocol):
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slots
+        self.wheel[slot][protocol.id] = protocol
+        self.slot_of[protocol.id] = slot
+
+    def remove(self, protocol):
+        slot = self.slot_of.pop(protocol.id, None)
+        if slot is not None:
+            self.wheel[slot].pop(protocol.id, None)
+
+    def pong(self, protocol, pong):
+        try:
+            protocol.pings.remove(pong)
+        except ValueError:
+            return False
+        return True
+
+    def tick(self):
+        bucket = self.wheel[self.position]
+        self.position = (self.position + 1) % self.slots
+        if not bucket:
+            return
+
+        now = str(time.time())
+        frames = codec.Frames({"from": "ping", "timestamp": now})
+        notify = self.events.hasCallback("pingSent")
+        timed_out = []
+
+        for protocol in bucket.values():
+            if not protocol.connected:
+                continue
+            if len(protocol.pings) > self.max_pings:
+                timed_out.append(protocol)
+                continue
+
+            if protocol.tracing:
+                protocol.debug("Sending ping: %s" % now)
+            protocol.writeFrame(frames[protocol.wire])
+            protocol.pings.append(now)
+
+            if notify:
+                self.events.runCallback("pingSent", pingSentEvent(protocol, now))
+
+        if timed_out:
+            self.timeout(timed_out)
+
+    def timeout(self, protocols):
+        """
+        Drop a group of connections that haven't answered their pings.
+        :param protocols: The protocols to drop.
+        """
+        self.logger.info("Dropping %s connections: Ping timeout." % len(protocols))
+        for protocol in protocols:
+            self.remove(protocol)
+            protocol.info("Disconnecting: Ping timeout.")
+            protocol.writeFrame(self.timeout_frames[protocol.wire])
+            protocol.transport.loseConnection()
@@ -0,0 +1,201 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import os
+import sqlite3
+import threading
+
+from system import codec
+from system.fileio import write_atomic
+
+DELETED = object()  # Marks a deleted key in write batches and the read cache
+
+# Backends are given batches of {(namespace, key): value} changes to commit, where each value is a string of JSON or
+# DELETED, and hand back decoded values (or DELETED, for keys that aren't set) from get(). Values are encoded when
+# they're put, so that a value that can't be encoded is the caller's problem, rather than the whole batch's.
+
+
+class SQLiteBackend(object):
+    """
+    Key-value storage in a single SQLite database, in write-ahead logging mode.
+
+    Commits happen on the file I/O thread, with their own connection; reads happen on the reactor thread with another.
+        WAL lets the reader carry on while a commit is being written, so reads never wait for the disk to sync. This
+        is also safe to share between worker processes. Each worker's read cache is kept up to date over the bus
+        (see system/storage.py).
+
+    Settings:
+        path:        The database file. Defaults to data/storage.sqlite.
+        synchronous: SQLite's `synchronous` pragma. Defaults to NORMAL, which can lose the last commit (but never
+                     corrupts the database) if the machine loses power.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, settings):
+        self.path = settings.get("path", "data/storage.sqlite")
+        self.synchronous = settings.get("synchronous", "NORMAL")
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.reader = self._connect(True)
+        self.reader.execute("CREATE TABLE IF NOT EXISTS storage (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                            "value TEXT NOT NULL, PRIMARY KEY (namespace, key))")
+        self.reader.commit()
+        self.writer = None
+
+    def _connect(self, same_thread):
+        connection = sqlite3.connect(self.path, check_same_thread=same_thread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=%s" % self.synchronous)
+        return connection
+
+    def get(self, namespace, key):
+        row = self.reader.execute("SELECT value FROM storage WHERE namespace = ? AND key = ?",
+                                  (namespace, key)).fetchone()
+        if row is None:
+            return DELETED
+        return codec.decode(row[0])
+
+    def keys(self, namespace):
+        return [row[0] for row in self.reader.execute("SELECT key FROM storage WHERE namespace = ?", (namespace,))]
+
+    def commit(self, batch):
+        if self.writer is None:
+            self.writer = self._connect(False)
+        puts = []
+        deletes = []
+        for (namespace, key), value in batch.iteritems():
+            if value is DELETED:
+                deletes.append((namespace, key))
+            else:
+                puts.append((namespace, key, value))
+
+        with self.writer:
+            self.writer.executemany("DELETE FROM storage WHERE namespace = ? AND key = ?", deletes)
+            self.writer.executemany("INSERT OR REPLACE INTO storage (namespace, key, value) VALUES (?, ?, ?)", puts)
+
+    def close(self):
+        self.reader.close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LogBackend(object):
+    """
+    Key-value storage in an append-only log, with everything also held in memory.
+
+    Each commit (on the file I/O thread) appends a JSON line per change - [namespace, key, value] for puts, and
+        [namespace, key] for deletes - and fsyncs the log, so it only costs as much as the changes themselves. A torn
+        line at the end of the log, left by a crash mid-commit, is ignored when it's replayed. Once the log is more
+        than `compact_ratio` times the size of the live data (and at least `compact_size` bytes), it's compacted, by
+        atomically replacing it with a snapshot of the live data.
+
+    Reads happen on the reactor thread while commits change the data on the I/O thread, so both hold `lock` while
+        they touch it; it's never held while writing or syncing the log.
+
+    Every key is kept in memory, so this suits smaller datasets. It isn't safe to share between worker processes; use
+        the sqlite backend for those.
+
+    Settings:
+        path:          The log file. Defaults to data/storage.log.
+        compact_ratio: Defaults to 4.
+        compact_size:  Defaults to 1048576 (1 MB).
+    """
+
+    name = "log"
+
+    def __init__(self, settings):
+        self.logger = logging.getLogger("Storage")
+        self.path = settings.get("path", "data/storage.log")
+        self.compact_ratio = settings.get("compact_ratio", 4)
+        self.compact_size = settings.get("compact_size", 1024 * 1024)
+        self.data = {}  # {namespace: {key: JSON}}
+        self.lock = threading.Lock()  # Guards self.data
+        self.size = 0
+        self.threshold = self.compact_size  # The log size at which we next check whether it's worth compacting
+        self.replay()
+        self.fh = open(self.path, "ab")
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            return
+
+        good = 0
+        with open(self.path, "rb") as fh:
+            for line in fh:
+                try:
+                    entry = codec.decode(line)
+                except ValueError:
+                    self.logger.warn("Ignoring %s bytes of torn data at the end of %s." %
+                                     (os.path.getsize(self.path) - good, self.path))
+                    break
+                good += len(line)
+                if len(entry) == 3:
+                    self.data.setdefault(entry[0], {})[entry[1]] = codec.encode(entry[2])
+                else:
+                    self.data.get(entry[0], {}).pop(entry[1], None)
+        if good != os.path.getsize(self.path):
+            with open(self.path, "r+b") as fh:
+                fh.truncate(good)
+        self.size = good
+
+    def get(self, namespace, key):
+        with self.lock:
+            value = self.data.get(namespace, {}).get(key)
+        if value is None:
+            return DELETED
+        return codec.decode(value)
+
+    def keys(self, namespace):
+        with self.lock:
+            return list(self.data.get(namespace, ()))
+
+    def commit(self, batch):
+        lines = []
+        with self.lock:
+            for (namespace, key), value in batch.iteritems():
+                prefix = codec.encode(namespace) + "," + codec.encode(key)
+                if value is DELETED:
+                    lines.append("[%s]\n" % prefix)
+                    self.data.get(namespace, {}).pop(key, None)
+                else:
+                    lines.append("[%s,%s]\n" % (prefix, value))
+                    self.data.setdefault(namespace, {})[key] = value
+
+        data = "".join(lines)
+        self.fh.write(data)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.size += len(data)
+
+        if self.size >= self.threshold:
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            lines = ["[%s,%s,%s]\n" % (codec.encode(namespace), codec.encode(key), value)
+                     for namespace, keys in self.data.items() for key, value in keys.items()]
+        live = sum(len(line) for line in lines)
+        if self.size < live * self.compact_ratio:
+            self.threshold = live * self.compact_ratio
+            return
+
+        data = "".join(lines)
+        write_atomic(self.path, data)
+        self.fh.close()
+        self.fh = open(self.path, "ab")
+        self.logger.info("Compacted %s from %s to %s bytes." % (self.path, self.size, len(data)))
+        self.size = len(data)
+        self.threshold = max(self.compact_size, self.size * self.compact_ratio)
+
+    def close(self):
+        self.fh.close()
+
+
+BACKENDS = {SQLiteBackend.name: SQLiteBackend, LogBackend.name: LogBackend}
@@ -0,0 +1,245 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+
+from collections import deque
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+from system import codec
+
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+FORCED = "forced"  # Not a policy: a disconnect because the other policies couldn't free enough space
+
+
+class OutboundSettings(object):
+    """
+    Outbound queue settings, shared by every connection of a factory.
+
+    These come from the `outbound` section of the networking configuration:
+        high:     Queue size in bytes at which the overflow policies kick in. Defaults to 1MiB.
+        low:      Queue size in bytes that the policies try to get back down to. Defaults to half of `high`.
+        policies: A {message class: policy} dict. Message classes are whatever senders pass as `kind`; messages
+                  without one use the `default` class. Policies are:
+                      drop-oldest - Drop the oldest queued messages of this class.
+                      coalesce    - Only keep the newest queued message for each key of this class.
+                      disconnect  - Disconnect the client with an error if, once the other policies have run,
+                                    more than `low` bytes of messages of this class are still queued.
+                  Defaults to {chat: drop-oldest, players: coalesce, default: disconnect}.
+        coalesce: Set this to true to buffer everything written to a connection during a reactor iteration, and
+                  write it out with a single writeSequence at the start of the next one. Defaults to false.
+
+    `stats` counts how often each policy kicked in: messages dropped, messages coalesced away and clients
+        disconnected by the disconnect policy. Clients that had to be disconnected because dropping and coalescing
+        didn't free enough space are counted separately, under `forced`.
+    """
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+        self.logger = logging.getLogger("Outbound")
+
+        self.high = int(settings.get("high", 1024 * 1024))
+        self.low = int(settings.get("low", self.high // 2))
+
+        self.policies = {"chat": DROP_OLDEST, "players": COALESCE, "default": DISCONNECT}
+        self.policies.update(settings.get("policies") or {})
+        for kind, policy in self.policies.items():
+            if policy not in POLICIES:
+                self.logger.warn("Unknown outbound policy for '%s': %s - using %s" % (kind, policy, DISCONNECT))
+                self.policies[kind] = DISCONNECT
+
+        self.stats = dict((policy, 0) for policy in POLICIES + (FORCED,))
+        self.coalescer = WriteCoalescer() if settings.get("coalesce", False) else None
+
+    def policy(self, kind):
+        return self.policies.get(kind) or self.policies["default"]
+
+
+class WriteCoalescer(object):
+    """
+    Collects the outbound queues that were written to during a reactor iteration, and flushes each of them once,
+        at the start of the next one.
+
+    The flush is scheduled with callLater(0), since Twisted has no hook for the end of an iteration. Timed calls run
+        once the reactor has handled everything that came in on the last poll, and a pending one makes the next poll
+        return straight away. So the frames go out after every message read in the same iteration has been handled,
+        and before the reactor waits for more I/O; a client never waits on them for longer than that.
+
+    When an inbound message fans out into several outbound ones, this turns one transport write per message into
+        one writeSequence per connection, so syscalls and TCP segments scale with connections instead of messages.
+    """
+
+    def __init__(self):
+        self.dirty = []
+        self.call = None
+
+    def mark(self, queue):
+        self.dirty.append(queue)
+        if self.call is None:
+            self.call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.call = None
+        dirty, self.dirty = self.dirty, []
+        for queue in dirty:
+            queue.flush()
+
+
+class RawFrame(str):
+    """
+    A frame that was queued before compression was switched on, and must be written out as it is.
+    """
+
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """
+    A bounded outbound queue for a single connection.
+
+    The queue registers itself as a streaming producer with the connection's transport. While the transport is
+        keeping up, frames are written straight through. Once the transport's own buffer fills up it pauses us, and
+        frames are queued here instead, to be written out when it resumes us.
+
+    If the queue grows past the high watermark, the overflow policies of the message classes that are queued are
+        applied: messages are coalesced, and then dropped until the queue is back below the low watermark. If more
+        than `low` bytes of messages whose class is `disconnect` are left after that, the client is disconnected;
+        a few stray frames of those classes (a ping, an error reply) don't count against it. If the queue is still
+        above the high watermark, the client is too slow to keep, and is disconnected anyway.
+
+    If write coalescing is enabled, frames written while the transport is keeping up are held in `pending` until
+        the coalescer flushes them at the start of the next reactor iteration.
+
+    If the connection has negotiated compression, frames are compressed as they're handed to the transport rather
+        than when they're queued. A compressed stream can't have frames dropped from the middle of it, so this keeps
+        the overflow policies working on plain frames.
+    """
+
+    overflow_frames = codec.constant({"error": "Outbound queue overflow", "from": "core"})
+
+    def __init__(self, protocol, settings):
+        self.protocol = protocol
+        self.settings = settings
+        self.frames = deque()
+        self.size = 0
+        self.paused = False
+        self.dropped = False
+        self.coalescer = settings.coalescer
+        self.pending = []
+        self.compress = None
+
+    def compressWith(self, stream):
+        """
+        Start compressing frames with a wire.ZlibStream. Anything already queued was framed for the old wire format,
+            so it goes out as it is.
+        """
+        self.frames = deque((RawFrame(frame), kind, key) for frame, kind, key in self.frames)
+        self.pending = [RawFrame(frame) for frame in self.pending]
+        self.compress = stream.compress
+
+    def _prepare(self, frame):
+        if self.compress is None or type(frame) is RawFrame:
+            return frame
+        return self.compress(frame)
+
+    def write(self, frame, kind=None, key=None):
+        if self.dropped:
+            return
+        if not self.paused and not self.frames:
+            if self.coalescer is None:
+                self.protocol.transport.write(self._prepare(frame))
+            else:
+                if not self.pending:
+                    self.coalescer.mark(self)
+                self.pending.append(frame)
+            return
+
+        self.frames.append((frame, kind, key))
+        self.size += len(frame)
+        if self.size > self.settings.high:
+            self.overflow()
+
+    def overflow(self):
+        settings = self.settings
+        policies = dict((kind, settings.policy(kind)) for _, kind, _ in self.frames)
+
+        if COALESCE in policies.values():
+            seen = set()
+            kept = deque()
+            for entry in reversed(self.frames):
+                frame, kind, key = entry
+                if key is not None and policies[kind] == COALESCE:
+                    if (kind, key) in seen:
+                        self.size -= len(frame)
+                        settings.stats[COALESCE] += 1
+                        continue
+                    seen.add((kind, key))
+                kept.appendleft(entry)
+            self.frames = kept
+
+        if self.size > settings.low and DROP_OLDEST in policies.values():
+            kept = deque()
+            for entry in self.frames:
+                frame, kind, key = entry
+                if self.size > settings.low and policies[kind] == DROP_OLDEST:
+                    self.size -= len(frame)
+                    settings.stats[DROP_OLDEST] += 1
+                    continue
+                kept.append(entry)
+            self.frames = kept
+
+        if DISCONNECT in policies.values():
+            stuck = sum(len(frame) for frame, kind, _ in self.frames if policies[kind] == DISCONNECT)
+            if stuck > settings.low:
+                kinds = sorted(set(str(kind or "default") for kind, policy in policies.items() if policy == DISCONNECT))
+                self.disconnect(DISCONNECT, "Client isn't reading fast enough (%s bytes of %s messages queued)." %
+                                (stuck, ", ".join(kinds)))
+                return
+
+        if self.size > settings.high:
+            self.disconnect(FORCED, "Client isn't reading fast enough (%s bytes queued, after dropping and "
+                                    "coalescing)." % self.size)
+
+    def disconnect(self, reason, message):
+        """
+        Disconnect the client with an overflow error, counting it in the stats under `reason`.
+        """
+        self.settings.stats[reason] += 1
+        self.protocol.warn("Disconnecting: %s" % message)
+        self.stopProducing()
+        self.dropped = True
+        self.protocol.transport.write(self._prepare(self.overflow_frames[self.protocol.wire]))
+        self.protocol.transport.loseConnection()
+
+    def flush(self):
+        """
+        Write out everything that was buffered by write coalescing.
+        """
+        if self.pending and not self.dropped:
+            pending, self.pending = self.pending, []
+            if self.compress is not None:
+                pending = [self._prepare(frame) for frame in pending]
+            self.protocol.transport.writeSequence(pending)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        frames = self.frames
+        write = self.protocol.transport.write
+        while frames and not self.paused:
+            frame = frames.popleft()[0]
+            self.size -= len(frame)
+            write(self._prepare(frame))
+
+    def stopProducing(self):
+        self.frames.clear()
+        self.size = 0
+        self.pending = []
@@ -3,6 +3,7 @@ __author__ = "Gareth Coles"
 
 import logging
 from yapsy.IPlugin import IPlugin
+from system.storage import data
 
 
 class Plugin(IPlugin):
@@ -19,6 +20,8 @@ class Plugin(IPlugin):
       - Do any required setup of your plugin here.
 
     Optionally, you can override the `activate` method, but this is not required and should not be used for setup.
+
+    Once setup has been called, `store` is your plugin's own namespace in the key-value store (see system/storage.py).
     """
 
     def __init__(self):
@@ -41,6 +44,13 @@ class Plugin(IPlugin):
         self.logger = logging.getLogger(self.module.title())
         self.factory = factory
 
+    @property
+    def store(self):
+        """
+        This plugin's namespace in the key-value store.
+        """
+        return data().namespace(self.info.name)
+
     def activate(self):
         """
         Called when the plugin is loaded. Not to be used for setup!
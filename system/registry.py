@@ -0,0 +1,224 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import itertools
+import logging
+
+from system.events import manager
+from system.events.event import serverRemovedEvent
+
+
+class ClientRegistry(object):
+    """
+    Connection registry.
+    This class keeps track of every connected protocol object, along with a set of secondary indexes that are kept
+        up to date as clients connect, authenticate and disconnect. The factory owns one of these as `clients`.
+
+    All lookups are dict lookups, and the recipient lists used for broadcasting are built once and cached until
+        the registry changes, so iterating over "all authenticated servers" only costs as much as the servers
+        themselves.
+
+    Iterating over the registry (`for client in factory.clients`) yields every connected protocol, and is safe to do
+        while clients are being added or removed.
+
+    `relays` holds the factory's relays to other processes: the worker bus in multi-process mode (system/bus.py),
+        and the federation link to other nodes (system/federation.py). Clients that authenticate here are announced
+        on each of them, and authenticated clients elsewhere are added here as RemoteClient objects. These show up in
+        `by_name`, `by_key` and `servers`, so lookups see the whole network, but never in the recipient lists;
+        broadcasts reach them through the relays instead.
+
+    Whenever a server (local or remote) is removed from `servers`, a `serverRemoved` event is fired, so plugins that
+        keep per-server state can clean it up in one place.
+
+    Public methods:
+        add(protocol)                                       Register a newly-built protocol and assign it an ID.
+        remove(protocol)                                    Forget about a protocol. Does nothing if it's unknown.
+        authenticate(protocol, name, api_key, not_server)   Mark a protocol as authenticated and index it.
+        get(id)                                             Get a protocol by connection ID, or None.
+        get_by_name(name)                                   Get an authenticated protocol by name, or None.
+        get_by_key(api_key)                                 Get an authenticated protocol by API key, or None.
+        recipients(authenticated=False, servers=False)      Get a cached tuple of protocols to send to.
+        add_remote(client)                                  Index a client connected to another worker or node.
+        remove_remote(client)                               Forget about a client connected to another worker or node.
+
+    Public attributes (treat these as read-only, use the methods above to modify them):
+        by_id         {id: protocol} for every connected protocol.
+        by_name       {name: protocol} for authenticated protocols.
+        by_key        {api_key: protocol} for authenticated protocols.
+        authenticated {id: protocol} for authenticated protocols.
+        not_servers   {id: protocol} for authenticated protocols flagged with `not_server`.
+        servers       {name: protocol} for authenticated protocols that are servers. This is the factory's `servers`.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Registry")
+        self._ids = itertools.count(1)
+        self._cache = {}
+        self.relays = []
+
+        self.by_id = {}
+        self.by_name = {}
+        self.by_key = {}
+        self.authenticated = {}
+        self.not_servers = {}
+        self.servers = {}
+
+    def __contains__(self, protocol):
+        return self.by_id.get(protocol.id) is protocol
+
+    def __iter__(self):
+        return iter(self.recipients())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _changed(self):
+        self._cache = {}
+
+    def add(self, protocol):
+        """
+        Register a protocol and give it a connection ID.
+        :param protocol: The protocol object to register.
+        :return:         The protocol's new ID.
+        """
+        protocol.id = next(self._ids)
+        self.by_id[protocol.id] = protocol
+        self._changed()
+        return protocol.id
+
+    def remove(self, protocol):
+        """
+        Remove a protocol from the registry and all of its indexes.
+        :param protocol: The protocol object to remove.
+        """
+        if self.by_id.get(protocol.id) is not protocol:
+            return
+
+        del self.by_id[protocol.id]
+        removed = self._unindex(protocol)
+        self._changed()
+        if removed:
+            manager.manager().runCallback("serverRemoved", serverRemovedEvent(protocol))
+
+    def authenticate(self, protocol, name, api_key, not_server=False):
+        """
+        Mark a protocol as authenticated, setting its `authenticated`, `name`, `api_key` and `not_server` attributes.
+        Servers are added to the `servers` dict; clients flagged with `not_server` are not.
+        :param protocol:   The protocol object that authenticated.
+        :param name:       The name the API key maps to.
+        :param api_key:    The API key that was used.
+        :param not_server: Whether the client is something other than a server (a web client, for example).
+        """
+        if self._unindex(protocol):
+            self._changed()
+            manager.manager().runCallback("serverRemoved", serverRemovedEvent(protocol))
+
+        protocol.authenticated = True
+        protocol.name = name
+        protocol.api_key = api_key
+        protocol.not_server = bool(not_server)
+
+        self.authenticated[protocol.id] = protocol
+        self.by_name[name] = protocol
+        self.by_key[api_key] = protocol
+
+        if protocol.not_server:
+            self.not_servers[protocol.id] = protocol
+        else:
+            self.servers[name] = protocol
+        self._changed()
+
+        for relay in self.relays:
+            relay.announce(protocol)
+
+    def _unindex(self, protocol):
+        # Returns True if the protocol was removed from `servers`
+        if self.authenticated.pop(protocol.id, None) is None:
+            return False
+        for relay in self.relays:
+            relay.retract(protocol)
+        self.not_servers.pop(protocol.id, None)
+
+        name = getattr(protocol, "name", None)
+        if self.by_name.get(name) is protocol:
+            del self.by_name[name]
+        if self.servers.get(name) is protocol:
+            del self.servers[name]
+            self.logger.debug("Removed server '%s' from servers dict." % name)
+            removed = True
+        else:
+            removed = False
+
+        api_key = getattr(protocol, "api_key", None)
+        if self.by_key.get(api_key) is protocol:
+            del self.by_key[api_key]
+        return removed
+
+    def get(self, id):
+        return self.by_id.get(id)
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_key(self, api_key):
+        return self.by_key.get(api_key)
+
+    def recipients(self, authenticated=False, servers=False):
+        """
+        Get a tuple of protocols to send something to.
+        The tuple is cached until the next time a client connects, authenticates or disconnects.
+        :param authenticated: Only include authenticated clients.
+        :param servers:       Only include authenticated servers.
+        """
+        if servers:
+            key = "servers"
+        elif authenticated:
+            key = "authenticated"
+        else:
+            key = "all"
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        if key == "servers":
+            result = tuple(client for client in self.servers.values() if not client.remote)
+        elif key == "authenticated":
+            result = tuple(self.authenticated.values())
+        else:
+            result = tuple(self.by_id.values())
+
+        self._cache[key] = result
+        return result
+
+    def add_remote(self, client):
+        """
+        Index an authenticated client that's connected to another worker or node.
+        :param client: The system.bus.RemoteClient standing in for it.
+        """
+        if client.name in self.by_name and not self.by_name[client.name].remote:
+            self.logger.warn("%s is connected here and on %s %s; ignoring the remote one." %
+                             (client.name, client.relay.kind, client.owner))
+            return
+        self.by_name[client.name] = client
+        self.by_key[client.api_key] = client
+        if not client.not_server:
+            self.servers[client.name] = client
+        self._changed()
+
+    def remove_remote(self, client):
+        """
+        Forget about a client that was connected to another worker or node.
+        :param client: The system.bus.RemoteClient standing in for it.
+        """
+        if self.by_name.get(client.name) is client:
+            del self.by_name[client.name]
+        if self.by_key.get(client.api_key) is client:
+            del self.by_key[client.api_key]
+        removed = self.servers.get(client.name) is client
+        if removed:
+            del self.servers[client.name]
+        self._changed()
+        if removed:
+            manager.manager().runCallback("serverRemoved", serverRemovedEvent(client))
@@ -1,12 +1,54 @@
 # coding=utf-8
-import os
-import yaml
 import logging
 import system.util as util
 
+from collections import OrderedDict
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+from system import codec
+from system.config import conf, dump_yaml, load_yaml
 from system.decorators import Singleton
+from system.fileio import io, write_atomic
+from system.kvstore import BACKENDS, DELETED
 
 BASE_PATH = "data/%s"
+_MISSING = object()
+
+
+class Namespace(object):
+    """
+    A single namespace in the key-value store; get one with data().namespace(name), or use a plugin's `store`.
+    Keys are strings, and values can be anything that can be encoded to JSON.
+
+    Public methods:
+        get(key, default=None)  Get the value of a key, or default if it isn't set.
+        put(key, value)         Set the value of a key.
+        delete(key)             Delete a key.
+        keys()                  Get a list of all of the keys that are set.
+        flush()                 Commit everything now, instead of waiting. Returns a Deferred.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __contains__(self, key):
+        return self.store.get(self.name, key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        return self.store.get(self.name, key, default)
+
+    def put(self, key, value):
+        self.store.put(self.name, key, value)
+
+    def delete(self, key):
+        self.store.delete(self.name, key)
+
+    def keys(self):
+        return self.store.keys(self.name)
+
+    def flush(self):
+        return self.store.flush()
 
 
 @Singleton
@@ -23,12 +65,205 @@ class storage(object):
     Public methods:
         load_file()
         save_file()
+        load_file_async()   Like load_file(), but done on the file I/O thread. Returns a Deferred.
+        save_file_async()   Like save_file(), but done on the file I/O thread. Returns a Deferred.
+
+    Files are always saved atomically, and concurrent async requests for the same file are collapsed into a single
+        read or write; see system/fileio.py.
+
+    Rewriting a whole file for every change gets expensive for state that changes often, so there's also a key-value
+        store, split into namespaces - one for each plugin, usually. Use data().namespace(name) (or a plugin's
+        `store`) to get one, and then get(), put() and delete() single keys. Changes are visible straight away, but
+        they're committed by a backend (see system/kvstore.py) in batches, on the file I/O thread: every
+        `flush_interval` seconds, once `batch_size` changes are waiting, and when the reactor shuts down. Recently used
+        keys are kept in memory, so reading them doesn't touch the backend. If you change a value you got from the
+        store in place, put() it again, or the change won't be committed.
+
+    In multi-process mode, every worker has its own cache in front of the same backend. So each worker publishes the
+        keys it commits on the bus, and the others drop those keys from their caches. A change made on one worker
+        becomes visible on the others once it's committed. Until then they see the old value. If two workers change
+        the same key, the last one to commit wins.
+
+    Configuration, from storage.yml (add "storage: storage.yml" to mapping.yml):
+        backend:        "sqlite" (the default) or "log". Other settings are passed to the backend.
+        flush_interval: How often to commit changes, in seconds. Defaults to 1.
+        batch_size:     How many changes to let pile up before committing them early. Defaults to 10000.
+        cache_size:     How many keys to keep in memory. Defaults to 10000.
+
+    More public methods, for the key-value store:
+        namespace(name)                     Get a Namespace object for a namespace.
+        get(namespace, key, default=None)   Get the value of a key, or default if it isn't set.
+        put(namespace, key, value)          Set the value of a key.
+        delete(namespace, key)              Delete a key.
+        keys(namespace)                     Get a list of all of the keys that are set in a namespace.
+        flush()                             Commit everything now. Returns a Deferred that fires with True once
+                                                it's committed, or False if it couldn't be.
+        share(bus)                          Keep the cache in step with the other workers'. CoreFactory does this.
     """
     files = {}
     logger = logging.getLogger("Storage")
 
     def __init__(self):
-        pass
+        self.backend = None
+        self.namespaces = {}
+        self.cache = OrderedDict()  # {(namespace, key): value or DELETED}, least recently used first
+        self.pending = {}  # {(namespace, key): JSON or DELETED}, waiting to be committed
+        self.committing = {}  # The same, for the batch that's being committed right now
+        self.waiting = []  # Deferreds for flushes that are waiting for the commit in progress to finish
+        self.flusher = None
+        self.bus = None
+
+    def _open(self):
+        settings = conf().get("storage") or {}
+        name = settings.get("backend", "sqlite")
+        self.backend = BACKENDS[name](settings)
+        if self.bus is not None and name != "sqlite":
+            self.logger.warn("The %s key-value store backend isn't safe to share between worker processes; "
+                             "use sqlite instead." % name)
+        self.cache_size = settings.get("cache_size", 10000)
+        self.batch_size = settings.get("batch_size", 10000)
+
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(settings.get("flush_interval", 1), now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self._shutdown)
+        self.logger.info("Opened the %s key-value store." % name)
+
+    def _shutdown(self):
+        if self.flusher.running:
+            self.flusher.stop()
+        return self.flush()
+
+    def share(self, bus):
+        """
+        Drop keys that other workers have committed from the cache, and tell them about the keys we commit.
+        :param bus: This worker's system.bus.Bus.
+        """
+        self.bus = bus
+        bus.subscribe("storage", self.onBusCommit)
+
+    def onBusCommit(self, worker, message):
+        for namespace, key in message["keys"]:
+            self.cache.pop((namespace, key), None)
+
+    def namespace(self, name):
+        """
+        Get a namespace in the key-value store.
+        :param name: The name of the namespace; usually your plugin's name.
+        :return:     A Namespace object.
+        """
+        if self.backend is None:
+            self._open()
+        if name not in self.namespaces:
+            self.namespaces[name] = Namespace(self, name)
+        return self.namespaces[name]
+
+    def get(self, namespace, key, default=None):
+        """
+        Get the value of a key in the key-value store.
+        :param namespace: The namespace the key is in.
+        :param key:       The key.
+        :param default:   What to return if the key isn't set.
+        """
+        if self.backend is None:
+            self._open()
+        k = (namespace, key)
+        value = self.cache.pop(k, _MISSING)
+        if value is _MISSING:
+            value = self.pending.get(k, _MISSING)
+            if value is _MISSING:
+                value = self.committing.get(k, _MISSING)
+            if value is _MISSING:
+                value = self.backend.get(namespace, key)
+            elif value is not DELETED:
+                value = codec.decode(value)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[k] = value
+
+        if value is DELETED:
+            return default
+        return value
+
+    def put(self, namespace, key, value):
+        """
+        Set the value of a key in the key-value store.
+        :param namespace: The namespace the key is in.
+        :param key:       The key.
+        :param value:     The value; anything that can be encoded to JSON.
+        """
+        self._change((namespace, key), value, codec.encode(value))
+
+    def delete(self, namespace, key):
+        """
+        Delete a key from the key-value store.
+        :param namespace: The namespace the key is in.
+        :param key:       The key.
+        """
+        self._change((namespace, key), DELETED, DELETED)
+
+    def _change(self, k, value, stored):
+        if self.backend is None:
+            self._open()
+        self.cache.pop(k, None)
+        if len(self.cache) >= self.cache_size:
+            self.cache.popitem(last=False)
+        self.cache[k] = value
+        self.pending[k] = stored
+        if len(self.pending) >= self.batch_size and not self.committing:
+            self.flush()
+
+    def keys(self, namespace):
+        """
+        Get a list of all of the keys that are set in a namespace of the key-value store.
+        :param namespace: The namespace.
+        """
+        if self.backend is None:
+            self._open()
+        keys = set(self.backend.keys(namespace))
+        for changes in (self.committing, self.pending):
+            for (n, key), value in changes.iteritems():
+                if n == namespace:
+                    if value is DELETED:
+                        keys.discard(key)
+                    else:
+                        keys.add(key)
+        return list(keys)
+
+    def flush(self):
+        """
+        Commit all of the changes to the key-value store now, rather than waiting for the timer.
+        :return: A Deferred that fires with True once everything has been committed, or False if it couldn't be.
+        """
+        if self.committing:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        if not self.pending:
+            return defer.succeed(True)
+
+        batch, self.pending = self.pending, {}
+        self.committing = batch
+        return io().run(self.backend.commit, batch).addBoth(self._committed, batch)
+
+    def _committed(self, result, batch):
+        self.committing = {}
+        if isinstance(result, Failure):
+            self.logger.error("Unable to commit %s changes to the key-value store, will try again: %s" %
+                              (len(batch), result.getErrorMessage()))
+            for k, value in batch.iteritems():
+                self.pending.setdefault(k, value)  # Newer changes win
+            result = False
+        else:
+            result = True
+            if self.bus is not None:
+                self.bus.publish("storage", {"keys": [list(k) for k in batch]})
+
+        if self.waiting:
+            waiting, self.waiting = self.waiting, []
+            d = self.flush()
+            for waiter in waiting:
+                d.addCallback(_fire, waiter)
+        return result
 
     def _load_file(self, filename):
         try:
@@ -36,24 +271,26 @@ class storage(object):
             data = fh.read()
             fh.close()
 
-            return yaml.load(data)
+            return load_yaml(data)
         except Exception:
             util.output_exception(self.logger)
             return None
 
     def _save_file(self, filename, dictionary):
         try:
-            fh = open(filename, "w")
-            data = yaml.dump(dictionary, default_flow_style=False)
-            fh.write(data)
-            fh.flush()
-            fh.close()
-
+            write_atomic(filename, dump_yaml(dictionary))
             return True
         except Exception:
             util.output_exception(self.logger)
             return False
 
+    def _path(self, filename):
+        if "\\" in filename:
+            filename = filename.replace("\\", "/")
+        if "/" in filename:
+            filename = filename.replace("../", "")
+        return BASE_PATH % filename
+
     def save_file(self, filename, dictionary):
         """
         Save a dictionary to a yaml file.
@@ -61,16 +298,7 @@ class storage(object):
         :param dictionary: The data to be saved, a standard Python dictionary
         :param filename:   The file to save to, without data/
         """
-        if "\\" in filename:
-            filename = filename.replace("\\", "/")
-        if "/" in filename:
-            filename = filename.replace("../", "")
-            path = BASE_PATH % filename.split("/")
-            path = path[0:len(path)-1]
-            path = "/".join(path)
-            if not os.path.exists(path):
-                os.makedirs(path)
-        self._save_file(BASE_PATH % filename, dictionary)
+        return self._save_file(self._path(filename), dictionary)
 
     def load_file(self, filename):
         """
@@ -78,11 +306,43 @@ class storage(object):
         This will only load stuff in the data/ folder, don't specify data/ in the path.
         :param filename: The file to load from, without data/
         """
-        if "\\" in filename:
-            filename = filename.replace("\\", "/")
-        if "/" in filename:
-            filename = filename.replace("../", "")
-        return self._load_file(BASE_PATH % filename)
+        return self._load_file(self._path(filename))
+
+    def load_file_async(self, filename):
+        """
+        Load a dictionary from a yaml file, on the file I/O thread.
+        This will only load stuff in the data/ folder, don't specify data/ in the path.
+        :param filename: The file to load from, without data/
+        :return:         A Deferred that fires with the data, or None if the file couldn't be loaded.
+        """
+        filename = self._path(filename)
+
+        def failed(failure):
+            self.logger.error("Unable to load %s: %s" % (filename, failure.getErrorMessage()))
+            return None
+
+        return io().load(filename, load_yaml).addErrback(failed)
+
+    def save_file_async(self, filename, dictionary):
+        """
+        Save a dictionary to a yaml file, on the file I/O thread.
+        This will only save stuff in the data/ folder, don't specify data/ in the path.
+        :param dictionary: The data to be saved, a standard Python dictionary
+        :param filename:   The file to save to, without data/
+        :return:           A Deferred that fires with True once it's saved, or False if it couldn't be.
+        """
+        filename = self._path(filename)
+
+        def failed(failure):
+            self.logger.error("Unable to save %s: %s" % (filename, failure.getErrorMessage()))
+            return False
+
+        return io().save(filename, dictionary, dump_yaml).addErrback(failed)
+
+
+def _fire(result, d):
+    d.callback(result)
+    return result
 
 
 def data():
@@ -0,0 +1,87 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import functools
+import logging
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from system import config as conf
+from system.decorators import Singleton
+
+
+@Singleton
+class BlockingPool(object):
+    """
+    BlockingPool - A singleton holding the bounded thread pool that blocking work is offloaded to.
+    Use the pool() function at the bottom of this file or BlockingPool.Instance() to get an instance of this.
+
+    Anything that blocks - database queries, file I/O, talking to other services - stalls every connection if it's
+        done on the reactor thread. Mark event handlers that do that sort of thing with the @blocking decorator below,
+        and they'll be run here instead.
+
+    The pool is started the first time it's used, and stopped when the reactor shuts down. Its size is
+        `blocking_threads` in the networking configuration, and defaults to 10. Once every thread is busy, further
+        work waits in the pool's queue.
+
+    Public methods:
+        run(function, *args, **kwargs)  Run a function in the pool. Returns a Deferred that fires with its result
+                                          on the reactor thread.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Threads")
+        networking = conf.conf().get("networking") or {}
+        self.size = max(1, int(networking.get("blocking_threads", 10)))
+        self.threadpool = None
+
+    def start(self):
+        self.threadpool = ThreadPool(0, self.size, "blocking")
+        self.threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        self.logger.debug("Started the blocking thread pool with up to %s threads." % self.size)
+
+    def stop(self):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+
+    def run(self, function, *args, **kwargs):
+        if self.threadpool is None:
+            self.start()
+        return threads.deferToThreadPool(reactor, self.threadpool, function, *args, **kwargs)
+
+
+def pool():
+    """
+    Convenience method for getting an instance of the blocking thread pool singleton.
+    """
+    return BlockingPool.Instance()
+
+
+def blocking(function):
+    """
+    Decorator for event handlers (or anything else) that block. The decorated function is run in the bounded
+        blocking thread pool, and calling it returns a Deferred that fires with its result on the reactor thread.
+
+    The event manager waits for handlers that return Deferreds before running the next one, so a blocking handler can
+        still cancel the event. Remember that the handler runs in another thread: it mustn't touch connections or
+        anything else that belongs to the reactor. If you need to, split it in two - a @blocking method that does the
+        blocking work and returns its result, and a handler that calls it, adds a callback to the Deferred to deal
+        with the result on the reactor thread, and returns it.
+
+        @blocking
+        def loadPlayer(self, name):
+            return self.db.execute(...).fetchone()
+
+        def onOnline(self, event):
+            d = self.loadPlayer(event.data["player"])
+            d.addCallback(lambda row: event.caller.send(...))
+            return d
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return pool().run(function, *args, **kwargs)
+
+    wrapper.blocking = True
+    return wrapper
@@ -0,0 +1,79 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import random
+
+from system import config as conf
+from system.decorators import Singleton
+
+
+@Singleton
+class Tracer(object):
+    """
+    Tracer - A singleton that decides what gets traced on the per-message hot paths.
+    Use the tracer() function at the bottom of this file or Tracer.Instance() to get an instance of this.
+
+    Formatting debug messages for every line received, every line sent and every callback run is expensive, even
+        when the message is thrown away because we're logging at INFO. Instead of calling the logger directly, the
+        hot paths check a precomputed flag first, so tracing costs a single attribute lookup when it's disabled.
+
+    The flags are worked out by refresh(), which the factory calls on startup (after logging has been configured).
+        If you change log levels at runtime, call refresh() again.
+
+    When debugging production, tracing can be narrowed down with an optional `tracing` configuration mapping:
+        hosts:     A list of client hosts to trace. Other connections are not traced.
+        sample:    A number between 0 and 1; the fraction of connections that will be traced. Defaults to 1.
+        actions:   A list of message actions to trace. Messages with other actions are not traced.
+        callbacks: A list of event callback names to trace. Other callbacks are not traced.
+
+    Public attributes:
+        core   - Whether connection tracing is enabled at all (the Protocol logger is at DEBUG)
+        events - Whether event tracing is enabled at all (the Events logger is at DEBUG)
+
+    Public methods:
+        refresh()            Recompute the flags from the log levels and configuration.
+        connection(protocol) Decide whether a connection should be traced. Call this once per connection.
+        action(data)         Decide whether a parsed message should be traced.
+        callback(name)       Decide whether an event callback should be traced.
+    """
+
+    def __init__(self):
+        self.core = False
+        self.events = False
+        self.hosts = None
+        self.sample = 1.0
+        self.actions = None
+        self.callbacks = None
+
+    def refresh(self):
+        self.core = logging.getLogger("Protocol").isEnabledFor(logging.DEBUG)
+        self.events = logging.getLogger("Events").isEnabledFor(logging.DEBUG)
+
+        settings = conf.conf().get("tracing") or {}
+        self.hosts = set(settings["hosts"]) if settings.get("hosts") else None
+        self.sample = float(settings.get("sample", 1.0))
+        self.actions = set(settings["actions"]) if settings.get("actions") else None
+        self.callbacks = set(settings["callbacks"]) if settings.get("callbacks") else None
+
+    def connection(self, protocol):
+        if not self.core:
+            return False
+        if self.hosts is not None and protocol.host not in self.hosts:
+            return False
+        return self.sample >= 1 or random.random() < self.sample
+
+    def action(self, data):
+        if self.actions is None:
+            return True
+        return isinstance(data, dict) and data.get("action") in self.actions
+
+    def callback(self, name):
+        return self.callbacks is None or name in self.callbacks
+
+
+def tracer():
+    """
+    Convenience method for getting an instance of the tracer singleton.
+    """
+    return Tracer.Instance()
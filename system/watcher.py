@@ -0,0 +1,119 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import os
+
+from twisted.internet import reactor, task
+from twisted.python.failure import Failure
+from system import config as conf
+
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+except ImportError:  # inotify is Linux-only
+    inotify = None
+
+
+class ConfigWatcher(object):
+    """
+    Watches the config/ folder, and reloads the configuration when anything in it changes.
+
+    Reloading is done on the file I/O thread, and only the files that have actually changed are parsed again (see
+        system/config.py). If any mappings changed, the configuration fires a `configChanged` event naming them, so
+        plugins never need to poll the disk themselves.
+
+    On Linux, changes are picked up with inotify as soon as they happen; bursts of changes (an editor saving a file,
+        say) are collapsed into a single reload `delay` seconds after the last one. Elsewhere, or if inotify isn't
+        available, the configuration is reloaded every `interval` seconds instead.
+
+    Configuration, from `config_watcher` in the networking configuration:
+        enabled:  Whether to watch the configuration at all. Defaults to true.
+        inotify:  Whether to use inotify where it's available. Set this to false to always poll. Defaults to true.
+        interval: How often to poll, in seconds. Defaults to 5.
+
+    Public methods:
+        start() Start watching the configuration.
+        stop()  Stop watching the configuration.
+    """
+
+    delay = 0.25
+
+    def __init__(self, settings=None):
+        self.logger = logging.getLogger("Watcher")
+        settings = settings or {}
+        self.enabled = settings.get("enabled", True)
+        self.use_inotify = settings.get("inotify", True) and inotify is not None
+        self.interval = settings.get("interval", 5)
+        self.path = os.path.dirname(conf.BASE_PATH % "") or "."
+
+        self.notifier = None
+        self.poller = None
+        self.pending = None
+        self.reloading = False
+        self.again = False
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.use_inotify:
+            try:
+                self.notifier = inotify.INotify()
+                self.notifier.startReading()
+                mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_CREATE | \
+                    inotify.IN_DELETE
+                self.notifier.watch(FilePath(self.path), mask=mask, autoAdd=True, callbacks=[self.notified],
+                                    recursive=True)
+                self.logger.info("Watching %s/ for configuration changes with inotify." % self.path)
+                return
+            except Exception as e:
+                self.logger.warn("Unable to use inotify (%s), polling for configuration changes instead." % e)
+                self.notifier = None
+
+        self.poller = task.LoopingCall(self.reload)
+        self.poller.start(self.interval, now=False)
+        self.logger.info("Checking %s/ for configuration changes every %s seconds." % (self.path, self.interval))
+
+    def stop(self):
+        if self.notifier is not None:
+            # At shutdown, we're stopped from inside the reactor's own disconnectAll(), which will close the notifier
+            # after us if we close it here - and INotify can't be closed twice. So just stop reading now, and close it
+            # on the next iteration if the reactor hasn't already.
+            self.notifier.stopReading()
+            reactor.callLater(0, _close, self.notifier)
+            self.notifier = None
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        self.poller = None
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+
+    def notified(self, ignored, path, mask):
+        name = path.basename()
+        if name.startswith(".") and name.endswith(".tmp"):
+            return  # One of our atomic saves, which will be followed by a rename
+        if self.pending is not None and self.pending.active():
+            self.pending.reset(self.delay)
+        else:
+            self.pending = reactor.callLater(self.delay, self.reload)
+
+    def reload(self):
+        if self.reloading:
+            self.again = True  # Something changed while we were loading; go round again once we're done
+            return
+        self.reloading = True
+        self.again = False
+        conf.conf().reload_async().addBoth(self.reloaded)
+
+    def reloaded(self, result):
+        if isinstance(result, Failure):
+            self.logger.error("Unable to reload the configuration: %s" % result.getErrorMessage())
+        self.reloading = False
+        if self.again:
+            self.reload()
+
+
+def _close(notifier):
+    if notifier.connected:
+        notifier.loseConnection()
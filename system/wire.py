@@ -0,0 +1,159 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import struct
+import zlib
+
+from twisted.protocols.basic import LineReceiver
+from system import codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct(">IB")  # Payload length, flags
+
+FLAG_ZLIB = 0x01
+
+
+class WireFormat(object):
+    """
+    A wire format: how messages are encoded and framed on a connection.
+
+    Every connection starts out speaking newline-delimited JSON. The version handshake tells the client which other
+        formats we support, and a client can switch by sending {"format": name} as a line. We answer with
+        {"from": "core", "format": name}, and from then on both sides use the new format.
+
+    Framed formats send each message as a 5-byte header - a big-endian unsigned int with the payload length, followed
+        by a flags byte - and then the payload itself.
+
+    Clients may also ask for compression by adding {"compression": "zlib"} to the same message. Compressed
+        connections always use framing (JSON included), and payloads that were compressed have the FLAG_ZLIB flag set.
+        See ZlibStream below.
+
+    Whatever the format, plugins always see the same decoded dict in `dataReceivedEvent.data`.
+    """
+
+    name = None
+    framed = False
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, payload):
+        raise NotImplementedError()
+
+    def frame(self, message):
+        """
+        Encode and frame a message.
+        :param message: A codec.Frames instance holding the message.
+        :return:        The bytes to write to the transport.
+        """
+        payload = self.dumps(message.obj)
+        return HEADER.pack(len(payload), 0) + payload
+
+
+class LineJSON(WireFormat):
+    """
+    Newline-delimited JSON. This is what every connection starts with.
+    """
+
+    name = "json"
+
+    def dumps(self, obj):
+        return codec.encode(obj)
+
+    def loads(self, payload):
+        return codec.decode(payload)
+
+    def frame(self, message):
+        return message.json + LineReceiver.delimiter
+
+
+class FramedJSON(WireFormat):
+    """
+    Length-prefixed JSON frames. This is used for JSON connections that have asked for compression.
+    """
+
+    name = "json"
+    framed = True
+
+    def dumps(self, obj):
+        return codec.encode(obj)
+
+    def loads(self, payload):
+        return codec.decode(payload)
+
+
+class FramedMsgpack(WireFormat):
+    """
+    Length-prefixed MessagePack frames. Only available if the msgpack module is installed.
+    """
+
+    name = "msgpack"
+    framed = True
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+LINE_JSON = LineJSON()
+FRAMED_JSON = FramedJSON()
+
+FORMATS = {LINE_JSON.name: LINE_JSON}
+
+if msgpack is not None:
+    FORMATS[FramedMsgpack.name] = FramedMsgpack()
+
+
+class ZlibStream(object):
+    """
+    Per-connection zlib compression.
+
+    Each direction of a connection is a single deflate stream, flushed with Z_SYNC_FLUSH after every frame, so the
+        compression context carries over from one frame to the next and keys that show up in every message ("from",
+        "players", "target" and so on) compress down to almost nothing. Frames with payloads smaller than `threshold`
+        bytes are sent as they are, without the FLAG_ZLIB flag; they don't touch the stream at all.
+
+    Settings, from the `compression` section of the networking configuration:
+        enabled:     Whether to offer compression to clients at all. Defaults to true.
+        threshold:   The smallest payload, in bytes, that will be compressed. Defaults to 256.
+        level:       The zlib compression level. Defaults to 6.
+        window_bits: The zlib window size; lower this to save memory with lots of connections. Defaults to 15.
+        mem_level:   The zlib memory level; lower this to save memory with lots of connections. Defaults to 8.
+    """
+
+    name = "zlib"
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+        self.threshold = int(settings.get("threshold", 256))
+        self.compressor = zlib.compressobj(int(settings.get("level", 6)), zlib.DEFLATED,
+                                           int(settings.get("window_bits", 15)), int(settings.get("mem_level", 8)))
+        self.decompressor = zlib.decompressobj()
+
+    def compress(self, frame):
+        """
+        Compress an outgoing frame, if it's large enough to be worth it.
+        :param frame: A complete frame, header included.
+        :return:      The frame to write to the transport.
+        """
+        if len(frame) - HEADER.size < self.threshold:
+            return frame
+        payload = self.compressor.compress(buffer(frame, HEADER.size)) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return HEADER.pack(len(payload), FLAG_ZLIB) + payload
+
+    def decompress(self, payload, limit):
+        """
+        Decompress an incoming payload.
+        :param payload: The compressed payload.
+        :param limit:   The largest decompressed payload we'll accept. ValueError is raised for anything bigger.
+        """
+        data = self.decompressor.decompress(payload, limit)
+        if self.decompressor.unconsumed_tail:
+            raise ValueError("Decompressed frame is too long")
+        return data
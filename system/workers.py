@@ -0,0 +1,109 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+import logging
+import os
+import socket
+import sys
+
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import ProcessProtocol
+from system.bus import BusHub
+
+
+class WorkerProcess(ProcessProtocol):
+    """
+    Process protocol for a single worker. Workers share our stdout and stderr, so all we care about is when they exit.
+    """
+
+    def __init__(self, master, worker):
+        self.master = master
+        self.worker = worker
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.master.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class Master(object):
+    """
+    The master process for multi-process mode.
+
+    Set `workers` in the networking configuration to a number above 1 to use this. The master binds the listening
+        socket itself and starts that many worker processes (run.py --worker), handing each of them the socket, which
+        they adopt with reactor.adoptStreamPort. The kernel then spreads incoming connections across the workers, and
+        each worker runs its own CoreFactory, plugins and reactor on its own core.
+
+    The master also runs the bus hub (see system/bus.py) on a Unix socket, which the workers use to relay broadcasts
+        and targeted messages, and to share their registries and plugin state, so that the workers behave like a
+        single server to the clients. The socket path is `workers_socket` in the networking configuration, and
+        defaults to data/bus.sock.
+
+    Workers that exit unexpectedly are restarted after `restart_delay` seconds.
+
+    Public methods:
+        start() Bind the socket, start the hub and spawn the workers.
+        stop()  Stop the workers. Returns a Deferred that fires once they've all exited.
+    """
+
+    restart_delay = 1
+
+    def __init__(self, networking, debug=False):
+        self.logger = logging.getLogger("Master")
+        self.port = networking["port"]
+        self.count = int(networking.get("workers", 1))
+        self.path = networking.get("workers_socket", "data/bus.sock")
+        self.debug = debug
+        self.socket = None
+        self.hub = None
+        self.processes = {}
+        self.stopping = False
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", self.port))
+        self.socket.listen(50)
+        self.socket.setblocking(False)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.hub = reactor.listenUNIX(self.path, BusHub())
+
+        for worker in xrange(1, self.count + 1):
+            self.spawn(worker)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, worker):
+        fd = self.socket.fileno()
+        args = [sys.executable, sys.argv[0], "--worker", str(worker), "--fd", str(fd), "--bus", self.path]
+        if self.debug:
+            args.append("--debug")
+
+        process = WorkerProcess(self, worker)
+        reactor.spawnProcess(process, sys.executable, args, env=os.environ, path=os.getcwd(),
+                             childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+        self.processes[worker] = process
+        self.logger.info("Started worker %s (pid %s)." % (worker, process.transport.pid))
+
+    def workerEnded(self, process, reason):
+        if self.processes.get(process.worker) is process:
+            del self.processes[process.worker]
+        if self.stopping:
+            self.logger.info("Worker %s has stopped." % process.worker)
+            return
+        self.logger.warn("Worker %s exited unexpectedly: %s" % (process.worker, reason.getErrorMessage()))
+        reactor.callLater(self.restart_delay, self.spawn, process.worker)
+
+    def stop(self):
+        self.stopping = True
+        self.logger.info("Stopping %s workers.." % len(self.processes))
+        ended = []
+        for process in self.processes.values():
+            ended.append(process.ended)
+            try:
+                process.transport.signalProcess("TERM")
+            except Exception:
+                pass
+        return defer.DeferredList(ended)
@@ -0,0 +1,370 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+# Loopback checks for multi-process setups.
+#
+# This starts real server processes on 127.0.0.1, each from its own temporary directory with generated configuration,
+#   connects clients to them over TCP, and checks what the clients see:
+#
+#   federation  Three nodes, linked in a triangle (a -> b -> c -> a), so every message has a loop to go round.
+#               - Membership: a server that authenticates on one node shows up in players lists on the others, and
+#                 its API key can't be used on another node while it's connected.
+#               - Broadcast relay and loop suppression: a chat message sent on one node reaches the clients on each
+#                 of the others exactly once, and never comes back to its sender.
+#               - Player presence: a player that comes online on one node can be located from another.
+#               - Cleanup: a server that disconnects is forgotten by the other nodes, and so are all of a node's
+#                 servers once the node is killed and its links drop.
+#   workers     One server with several worker processes, linked by the worker bus. The kernel decides which worker
+#                 accepts each connection, so clients keep connecting (up to 24) until there's one on every worker;
+#                 fewer than two workers with clients fails the run, since nothing would cross the bus. Then the same
+#                 membership, relay, presence and cleanup checks are made, with the sender and the client looking the
+#                 player up on different workers. Searching the chat archive should give the same messages and IDs
+#                 whichever worker answers.
+#
+#   python tools/loopback.py                     Run both
+#   python tools/loopback.py federation --keep   Run one, and keep the nodes' directories and logs afterwards
+#
+# It exits with status 1 if any check fails.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEYS = dict(("key-srv-%s" % letter, "srv-%s" % letter) for letter in "abcdefghijklmnopqrstuvwx")
+
+
+class Node(object):
+    """
+    A server process, running from a temporary directory.
+    """
+
+    def __init__(self, name, port, networking=None, federation=None, python=sys.executable):
+        self.name = name
+        self.port = port
+        self.path = tempfile.mkdtemp(prefix="inter-loopback-%s-" % name)
+        for directory in ("system", "plugins"):
+            shutil.copytree(os.path.join(ROOT, directory), os.path.join(self.path, directory),
+                            ignore=shutil.ignore_patterns("*.pyc"))
+        shutil.copy(os.path.join(ROOT, "run.py"), self.path)
+        os.makedirs(os.path.join(self.path, "config"))
+        os.makedirs(os.path.join(self.path, "data"))
+
+        mapping = {"networking": "networking.yml", "auth": "auth.yml"}
+        settings = {"port": port, "config_watcher": {"enabled": False}}
+        settings.update(networking or {})
+        self._write("networking.yml", settings)
+        self._write("auth.yml", {"keys": KEYS})
+        if federation is not None:
+            mapping["federation"] = "federation.yml"
+            self._write("federation.yml", federation)
+        self._write("mapping.yml", mapping)
+
+        self.log = open(os.path.join(self.path, "server.log"), "w")
+        self.process = subprocess.Popen([python, "run.py"], cwd=self.path, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def _write(self, filename, data):
+        with open(os.path.join(self.path, "config", filename), "w") as fh:
+            yaml.safe_dump(data, fh, default_flow_style=False)
+
+    def wait(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Node %s exited with code %s; see %s" %
+                                   (self.name, self.process.returncode, os.path.join(self.path, "server.log")))
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("Node %s didn't start listening within %s seconds" % (self.name, timeout))
+
+    def worker(self, name, timeout=2):
+        """
+        Find out from the log which worker a client authenticated with, or None.
+        """
+        deadline = time.time() + timeout
+        while True:
+            for line in reversed(self.output().splitlines()):
+                if line.endswith("Client authenticated: %s" % name):
+                    worker = line.split(" | ")[1].strip()
+                    return worker if re.match(r"w\d+$", worker) else None
+            if time.time() > deadline:
+                return None
+            time.sleep(0.1)
+
+    def output(self):
+        with open(os.path.join(self.path, "server.log")) as fh:
+            return fh.read()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGKILL)
+            self.process.wait()
+
+    def stop(self, keep=False):
+        if self.process.poll() is None:
+            self.process.terminate()
+            deadline = time.time() + 10
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.kill()
+        self.log.close()
+        if keep:
+            print "  Kept node %s in %s" % (self.name, self.path)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Client(object):
+    """
+    A blocking JSON-lines client, authenticated with one of KEYS.
+    """
+
+    def __init__(self, port, name):
+        self.name = name
+        self.socket = socket.create_connection(("127.0.0.1", port), 5)
+        self.buffer = ""
+        self.send({"api_key": "key-%s" % name})
+
+    def send(self, message):
+        self.socket.sendall(json.dumps(message) + "\r\n")
+
+    def receive(self, timeout):
+        """
+        Get every message that arrives within `timeout` seconds.
+        """
+        messages = []
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            self.buffer += data
+            while "\r\n" in self.buffer:
+                line, self.buffer = self.buffer.split("\r\n", 1)
+                messages.append(json.loads(line))
+        return messages
+
+    def request(self, message, match, timeout=2):
+        """
+        Send a message, and return the first reply that `match(reply)` is true for, or None.
+        """
+        self.send(message)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for reply in self.receive(0.1):
+                if match(reply):
+                    return reply
+        return None
+
+    def servers(self):
+        # Every server this client's node knows about, apart from itself
+        reply = self.request({"action": "players", "type": "list"},
+                             lambda m: m.get("from") == "players" and m.get("type") == "list")
+        return set(reply["players"]) if reply else None
+
+    def close(self):
+        self.socket.close()
+
+
+class Checks(object):
+
+    def __init__(self):
+        self.failures = 0
+
+    def check(self, name, passed, detail=""):
+        print "  %s  %s%s" % ("ok  " if passed else "FAIL", name, " (%s)" % detail if detail and not passed else "")
+        if not passed:
+            self.failures += 1
+        return passed
+
+    def eventually(self, name, condition, timeout=10):
+        """
+        Check that condition() becomes true within `timeout` seconds.
+        """
+        deadline = time.time() + timeout
+        result = condition()
+        while not result and time.time() < deadline:
+            time.sleep(0.25)
+            result = condition()
+        return self.check(name, result)
+
+
+def relay(checks, sender, receivers):
+    """
+    Send a chat message, and check that each receiver gets exactly one copy of it, and the sender none.
+    """
+    text = "loopback %s" % uuid.uuid4().hex
+    sender.send({"action": "chat", "user": "tester", "message": text})
+    counts = {}
+    for client in [sender] + receivers:
+        counts[client.name] = len([m for m in client.receive(1.5)
+                                   if m.get("from") == "chat" and m.get("message") == text])
+    checks.check("chat from %s reaches %s exactly once each" % (sender.name, ", ".join(c.name for c in receivers)),
+                 all(counts[client.name] == 1 for client in receivers), "copies received: %s" % counts)
+    checks.check("chat from %s doesn't come back to it" % sender.name, counts[sender.name] == 0,
+                 "copies received: %s" % counts[sender.name])
+
+
+def locate(checks, owner, other, player):
+    owner.send({"action": "players", "type": "online", "player": player})
+
+    def located():
+        reply = other.request({"action": "players", "type": "locate", "player": player},
+                              lambda m: m.get("type") == "locate")
+        return reply is not None and reply.get("server") == owner.name
+    checks.eventually("player online on %s can be located from %s" % (owner.name, other.name), located, 5)
+
+
+def federation(args, checks):
+    print "Federation: three nodes in a triangle"
+    base = args.port
+    names = ("a", "b", "c")
+    ports = dict((name, base + i) for i, name in enumerate(names))
+    peer_ports = dict((name, base + 10 + i) for i, name in enumerate(names))
+    links = {"a": "b", "b": "c", "c": "a"}
+
+    nodes = {}
+    try:
+        for name in names:
+            nodes[name] = Node(name, ports[name], federation={
+                "node": "node-%s" % name, "secret": "loopback", "port": peer_ports[name],
+                "interface": "127.0.0.1", "peers": [{"host": "127.0.0.1", "port": peer_ports[links[name]]}]
+            }, python=args.python)
+        for node in nodes.values():
+            node.wait()
+
+        checks.eventually("every node links up with both of the others",
+                          lambda: all(node.output().count("Linked up with node") >= 2 for node in nodes.values()))
+
+        clients = dict((name, Client(ports[name], "srv-%s" % name)) for name in names)
+        a, b, c = clients["a"], clients["b"], clients["c"]
+        for client in clients.values():
+            client.receive(0.5)
+
+        for name, client in clients.items():
+            expected = set("srv-%s" % other for other in names if other != name)
+            checks.eventually("%s sees the servers on the other nodes" % client.name,
+                              lambda client=client, expected=expected: client.servers() == expected)
+
+        duplicate = Client(ports["c"], "srv-a")
+        reply = [m for m in duplicate.receive(1) if m.get("from") == "auth"]
+        checks.check("srv-a's API key is refused on another node while it's connected",
+                     any(m.get("code") == 2 for m in reply), reply)
+        duplicate.close()
+
+        relay(checks, a, [b, c])
+        relay(checks, c, [a, b])
+        locate(checks, a, c, "alice")
+
+        b.close()
+        checks.eventually("the other nodes forget srv-b once it disconnects",
+                          lambda: a.servers() == {"srv-c"} and c.servers() == {"srv-a"})
+
+        nodes["a"].kill()
+        checks.eventually("node c forgets srv-a once node a is killed", lambda: c.servers() == set())
+        c.close()
+    finally:
+        for node in nodes.values():
+            node.stop(args.keep)
+
+
+def workers(args, checks):
+    print "Workers: one server with %s worker processes" % args.workers
+    node = Node("workers", args.port, networking={"workers": args.workers}, python=args.python)
+    clients = []
+    try:
+        node.wait()
+        time.sleep(1)  # The workers come up after the master starts listening
+        placed = {}  # {name: worker}
+        for name in sorted(KEYS.values()):
+            client = Client(args.port, name)
+            client.receive(0.2)
+            clients.append(client)
+            placed[name] = node.worker(name)
+            if len(clients) >= 6 and len(set(placed.values()) - {None}) >= args.workers:
+                break
+        spread = set(placed.values()) - {None}
+        if not checks.check("clients landed on at least two workers", len(spread) >= 2,
+                            "all %s clients went to %s" % (len(clients), ", ".join(sorted(spread)) or "no worker")):
+            return
+        print "  %s clients, spread over %s" % (len(clients), ", ".join(sorted(spread)))
+
+        names = set(placed)
+        for client in clients:
+            checks.eventually("%s sees every other server" % client.name,
+                              lambda client=client: client.servers() == names - {client.name})
+
+        # Send from one worker, and look the player up from another, so that both have to cross the bus
+        sender = clients[0]
+        other = [client for client in clients if placed[client.name] != placed[sender.name]][0]
+        relay(checks, sender, clients[1:])
+        locate(checks, sender, other, "bob")
+
+        found = []
+        for client in clients:
+            reply = client.request({"action": "chat-archive"}, lambda m: m.get("type") == "archive", 5) or {}
+            found.append([(m["id"], m["message"]) for m in reply.get("messages", [])])
+        checks.check("chat archive searches give the same messages and IDs on every worker",
+                     found[0] and all(messages == found[0] for messages in found), found)
+
+        gone = clients.pop()
+        gone.close()
+        del placed[gone.name]
+        checks.eventually("every worker forgets %s once it disconnects" % gone.name,
+                          lambda: all(gone.name not in client.servers() for client in clients))
+    finally:
+        for client in clients:
+            client.close()
+        node.stop(args.keep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check federation and the worker bus with real processes on "
+                                                 "127.0.0.1.")
+    parser.add_argument("setups", nargs="*", metavar="setup",
+                        help="Which setups to check: federation and/or workers (default both)")
+    parser.add_argument("--port", type=int, default=35700, help="First port to use (default 35700)")
+    parser.add_argument("--workers", type=int, default=3,
+                        help="Worker processes for the workers check, at least 2 (default 3)")
+    parser.add_argument("--python", default=sys.executable, help="Python to run the servers with")
+    parser.add_argument("--keep", action="store_true", help="Keep the servers' temporary directories and logs")
+    args = parser.parse_args()
+    setups = {"federation": federation, "workers": workers}
+    for setup in args.setups:
+        if setup not in setups:
+            parser.error("Unknown setup: %s" % setup)
+
+    checks = Checks()
+    for setup in args.setups or ["federation", "workers"]:
+        setups[setup](args, checks)
+
+    if checks.failures:
+        print "%s check(s) failed." % checks.failures
+        sys.exit(1)
+    print "All checks passed."
+
+
+if __name__ == "__main__":
+    main()